@@ -1,106 +1,212 @@
 import os
+import time
+import tempfile
+import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from skimage.draw import disk
-from skimage.util import random_noise
-from utils import seed_everything, normalize01
+from scipy.spatial import cKDTree
+from utils import seed_everything
+from image_store import ChunkedArray, CHUNK_SIDE, preview
+from perf import stage_profile, section
 
-OUT_IMG = os.path.join("data", "raw", "microscopy_image.npy")
-OUT_GT  = os.path.join("data", "raw", "gt_mask.npy")
+OUT_IMG = os.path.join("data", "raw", "microscopy_image.chunks")
+OUT_GT  = os.path.join("data", "raw", "gt_mask.chunks")
 OUT_META = os.path.join("data", "raw", "cell_metadata.csv")
 
 # "BARseq-like" second view (synthetic)
 OUT_BARCODES = os.path.join("data", "raw", "barcode_view.csv")
 
-def main():
-    seed_everything(42)
-    rng = np.random.default_rng(42)
-
-    H, W = 256, 256
-    n_cells = 180
-    n_types = 4  # synthetic "cell types"
-    barcode_dim = 12
-    proj_dim = 8
-
-    # base background with gentle gradient
-    yy, xx = np.mgrid[0:H, 0:W]
-    background = 0.15 + 0.15*(xx/W) + 0.10*(yy/H)
-
-    img = background.copy()
-    gt = np.zeros((H, W), dtype=np.int32)
+OUT_PREVIEW = os.path.join("figures", "synthetic_image_preview.png")
+
+# noise is drawn per block of rows from its own seeded substream, so the image does not
+# depend on --chunk-rows
+NOISE_BLOCK = 256
+NOISE_VAR = 0.01
+PREVIEW_MAX = 2048
+TABLE_CHUNK = 100_000
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Generate a synthetic microscopy image, GT mask and barcode view.")
+    p.add_argument("--height", type=int, default=256)
+    p.add_argument("--width", type=int, default=256)
+    p.add_argument("--n-cells", type=int, default=180)
+    p.add_argument("--n-types", type=int, default=4, help="synthetic cell types")
+    p.add_argument("--barcode-dim", type=int, default=12)
+    p.add_argument("--proj-dim", type=int, default=8)
+    p.add_argument("--min-dist", type=float, default=10.0, help="minimum distance between cell centres")
+    p.add_argument("--margin", type=int, default=12, help="keep centres this far from the border")
+    p.add_argument("--chunk-rows", type=int, default=2048, help="image rows rendered per chunk (rounded to the store chunk)")
+    p.add_argument("--seed", type=int, default=42)
+    return p.parse_args()
+
+def place_centers(n, H, W, min_dist, margin, rng, max_rounds=200):
+    # Dart throwing in vectorized batches against a background grid with cells of side
+    # min_dist/sqrt(2): each grid cell holds at most one centre, so a candidate only has to
+    # be checked against the 5x5 grid neighbourhood instead of every accepted centre.
+    cs = min_dist / np.sqrt(2)
+    gh, gw = int(np.ceil(H / cs)), int(np.ceil(W / cs))
+    occ = np.full((gh + 4, gw + 4), -1, dtype=np.int64)
+    centers = np.empty((n, 2), dtype=np.int64)
+    k = 0
+    for _ in range(max_rounds):
+        if k >= n:
+            break
+        m = min(max(2 * (n - k), 64), 1 << 20)
+        cand = np.column_stack([rng.integers(margin, H - margin, m), rng.integers(margin, W - margin, m)])
+        gy = (cand[:, 0] / cs).astype(np.int64) + 2
+        gx = (cand[:, 1] / cs).astype(np.int64) + 2
+
+        ok = np.ones(m, dtype=bool)
+        for dy in range(-2, 3):
+            for dx in range(-2, 3):
+                j = occ[gy + dy, gx + dx]
+                has = np.flatnonzero(j >= 0)
+                d2 = ((centers[j[has]] - cand[has]) ** 2).sum(axis=1)
+                ok[has[d2 <= min_dist ** 2]] = False
+        cand, gy, gx = cand[ok], gy[ok], gx[ok]
+
+        # conflicts inside the batch: drop the later candidate of every close pair
+        if len(cand) > 1:
+            pairs = cKDTree(cand).query_pairs(min_dist, output_type="ndarray")
+            keep = np.ones(len(cand), dtype=bool)
+            keep[pairs.max(axis=1)] = False
+            cand, gy, gx = cand[keep], gy[keep], gx[keep]
+
+        take = min(len(cand), n - k)
+        centers[k:k + take] = cand[:take]
+        occ[gy[:take], gx[:take]] = np.arange(k, k + take)
+        k += take
+    return centers[:k]
+
+def disk_offsets(radius):
+    # same footprint as skimage.draw.disk: (dy^2 + dx^2) < radius^2
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    m = dy**2 + dx**2 < radius**2
+    return dy[m], dx[m]
+
+def render_rows(r0, r1, H, W, cy, cx, radius, intensity, ids):
+    # background with gentle gradient + additive cell blobs; later cells overwrite GT
+    yy = np.arange(r0, r1, dtype=float)[:, None]
+    xx = np.arange(W, dtype=float)[None, :]
+    img = 0.15 + 0.15*(xx/W) + 0.10*(yy/H)
+    gt = np.zeros((r1 - r0, W), dtype=np.int32)
+
+    sel = (cy + radius > r0) & (cy - radius < r1)
+    for r in np.unique(radius[sel]):
+        m = sel & (radius == r)
+        dy, dx = disk_offsets(int(r))
+        ys = cy[m][:, None] + dy[None, :]
+        xs = cx[m][:, None] + dx[None, :]
+        inb = (ys >= r0) & (ys < r1) & (xs >= 0) & (xs < W)
+        flat = ((ys - r0) * W + xs)[inb]
+        np.add.at(img.ravel(), flat, np.broadcast_to(intensity[m][:, None], ys.shape)[inb])
+        np.maximum.at(gt.ravel(), flat, np.broadcast_to(ids[m][:, None], ys.shape)[inb].astype(np.int32))
+    return img, gt
+
+def write_table(df, path):
+    for i in range(0, max(len(df), 1), TABLE_CHUNK):
+        df.iloc[i:i + TABLE_CHUNK].to_csv(path, index=False, mode="w" if i == 0 else "a", header=i == 0)
 
-    rows = []
-    barcode_rows = []
+def main():
+    args = parse_args()
+    seed_everything(args.seed)
+    t0 = time.perf_counter()
 
-    # cell-type prototypes for barcode/projection
-    type_proto_bar = 1.0 * rng.normal(0, 1, size=(n_types, barcode_dim))
-    type_proto_prj = 1.0 * rng.normal(0, 1, size=(n_types, proj_dim))
+    H, W = args.height, args.width
+    n_types = args.n_types  # synthetic "cell types"
+    place_ss, attr_ss, noise_ss = np.random.SeedSequence(args.seed).spawn(3)
+    rng = np.random.default_rng(attr_ss)
 
     # place cells (avoid borders)
-    centers = []
-    for cid in range(1, n_cells+1):
-        for _ in range(200):
-            cy = int(rng.integers(12, H-12))
-            cx = int(rng.integers(12, W-12))
-            if all((cy-y)**2 + (cx-x)**2 > 10**2 for y,x in centers):
-                centers.append((cy,cx))
-                break
-
-        ctype = int(rng.integers(0, n_types))
-        radius = int(rng.integers(5, 12))
-        intensity = float(rng.uniform(0.45, 0.95)) + 0.08*ctype
-
-        rr, cc = disk((cy, cx), radius=radius, shape=img.shape)
-
-        # add a bright nucleus-like blob (soft)
-        img[rr, cc] += intensity
-
-        # write GT label
-        gt[rr, cc] = cid
-
-        rows.append({
-            "cell_id": cid,
-            "true_type": ctype,
-            "cy": cy,
-            "cx": cx,
-            "radius": radius,
-            "intensity": intensity
-        })
-
-        # barcode/projection view per cell (type + noise)
-        bar = type_proto_bar[ctype] + rng.normal(0, 0.8, size=barcode_dim)
-        prj = type_proto_prj[ctype] + rng.normal(0, 0.8, size=proj_dim)
-        br = {"cell_id": cid, "true_type": ctype}
-        for j in range(barcode_dim):
-            br[f"bar_{j+1}"] = float(bar[j])
-        for j in range(proj_dim):
-            br[f"prj_{j+1}"] = float(prj[j])
-        barcode_rows.append(br)
-
-    # add noise + normalize to [0,1]
-    img = random_noise(img, mode="gaussian", var=0.01)
-    img = normalize01(img)
+    with section("placement"):
+        centers = place_centers(args.n_cells, H, W, args.min_dist, args.margin, np.random.default_rng(place_ss))
+    n = len(centers)
+    if n < args.n_cells:
+        print(f"Warning: only {n:,} of {args.n_cells:,} cells fit at min distance {args.min_dist}")
+    cy, cx = centers[:, 0], centers[:, 1]
+    ids = np.arange(1, n + 1)
+
+    ctype = rng.integers(0, n_types, size=n)
+    radius = rng.integers(5, 12, size=n)
+    intensity = rng.uniform(0.45, 0.95, size=n) + 0.08*ctype
+
+    # cell-type prototypes for barcode/projection; per-cell view = type + noise
+    type_proto_bar = 1.0 * rng.normal(0, 1, size=(n_types, args.barcode_dim))
+    type_proto_prj = 1.0 * rng.normal(0, 1, size=(n_types, args.proj_dim))
+    bar = type_proto_bar[ctype] + rng.normal(0, 0.8, size=(n, args.barcode_dim))
+    prj = type_proto_prj[ctype] + rng.normal(0, 0.8, size=(n, args.proj_dim))
 
     os.makedirs(os.path.dirname(OUT_IMG), exist_ok=True)
-    np.save(OUT_IMG, img.astype(np.float32))
-    np.save(OUT_GT, gt)
-
-    pd.DataFrame(rows).to_csv(OUT_META, index=False)
-    pd.DataFrame(barcode_rows).to_csv(OUT_BARCODES, index=False)
-
-    # save a quick preview
+    img = ChunkedArray.create(OUT_IMG, (H, W), np.float32)
+    gt = ChunkedArray.create(OUT_GT, (H, W), np.int32)
+
+    # render in row chunks: cells + gaussian noise (clipped like skimage random_noise) into
+    # an uncompressed scratch memmap, then a second pass normalizes to [0,1] with the global
+    # range and compresses each band into the store once; bands are whole store chunks
+    chunk = max(CHUNK_SIDE, (args.chunk_rows // CHUNK_SIDE) * CHUNK_SIDE)
+    noise_seeds = noise_ss.spawn(int(np.ceil(H / NOISE_BLOCK)))
+    lo, hi = np.inf, -np.inf
+    fd, scratch_path = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(OUT_IMG))
+    os.close(fd)
+    raw = None
+    try:
+        raw = np.lib.format.open_memmap(scratch_path, mode="w+", dtype=np.float32, shape=(H, W))
+        with section("render"):
+            for r0 in range(0, H, chunk):
+                r1 = min(r0 + chunk, H)
+                band, band_gt = render_rows(r0, r1, H, W, cy, cx, radius, intensity, ids)
+                for b0 in range(r0, r1, NOISE_BLOCK):
+                    b1 = min(b0 + NOISE_BLOCK, r1)
+                    noise = np.random.default_rng(noise_seeds[b0 // NOISE_BLOCK]).normal(0, np.sqrt(NOISE_VAR), size=(b1 - b0, W))
+                    band[b0 - r0:b1 - r0] += noise
+                np.clip(band, 0.0, 1.0, out=band)
+                lo, hi = min(lo, band.min()), max(hi, band.max())
+                raw[r0:r1] = band
+                gt[r0:r1] = band_gt
+        with section("normalize"):
+            for r0 in range(0, H, chunk):
+                band = raw[r0:r0 + chunk].astype(float)
+                img[r0:r0 + chunk] = (band - lo) / ((hi - lo) + 1e-12)
+    finally:
+        del raw
+        os.remove(scratch_path)
+    with section("levels"):
+        img.build_levels()
+        gt.build_levels()
+
+    meta = pd.DataFrame({
+        "cell_id": ids,
+        "true_type": ctype,
+        "cy": cy,
+        "cx": cx,
+        "radius": radius,
+        "intensity": intensity,
+    })
+    write_table(meta, OUT_META)
+
+    bv = pd.DataFrame({"cell_id": ids, "true_type": ctype})
+    bv = pd.concat([
+        bv,
+        pd.DataFrame(bar, columns=[f"bar_{j+1}" for j in range(args.barcode_dim)]),
+        pd.DataFrame(prj, columns=[f"prj_{j+1}" for j in range(args.proj_dim)]),
+    ], axis=1)
+    write_table(bv, OUT_BARCODES)
+
+    # save a quick preview (from a downsampled level for large images)
     os.makedirs("figures", exist_ok=True)
     plt.figure(figsize=(6,6))
-    plt.imshow(img, cmap="gray")
+    plt.imshow(preview(img, PREVIEW_MAX)[0], cmap="gray")
     plt.title("Synthetic microscopy image (preview)")
     plt.axis("off")
     plt.tight_layout()
-    plt.savefig("figures/synthetic_image_preview.png", dpi=200)
+    plt.savefig(OUT_PREVIEW, dpi=200)
     plt.close()
 
+    print(f"Generated {H}x{W} image with {n:,} cells in {time.perf_counter() - t0:.1f}s")
     print(f"Saved: {OUT_IMG}, {OUT_GT}, {OUT_META}, {OUT_BARCODES}")
-    print("Preview: figures/synthetic_image_preview.png")
+    print(f"Preview: {OUT_PREVIEW}")
 
 if __name__ == "__main__":
-    main()
+    with stage_profile(__file__, globals()):
+        main()
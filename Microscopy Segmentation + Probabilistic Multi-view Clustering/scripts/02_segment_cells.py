@@ -1,47 +1,127 @@
 import os
+import shutil
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import ndimage as ndi
-from skimage.filters import threshold_otsu, gaussian
-from skimage.morphology import remove_small_objects, binary_opening, disk
-from skimage.segmentation import watershed, find_boundaries
-from skimage.measure import label
+from skimage.segmentation import find_boundaries
 from utils import seed_everything
+from segmentation import segment_image, segment_tiled, label_dtype, working_bytes, fit_tile_size
+from seg_sweep import run_seg_sweep
+from image_store import META, ChunkedArray, open_image, write_image, preview
+from perf import stage_profile, section, note
 
-IN_IMG = os.path.join("data", "raw", "microscopy_image.npy")
-IN_GT  = os.path.join("data", "raw", "gt_mask.npy")
+IN_IMG = os.path.join("data", "raw", "microscopy_image.chunks")
+IN_GT  = os.path.join("data", "raw", "gt_mask.chunks")
 
-OUT_MASK = os.path.join("data", "processed", "seg_mask.npy")
+OUT_MASK = os.path.join("data", "processed", "seg_mask.chunks")
 OUT_OVERLAY = os.path.join("figures", "segmentation_overlay.png")
+OUT_SEG_SWEEP = os.path.join("reports", "segmentation_sweep.csv")
 
-def main():
-    seed_everything(42)
-    img = np.load(IN_IMG)
-    gt = np.load(IN_GT)
+# intermediate products of --sweep (smoothed images, masks, EDTs), reused across sweeps
+SWEEP_CACHE = os.path.join("data", "processed", "seg_sweep_cache")
 
-    # smooth and threshold
-    smooth = gaussian(img, sigma=1.0, preserve_range=True)
-    thr = threshold_otsu(smooth)
-    bw = smooth > thr
+# longest side of the overlay figure; larger images are shown from a downsampled level
+PREVIEW_MAX = 2048
 
-    # cleanup
-    bw = binary_opening(bw, footprint=disk(2))
-    bw = remove_small_objects(bw, min_size=40)
+def parse_args():
+    p = argparse.ArgumentParser(description="Baseline Otsu + watershed cell segmentation.")
+    p.add_argument("--tiled", action="store_true",
+                   help="out-of-core mode: memory-mapped input, overlapping tiles, stitched labels")
+    p.add_argument("--tile-size", type=int, default=2048)
+    p.add_argument("--max-cell-radius", type=int, default=12,
+                   help="largest expected cell radius in pixels (sets the tile halo)")
+    p.add_argument("--halo", type=int, default=None,
+                   help="tile overlap in pixels (default: 4 x max cell radius)")
+    p.add_argument("--z", type=int, default=None, help="z-slice of a volumetric image (default: middle)")
+    p.add_argument("--channel", type=int, default=None, help="channel of a multi-channel image (default: 0)")
+    p.add_argument("--max-otsu-samples", type=int, default=4_000_000,
+                   help="pixels sampled for the global Otsu histogram in tiled mode")
+    p.add_argument("--low-memory", action="store_true",
+                   help="float32 working arrays, in-place steps and the smallest label dtype")
+    p.add_argument("--max-memory-mb", type=float, default=None,
+                   help="peak working-memory ceiling; in tiled mode it also caps the tile size")
+    p.add_argument("--on-exceed", choices=["fail", "tile"], default="fail",
+                   help="what to do when the in-memory path would exceed --max-memory-mb")
+    p.add_argument("--sweep", action="store_true",
+                   help="score a grid of settings against GT (cached, in parallel); the best one is saved")
+    p.add_argument("--sigmas", default="0.5,1.0,1.5,2.0")
+    p.add_argument("--open-radii", default="1,2,3")
+    p.add_argument("--min-sizes", default="20,40,80")
+    p.add_argument("--marker-percentiles", default="60,75,90")
+    p.add_argument("--rank-by", choices=["dice", "iou", "f1"], default="dice",
+                   help="ranking metric (f1 = instance F1 at IoU 0.5); ties go to the other one")
+    p.add_argument("--workers", type=int, default=None)
+    args = p.parse_args()
+    if args.sweep and args.tiled:
+        p.error("--sweep segments the whole plane in memory; it cannot be combined with --tiled")
+    return args
 
-    # distance + watershed
-    dist = ndi.distance_transform_edt(bw)
-    # local maxima as markers (simple)
-    markers = label(dist > np.percentile(dist[bw], 75))
-    seg = watershed(-dist, markers, mask=bw)
+def sweep(args, img, plane):
+    # grid search over the segmentation settings; returns the labels of the best setting
+    gt = open_image(IN_GT, plane)
+    stamp = {"image": IN_IMG, "plane": plane,
+             "mtime_ns": os.stat(os.path.join(IN_IMG, META)).st_mtime_ns}
+    with section("sweep"):
+        table, params, seg, timing = run_seg_sweep(
+            img, gt,
+            sigmas=[float(v) for v in args.sigmas.split(",")],
+            open_radii=[int(v) for v in args.open_radii.split(",")],
+            min_sizes=[int(v) for v in args.min_sizes.split(",")],
+            marker_percentiles=[float(v) for v in args.marker_percentiles.split(",")],
+            cache_dir=SWEEP_CACHE, stamp=stamp, rank_by=args.rank_by, workers=args.workers,
+        )
+    for k, v in timing.items():
+        note(f"sweep_{k}", v)
+    os.makedirs(os.path.dirname(OUT_SEG_SWEEP), exist_ok=True)
+    table.to_csv(OUT_SEG_SWEEP, index=False)
+    print(table.head(10).to_string(index=False, float_format=lambda v: f"{v:.4g}"))
+    print(f"Saved sweep table: {OUT_SEG_SWEEP} ({len(table)} settings; "
+          f"{timing['masks_computed']} masks computed, {timing['masks_cached']} from cache)")
+    return seg.astype(np.int32), params
 
-    os.makedirs(os.path.dirname(OUT_MASK), exist_ok=True)
-    np.save(OUT_MASK, seg.astype(np.int32))
+def shrink_labels(path, n_labels, chunk_rows=4096):
+    # rewrite an int32 label store in the smallest dtype that holds n_labels
+    dtype = label_dtype(n_labels)
+    src = ChunkedArray(path)
+    if dtype.itemsize >= src.dtype.itemsize:
+        return
+    tmp = path + ".tmp"
+    dst = ChunkedArray.create(tmp, src.shape, dtype, axes=src.axes, attrs=src.attrs)
+    for r0 in range(0, src.shape[0], chunk_rows):
+        dst[r0:r0 + chunk_rows] = src[r0:r0 + chunk_rows]
+    shutil.rmtree(path)
+    os.replace(tmp, path)
 
-    # overlay plot
+def plan_memory(args, shape, halo):
+    # apply --max-memory-mb: fail fast, switch to tiling, or shrink the tile size
+    if args.max_memory_mb is None:
+        return
+    budget = args.max_memory_mb * (1 << 20)
+    if not args.tiled:
+        # the in-memory path also holds the float32 input
+        need = working_bytes(shape, args.low_memory) + int(np.prod(shape)) * 4
+        if need <= budget:
+            return
+        msg = f"in-memory segmentation needs ~{need / (1 << 20):,.0f} MB, above --max-memory-mb {args.max_memory_mb:,.0f}"
+        if args.on_exceed == "fail":
+            raise SystemExit(msg + "; use --low-memory, --tiled or --on-exceed tile")
+        print(msg + "; falling back to tiled mode")
+        args.tiled = True
+    tile = fit_tile_size(budget, halo, args.low_memory, args.tile_size)
+    if tile is None:
+        raise SystemExit(f"--max-memory-mb {args.max_memory_mb:,.0f} is too small for one tile with a {halo}px halo")
+    if tile < args.tile_size:
+        print(f"Tile size reduced to {tile}px to fit --max-memory-mb {args.max_memory_mb:,.0f}")
+        args.tile_size = tile
+
+def save_overlay(img, seg):
     os.makedirs("figures", exist_ok=True)
-    boundaries = find_boundaries(seg, mode="outer")
+    img_s, _ = preview(img, PREVIEW_MAX)
+    # label levels round odd sizes up, image levels down
+    seg_s = preview(seg, PREVIEW_MAX)[0][:img_s.shape[0], :img_s.shape[1]]
+    boundaries = find_boundaries(seg_s, mode="outer")
     plt.figure(figsize=(6,6))
-    plt.imshow(img, cmap="gray")
+    plt.imshow(img_s, cmap="gray")
     plt.imshow(np.ma.masked_where(~boundaries, boundaries), cmap="autumn", alpha=0.9)
     plt.title("Segmentation overlay (baseline)")
     plt.axis("off")
@@ -49,8 +129,49 @@ def main():
     plt.savefig(OUT_OVERLAY, dpi=200)
     plt.close()
 
+def main():
+    args = parse_args()
+    seed_everything(42)
+    os.makedirs(os.path.dirname(OUT_MASK), exist_ok=True)
+
+    halo = args.halo if args.halo is not None else 4 * args.max_cell_radius
+    # the image is read lazily; for z-stacks / multi-channel images one plane is segmented
+    # and recorded in the mask, so 03 and 06 read the same plane
+    img = open_image(IN_IMG, {"z": args.z, "c": args.channel})
+    plane = getattr(img, "plane", {})
+    plan_memory(args, img.shape, halo)
+
+    if args.tiled:
+        seg = ChunkedArray.create(OUT_MASK, img.shape, np.int32, attrs={"plane": plane})
+        info = segment_tiled(img, seg, tile_size=args.tile_size, halo=halo,
+                             max_otsu_samples=args.max_otsu_samples,
+                             scratch_dir=os.path.dirname(OUT_MASK),
+                             low_memory=args.low_memory)
+        if args.low_memory:
+            shrink_labels(OUT_MASK, info["n_labels"])
+            seg = ChunkedArray(OUT_MASK)
+        with section("levels"):
+            seg.build_levels()
+        print(f"Tiled segmentation: {info['n_tiles']} tiles of {args.tile_size}px (halo {halo}px), "
+              f"{info['n_labels']:,} cells, Otsu threshold {info['otsu_threshold']:.4f}")
+        if info["truncated_objects"]:
+            print(f"Warning: {info['truncated_objects']} objects exceeded the halo and may be cut at tile seams; "
+                  "increase --max-cell-radius or --halo")
+    elif args.sweep:
+        seg, params = sweep(args, np.asarray(img), plane)
+        seg = write_image(seg, OUT_MASK, attrs={"plane": plane, "params": params})
+        print(f"Best setting: {params}")
+    else:
+        seg = segment_image(np.asarray(img), low_memory=args.low_memory)
+        seg = write_image(seg if args.low_memory else seg.astype(np.int32), OUT_MASK, attrs={"plane": plane})
+
+    # overlay plot
+    with section("overlay"):
+        save_overlay(img, seg)
+
     print(f"Saved segmentation: {OUT_MASK}")
     print(f"Saved overlay: {OUT_OVERLAY}")
 
 if __name__ == "__main__":
-    main()
+    with stage_profile(__file__, globals()):
+        main()
@@ -0,0 +1,61 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from utils import seed_everything
+from image_store import open_image
+from table_store import write_table
+from spatial_graph import region_adjacency, neighbourhood_features
+from perf import stage_profile, section, note
+
+# Spatial-graph stage (runs after 02, before 04): region adjacency graph of the segmentation
+# plus per-cell neighbourhood features, which 04 adds to the cell table as a third view.
+# Cell types are not known at this point of the pipeline, so the neighbour-type composition
+# is only computed when a typing is supplied (--types, e.g. the cluster assignments of an
+# earlier run).
+
+IN_SEG = os.path.join("data", "processed", "seg_mask.chunks")
+
+OUT_SPATIAL = os.path.join("data", "processed", "spatial_features.cols")
+OUT_RAG = os.path.join("data", "processed", "region_adjacency.cols")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Region adjacency graph and spatial neighbourhood features.")
+    p.add_argument("--radius", type=float, default=40.0, help="neighbourhood radius in pixels")
+    p.add_argument("--k", type=int, default=6, help="neighbours for the mean k-NN distance")
+    p.add_argument("--chunk-rows", type=int, default=4096, help="label rows read per band")
+    p.add_argument("--types", default=None,
+                   help="CSV with seg_id and a type column, for neighbour-type composition")
+    p.add_argument("--type-column", default="cluster")
+    return p.parse_args()
+
+def load_types(path, column, n_labels):
+    # dense label -> type code lookup, -1 for labels without a type
+    df = pd.read_csv(path, usecols=["seg_id", column])
+    types = np.full(n_labels, -1, dtype=np.int64)
+    ok = df["seg_id"].to_numpy() < n_labels
+    types[df["seg_id"].to_numpy()[ok]] = df[column].to_numpy()[ok].astype(np.int64)
+    return types
+
+def main():
+    args = parse_args()
+    seed_everything(42)
+    seg = open_image(IN_SEG)
+
+    with section("rag"):
+        edges, stats = region_adjacency(seg, chunk_rows=args.chunk_rows)
+    types = load_types(args.types, args.type_column, len(stats["area"])) if args.types else None
+    feats = neighbourhood_features(edges, stats, radius=args.radius, k=args.k, types=types)
+
+    write_table(edges, OUT_RAG)
+    write_table(feats, OUT_SPATIAL)
+    note("n_cells", int(len(feats)))
+    note("n_edges", int(len(edges)))
+
+    print(f"Region adjacency graph: {len(feats):,} cells, {len(edges):,} contacts "
+          f"(mean degree {feats['sp_n_contacts'].mean():.2f})")
+    print(f"Saved: {OUT_SPATIAL}, {OUT_RAG}")
+
+if __name__ == "__main__":
+    with stage_profile(__file__, globals()):
+        main()
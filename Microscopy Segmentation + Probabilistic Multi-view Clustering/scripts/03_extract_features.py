@@ -1,65 +1,89 @@
 import os
+import argparse
 import numpy as np
 import pandas as pd
-from skimage.measure import regionprops_table
 from utils import seed_everything
+from overlap import overlap_matrix, majority_mapping
+from features import morphology_table
+from texture import texture_table
+from image_store import open_image
+from table_store import SCHEMA, write_table, csv_to_table, build_index, lookup_rows, append_columns, export_csv
+from perf import stage_profile, section
 
-IN_IMG = os.path.join("data", "raw", "microscopy_image.npy")
-IN_GT  = os.path.join("data", "raw", "gt_mask.npy")
-IN_SEG = os.path.join("data", "processed", "seg_mask.npy")
+IN_IMG = os.path.join("data", "raw", "microscopy_image.chunks")
+IN_GT  = os.path.join("data", "raw", "gt_mask.chunks")
+IN_SEG = os.path.join("data", "processed", "seg_mask.chunks")
 IN_BV  = os.path.join("data", "raw", "barcode_view.csv")
 
-OUT_MORPH = os.path.join("data", "processed", "morph_features.csv")
-OUT_MAPPED = os.path.join("data", "processed", "mapped_cells.csv")
+OUT_MORPH = os.path.join("data", "processed", "morph_features.cols")
+OUT_MAPPED = os.path.join("data", "processed", "mapped_cells.cols")
+# barcode view as a columnar table with a cell_id offset index, rebuilt when the CSV changes
+OUT_BV_STORE = os.path.join("data", "processed", "barcode_view.cols")
 
-def majority_gt_label(seg_region_pixels, gt):
-    vals = gt[seg_region_pixels]
-    vals = vals[vals > 0]
-    if len(vals) == 0:
-        return 0
-    return int(pd.Series(vals).value_counts().index[0])
+# optional CSV exports
+CSV_MORPH = os.path.join("data", "processed", "morph_features.csv")
+CSV_MAPPED = os.path.join("data", "processed", "mapped_cells.csv")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Extract morphology features and map regions to GT cells.")
+    p.add_argument("--csv", action="store_true", help="also export the tables as CSV")
+    p.add_argument("--texture", action="store_true",
+                   help="add GLCM texture, intensity quantiles and radial profiles to View 1")
+    p.add_argument("--workers", type=int, default=None, help="processes for the texture features")
+    p.add_argument("--chunk-regions", type=int, default=2048, help="regions per texture work item")
+    p.add_argument("--join-chunk-rows", type=int, default=65536,
+                   help="barcode rows gathered per batch in the indexed join")
+    return p.parse_args()
+
+def barcode_store():
+    schema = os.path.join(OUT_BV_STORE, SCHEMA)
+    if not os.path.exists(schema) or os.path.getmtime(schema) < os.path.getmtime(IN_BV):
+        csv_to_table(IN_BV, OUT_BV_STORE)
+        build_index(OUT_BV_STORE, "cell_id")
+    return OUT_BV_STORE
 
 def main():
+    args = parse_args()
     seed_everything(42)
-    img = np.load(IN_IMG)
-    gt = np.load(IN_GT)
-    seg = np.load(IN_SEG)
+    # region features need the whole plane; GT is only streamed through the overlap matrix
+    seg_store = open_image(IN_SEG)
+    plane = seg_store.attrs.get("plane", {})
+    seg = np.asarray(seg_store)
+    img = np.asarray(open_image(IN_IMG, plane))
+    gt = open_image(IN_GT, plane)
 
-    props = regionprops_table(
-        seg,
-        intensity_image=img,
-        properties=[
-            "label",
-            "area",
-            "eccentricity",
-            "perimeter",
-            "solidity",
-            "mean_intensity",
-            "max_intensity",
-        ],
-    )
-    morph = pd.DataFrame(props).rename(columns={"label":"seg_id"})
-    morph.to_csv(OUT_MORPH, index=False)
+    morph = morphology_table(seg, img)
+    if args.texture:
+        morph = morph.merge(texture_table(seg, img, workers=args.workers, chunk_regions=args.chunk_regions),
+                            on="seg_id", how="left")
+    write_table(morph, OUT_MORPH)
 
     # Map each seg region to GT cell_id via majority overlap
-    # Build a pixel-index list per region by iterating over seg_id masks
-    mapped = []
-    for seg_id in morph["seg_id"].tolist():
-        mask = seg == seg_id
-        gt_id = int(pd.Series(gt[mask][gt[mask] > 0]).value_counts().index[0]) if np.any(gt[mask] > 0) else 0
-        mapped.append({"seg_id": seg_id, "gt_cell_id": gt_id})
-
-    map_df = pd.DataFrame(mapped)
-
-    bv = pd.read_csv(IN_BV)
-    out = morph.merge(map_df, on="seg_id", how="left").merge(bv, left_on="gt_cell_id", right_on="cell_id", how="left")
+    # (one pass over paired labels builds the sparse seg x GT overlap matrix)
+    with section("gt_mapping"):
+        best = majority_mapping(overlap_matrix(seg, gt))
+    seg_ids = morph["seg_id"].to_numpy()
+    map_df = pd.DataFrame({"seg_id": seg_ids, "gt_cell_id": best[seg_ids].astype(int)})
 
     # drop empty mappings
-    out = out[out["gt_cell_id"] > 0].copy()
-    out.to_csv(OUT_MAPPED, index=False)
+    out = morph.merge(map_df, on="seg_id", how="left")
+    out = out[out["gt_cell_id"] > 0]
+
+    # indexed join: barcode rows of the mapped cells are gathered from the column files in
+    # sorted batches, so the barcode view is never loaded whole
+    with section("barcode_join"):
+        store = barcode_store()
+        write_table(out, OUT_MAPPED)
+        append_columns(OUT_MAPPED, store, lookup_rows(store, "cell_id", out["gt_cell_id"].to_numpy()),
+                       chunk_rows=args.join_chunk_rows)
 
     print(f"Saved morphology: {OUT_MORPH}")
     print(f"Saved mapped table: {OUT_MAPPED} ({len(out):,} segmented regions mapped to GT cells)")
+    if args.csv:
+        morph.to_csv(CSV_MORPH, index=False)
+        export_csv(OUT_MAPPED, CSV_MAPPED)
+        print(f"Exported CSV: {CSV_MORPH}, {CSV_MAPPED}")
 
 if __name__ == "__main__":
-    main()
+    with stage_profile(__file__, globals()):
+        main()
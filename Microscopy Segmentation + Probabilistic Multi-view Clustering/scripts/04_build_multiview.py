@@ -1,27 +1,51 @@
 import os
-import pandas as pd
+import argparse
 from utils import seed_everything
+from table_store import table_columns, read_table, write_table
+from perf import stage_profile
 
-IN_MAPPED = os.path.join("data", "processed", "mapped_cells.csv")
-OUT_CELL_TABLE = os.path.join("reports", "cell_table.csv")
+IN_MAPPED = os.path.join("data", "processed", "mapped_cells.cols")
+IN_SPATIAL = os.path.join("data", "processed", "spatial_features.cols")
+OUT_CELL_TABLE = os.path.join("reports", "cell_table.cols")
+
+# optional CSV export
+CSV_CELL_TABLE = os.path.join("reports", "cell_table.csv")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Assemble the multi-view cell table.")
+    p.add_argument("--csv", action="store_true", help="also export the table as CSV")
+    return p.parse_args()
 
 def main():
+    args = parse_args()
     seed_everything(42)
-    df = pd.read_csv(IN_MAPPED)
+    cols = table_columns(IN_MAPPED)
 
     # View 1: morphology/intensity features
     morph_cols = ["area","eccentricity","perimeter","solidity","mean_intensity","max_intensity"]
+    # optional texture/intensity features from 03 --texture
+    morph_cols += [c for c in cols if c.startswith(("tex_","int_","rad_"))]
     # View 2: barcodes/projections
-    view2_cols = [c for c in df.columns if c.startswith("bar_") or c.startswith("prj_")]
+    view2_cols = [c for c in cols if c.startswith("bar_") or c.startswith("prj_")]
 
     keep = ["seg_id","gt_cell_id","true_type"] + morph_cols + view2_cols
-    out = df[keep].copy()
+    out = read_table(IN_MAPPED, columns=keep)
+
+    # View 3: spatial neighbourhood features from 02b, keyed by seg_id
+    spatial = read_table(IN_SPATIAL)
+    view3_cols = [c for c in spatial.columns if c.startswith("sp_")]
+    out = out.merge(spatial[["seg_id"] + view3_cols], on="seg_id", how="left")
 
-    os.makedirs(os.path.dirname(OUT_CELL_TABLE), exist_ok=True)
-    out.to_csv(OUT_CELL_TABLE, index=False)
+    # record the view structure so 05 can fit one covariance block per view
+    views = {"morphology": morph_cols, "barcode": view2_cols, "spatial": view3_cols}
+    write_table(out, OUT_CELL_TABLE, meta={"views": views})
 
     print(f"Saved multi-view dataset: {OUT_CELL_TABLE} ({out.shape[0]:,} x {out.shape[1]:,})")
-    print(f"View1 cols: {len(morph_cols)} | View2 cols: {len(view2_cols)}")
+    print(f"View1 cols: {len(morph_cols)} | View2 cols: {len(view2_cols)} | View3 cols: {len(view3_cols)}")
+    if args.csv:
+        out.to_csv(CSV_CELL_TABLE, index=False)
+        print(f"Exported CSV: {CSV_CELL_TABLE}")
 
 if __name__ == "__main__":
-    main()
+    with stage_profile(__file__, globals()):
+        main()
@@ -1,5 +1,6 @@
 import os
 import json
+import argparse
 import numpy as np
 import pandas as pd
 from sklearn.mixture import GaussianMixture
@@ -8,39 +9,199 @@ from sklearn.pipeline import Pipeline
 from sklearn.metrics import adjusted_rand_score, confusion_matrix
 
 from utils import seed_everything
+from table_store import table_columns, table_rows, table_meta, read_arrays, read_matrix, iter_chunks
+from streaming_gmm import StreamingScaler, StreamingGMM
+from multiview_gmm import MultiViewGMM
+from gmm_sweep import run_sweep
+from stability import run_stability
+from cluster_model import ClusterModel, temper_probs
+from perf import stage_profile, section, note
 
-IN_CELL = os.path.join("reports", "cell_table.csv")
+IN_CELL = os.path.join("reports", "cell_table.cols")
 OUT_ASSIGN = os.path.join("reports", "cluster_assignments.csv")
 OUT_SUM = os.path.join("reports", "cluster_summary.csv")
 OUT_METRICS = os.path.join("reports", "metrics.json")
+OUT_SWEEP = os.path.join("reports", "gmm_sweep.csv")
+OUT_STAB_CELLS = os.path.join("reports", "stability_cells.csv")
+OUT_STAB_CLUSTERS = os.path.join("reports", "stability_clusters.csv")
+OUT_STAB_RUNS = os.path.join("reports", "stability_runs.csv")
+OUT_MODEL = os.path.join("reports", "cluster_model.npz")
 
-def temper_probs(probs: np.ndarray, temperature: float = 2.0) -> np.ndarray:
-    # Temperature-smooth responsibilities to avoid overconfident posteriors.
-    # This is a practical calibration-style trick for demo settings.
-    p = np.clip(probs, 1e-12, 1.0)
-    p = p ** (1.0 / temperature)
-    p = p / (p.sum(axis=1, keepdims=True) + 1e-12)
-    return p
+N_COMPONENTS = 4
+REG_COVAR = 5e-2
 
-def main():
-    seed_everything(42)
-    df = pd.read_csv(IN_CELL)
+# metrics sections written only by some modes; a run drops the ones it did not produce
+MODE_METRICS = ["model_selection", "stability", "view_factorized_model"]
 
-    y_true = df["true_type"].astype(int).values
-    feature_cols = [c for c in df.columns if c not in ["seg_id","gt_cell_id","true_type"]]
-    X = df[feature_cols].values
+def parse_args():
+    p = argparse.ArgumentParser(description="Probabilistic multi-view clustering (GMM) of the cell table.")
+    p.add_argument("--streaming", action="store_true",
+                   help="fit from chunks with a streaming scaler and online EM instead of loading the table")
+    p.add_argument("--chunk-rows", type=int, default=65536)
+    p.add_argument("--epochs", type=int, default=2, help="passes over the table for online EM")
+    p.add_argument("--sweep", action="store_true",
+                   help="model selection over the grid below; the best-BIC model produces the outputs")
+    p.add_argument("--components", default="2,3,4,5,6,8")
+    p.add_argument("--covariance-types", default="full,tied,diag,spherical")
+    p.add_argument("--reg-covars", default="1e-1,5e-2,1e-2,1e-3")
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--view-factorized", action="store_true",
+                   help="one covariance block per view (views recorded by 04); cells missing a view are kept")
+    p.add_argument("--stability", action="store_true",
+                   help="refit on bootstrap/subsample resamples and report clustering stability")
+    p.add_argument("--n-resamples", type=int, default=200)
+    p.add_argument("--resample", choices=["bootstrap", "subsample"], default="bootstrap")
+    p.add_argument("--subsample-fraction", type=float, default=0.8)
+    args = p.parse_args()
+    if args.stability and (args.streaming or args.view_factorized):
+        p.error("--stability refits the in-memory GMM; combine it with the default fit or --sweep")
+    if sum([args.streaming, args.sweep, args.view_factorized]) > 1:
+        p.error("--streaming, --sweep and --view-factorized are separate fit modes; pick one")
+    return args
 
+def fit_predict_in_memory(feature_cols):
+    X = read_matrix(IN_CELL, feature_cols)
     model = Pipeline([
         ("scaler", StandardScaler()),
-        ("gmm", GaussianMixture(n_components=4, covariance_type="full", reg_covar=5e-2, random_state=42))
+        ("gmm", GaussianMixture(n_components=N_COMPONENTS, covariance_type="full", reg_covar=REG_COVAR, random_state=42))
     ])
-    model.fit(X)
+    with section("em_fit"):
+        model.fit(X)
+    note("em_iterations", int(model.named_steps["gmm"].n_iter_))
+
+    scaler, gmm = model.named_steps["scaler"], model.named_steps["gmm"]
+    saved = ClusterModel.from_gmm(feature_cols, scaler.mean_, scaler.scale_, gmm)
+    return gmm.predict_proba(scaler.transform(X)), saved
+
+def fit_predict_sweep(feature_cols, y_true, args):
+    scaler = StandardScaler()
+    Xs = scaler.fit_transform(read_matrix(IN_CELL, feature_cols))
+    with section("sweep"):
+        table, best = run_sweep(
+            Xs, y_true,
+            components=[int(v) for v in args.components.split(",")],
+            covariance_types=args.covariance_types.split(","),
+            reg_covars=[float(v) for v in args.reg_covars.split(",")],
+            workers=args.workers,
+        )
+    table.to_csv(OUT_SWEEP, index=False)
+    print(table.head(10).to_string(index=False, float_format=lambda v: f"{v:.4g}"))
+    print(f"Saved sweep table: {OUT_SWEEP} ({len(table)} fits)")
+    selection = {
+        "criterion": "bic",
+        "n_candidates": int(len(table)),
+        "n_components": int(best.n_components),
+        "covariance_type": best.covariance_type,
+        "reg_covar": float(best.reg_covar),
+        "bic": float(table["bic"].iloc[0]),
+    }
+    saved = ClusterModel.from_gmm(feature_cols, scaler.mean_, scaler.scale_, best)
+    return best.predict_proba(Xs), selection, saved
+
+def fit_predict_view_factorized(feature_cols):
+    views = table_meta(IN_CELL).get("views")
+    if not views:
+        raise ValueError(f"{IN_CELL} has no view structure; re-run 04_build_multiview.py")
+    # columns of a missing view are NaN; StandardScaler ignores NaN when fitting and keeps it
+    scaler = StandardScaler()
+    X = scaler.fit_transform(read_matrix(IN_CELL, feature_cols))
+    idx = {c: j for j, c in enumerate(feature_cols)}
+    names = [v for v in views if views[v]]
+    model = MultiViewGMM([[idx[c] for c in views[v]] for v in names],
+                         n_components=N_COMPONENTS, reg_covar=REG_COVAR, random_state=42)
+    with section("em_fit"):
+        model.fit(X)
+    note("em_iterations", int(model.n_iter_))
+    observed = model.observed_views(X)
+    info = {
+        "views": {v: len(views[v]) for v in names},
+        "cells_missing_view": {v: int((~observed[:, i]).sum()) for i, v in enumerate(names)},
+        "n_iter": int(model.n_iter_),
+        "converged": bool(model.converged_),
+        "bic": float(model.bic(X)),
+    }
+    saved = ClusterModel.from_multiview(feature_cols, scaler.mean_, scaler.scale_, model, names)
+    return model.predict_proba(X), info, saved
+
+def stability_analysis(feature_cols, out, y_true, n_components, selection, args):
+    # refits use the model that produced the reference labels (the best-BIC one after --sweep)
+    Xs = StandardScaler().fit_transform(read_matrix(IN_CELL, feature_cols))
+    with section("stability"):
+        cells, clusters, runs = run_stability(
+            Xs, out["cluster"].to_numpy(), y_true, n_components,
+            n_resamples=args.n_resamples, mode=args.resample, fraction=args.subsample_fraction,
+            covariance_type=selection["covariance_type"] if selection else "full",
+            reg_covar=selection["reg_covar"] if selection else REG_COVAR,
+            workers=args.workers,
+        )
+    cells.insert(0, "seg_id", out["seg_id"].to_numpy())
+    cells.insert(1, "cluster", out["cluster"].to_numpy())
+    cells.to_csv(OUT_STAB_CELLS, index=False)
+    clusters.to_csv(OUT_STAB_CLUSTERS, index=False)
+    runs.to_csv(OUT_STAB_RUNS, index=False)
+    print(clusters.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+    print(f"Saved stability tables: {OUT_STAB_CELLS}, {OUT_STAB_CLUSTERS}, {OUT_STAB_RUNS}")
+
+    ari = runs["ari_vs_reference"]
+    return {
+        "resample": args.resample,
+        "n_resamples": int(len(runs)),
+        "mean_co_assignment": float(cells["co_assignment"].mean()),
+        "cluster_jaccard_mean": [float(v) for v in clusters["jaccard_mean"]],
+        "ari_vs_reference": {
+            "mean": float(ari.mean()),
+            "p05": float(ari.quantile(0.05)),
+            "p50": float(ari.quantile(0.50)),
+            "p95": float(ari.quantile(0.95)),
+        },
+        "ari_vs_true_type_mean": float(runs["ari_vs_true_type"].mean()),
+    }
+
+def fit_predict_streaming(feature_cols, chunk_rows, epochs):
+    # pass 1: scaler statistics; then online EM epochs (first in table order, later ones in
+    # shuffled chunk order); last pass scores every chunk
+    scaler = StreamingScaler()
+    for _, block in iter_chunks(IN_CELL, feature_cols, chunk_rows):
+        scaler.partial_fit(block)
+
+    gmm = StreamingGMM(n_components=N_COMPONENTS, reg_covar=REG_COVAR, random_state=42)
+    rng = np.random.default_rng(42)
+    with section("em_fit"):
+        for epoch in range(epochs):
+            for _, block in iter_chunks(IN_CELL, feature_cols, chunk_rows, rng=rng if epoch else None):
+                gmm.partial_fit(scaler.transform(block))
+    note("em_iterations", int(gmm.n_batches_))
+
+    probs = np.empty((table_rows(IN_CELL), N_COMPONENTS))
+    for i, block in iter_chunks(IN_CELL, feature_cols, chunk_rows):
+        probs[i:i + len(block)] = gmm.predict_proba(scaler.transform(block))
+    return probs, ClusterModel.from_gmm(feature_cols, scaler.mean_, scaler.scale_, gmm)
+
+def main():
+    args = parse_args()
+    seed_everything(42)
+    id_cols = ["seg_id","gt_cell_id","true_type"]
+    df = pd.DataFrame(read_arrays(IN_CELL, id_cols, mmap=False))
+
+    y_true = df["true_type"].astype(int).values
+    feature_cols = [c for c in table_columns(IN_CELL) if c not in id_cols]
 
-    Xs = model.named_steps["scaler"].transform(X)
-    probs_raw = model.named_steps["gmm"].predict_proba(Xs)
+    selection = None
+    view_model = None
+    if args.streaming:
+        probs_raw, saved = fit_predict_streaming(feature_cols, args.chunk_rows, args.epochs)
+    elif args.sweep:
+        probs_raw, selection, saved = fit_predict_sweep(feature_cols, y_true, args)
+    elif args.view_factorized:
+        probs_raw, view_model, saved = fit_predict_view_factorized(feature_cols)
+    else:
+        probs_raw, saved = fit_predict_in_memory(feature_cols)
 
     temperature = 10.0
     probs = temper_probs(probs_raw, temperature=temperature)
+    # everything score_cells.py needs to label new cells the same way
+    saved.temperature = temperature
+    saved.save(OUT_MODEL)
 
     y_pred = probs.argmax(axis=1)
     maxp = probs.max(axis=1)
@@ -73,10 +234,18 @@ def main():
         },
         "confusion_matrix": cm.tolist(),
     }
+    if selection is not None:
+        metrics["model_selection"] = selection
+    if args.stability:
+        metrics["stability"] = stability_analysis(feature_cols, out, y_true, probs.shape[1], selection, args)
+    if view_model is not None:
+        metrics["view_factorized_model"] = view_model
 
     if os.path.exists(OUT_METRICS):
         with open(OUT_METRICS, "r") as f:
             existing = json.load(f)
+        for key in MODE_METRICS:
+            existing.pop(key, None)
         existing.update(metrics)
         metrics = existing
 
@@ -85,8 +254,10 @@ def main():
 
     print(f"Saved assignments: {OUT_ASSIGN}")
     print(f"Saved summary: {OUT_SUM}")
+    print(f"Saved cluster model: {OUT_MODEL}")
     print(f"Updated metrics: {OUT_METRICS}")
     print(json.dumps(metrics, indent=2))
 
 if __name__ == "__main__":
-    main()
+    with stage_profile(__file__, globals()):
+        main()
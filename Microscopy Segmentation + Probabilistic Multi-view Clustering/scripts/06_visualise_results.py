@@ -1,34 +1,122 @@
 import os
 import json
+import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.patches import Patch
+from skimage.segmentation import find_boundaries
 from sklearn.decomposition import PCA
 from sklearn.metrics import confusion_matrix
 
 from utils import seed_everything, normalize01
-
-IN_IMG = os.path.join("data", "raw", "microscopy_image.npy")
-IN_GT  = os.path.join("data", "raw", "gt_mask.npy")
-IN_SEG = os.path.join("data", "processed", "seg_mask.npy")
-
-IN_CELL = os.path.join("reports", "cell_table.csv")
+from overlap import overlap_matrix, binary_dice_iou, instance_matching
+from table_store import table_columns, table_rows, read_arrays, read_table, iter_chunks
+from streaming_gmm import StreamingScaler
+from render import density_raster, image_pyramid, label_level
+from image_store import open_image, preview
+from perf import stage_profile, section
+
+IN_IMG = os.path.join("data", "raw", "microscopy_image.chunks")
+IN_GT  = os.path.join("data", "raw", "gt_mask.chunks")
+IN_SEG = os.path.join("data", "processed", "seg_mask.chunks")
+
+IN_CELL = os.path.join("reports", "cell_table.cols")
 IN_ASSIGN = os.path.join("reports", "cluster_assignments.csv")
 METRICS_PATH = os.path.join("reports", "metrics.json")
 
 FIG_PCA = os.path.join("figures", "pca_clusters.png")
 FIG_CM  = os.path.join("figures", "confusion_matrix.png")
 FIG_TYPE = os.path.join("figures", "true_type_pca.png")
+FIG_OVERLAY = os.path.join("figures", "segmentation_vs_gt_overlay.png")
+
+FEATURE_PREFIXES = ("area","eccentricity","perimeter","solidity","mean_intensity","max_intensity",
+                    "tex_","int_","rad_","bar_","prj_","sp_")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Figures and segmentation metrics.")
+    p.add_argument("--large", action="store_true",
+                   help="large-data rendering: density rasters, sampled randomized PCA, pyramid overlay")
+    p.add_argument("--pca-sample", type=int, default=200_000, help="rows used to fit PCA in --large mode")
+    p.add_argument("--bins", type=int, default=512, help="raster resolution of the density plots")
+    p.add_argument("--chunk-rows", type=int, default=65536)
+    return p.parse_args()
+
+def plot_scatter(Z, labels, prefix, title, out_path):
+    plt.figure(figsize=(6,5))
+    for c in sorted(np.unique(labels)):
+        m = labels == c
+        plt.scatter(Z[m,0], Z[m,1], s=18, alpha=0.8, label=f"{prefix}{c}")
+    plt.title(title)
+    plt.xlabel("PC1")
+    plt.ylabel("PC2")
+    plt.legend(ncol=2, fontsize=9)
+    plt.tight_layout()
+    plt.savefig(out_path, dpi=200)
+    plt.close()
+
+def plot_density(Z, labels, prefix, title, out_path, bins):
+    # cost depends on the raster size, not on the number of cells
+    rgba, extent, classes, colours = density_raster(Z, labels, bins=bins)
+    plt.figure(figsize=(6,5))
+    plt.imshow(rgba, origin="lower", extent=extent, aspect="auto", interpolation="nearest")
+    plt.title(title)
+    plt.xlabel("PC1")
+    plt.ylabel("PC2")
+    plt.legend(handles=[Patch(color=col, label=f"{prefix}{c}") for c, col in zip(classes, colours)],
+               ncol=2, fontsize=9)
+    plt.tight_layout()
+    plt.savefig(out_path, dpi=200)
+    plt.close()
 
-def dice_iou_binary(a, b):
-    a = (a > 0).astype(np.uint8)
-    b = (b > 0).astype(np.uint8)
-    inter = (a & b).sum()
-    da = a.sum()
-    db = b.sum()
-    dice = (2*inter) / (da + db + 1e-12)
-    iou = inter / ((da + db - inter) + 1e-12)
-    return float(dice), float(iou)
+def pca_in_memory(df, feature_cols):
+    X = df[feature_cols].values.astype(float)
+    X = (X - X.mean(axis=0)) / (X.std(axis=0) + 1e-12)
+
+    pca = PCA(n_components=2, random_state=42)
+    return pca.fit_transform(X), pca.explained_variance_ratio_
+
+def pca_sampled(feature_cols, sample, chunk_rows):
+    # streamed standardisation, randomized PCA fitted on a row sample, then chunked projection
+    scaler = StreamingScaler()
+    for _, block in iter_chunks(IN_CELL, feature_cols, chunk_rows):
+        scaler.partial_fit(block)
+
+    n = table_rows(IN_CELL)
+    idx = np.sort(np.random.default_rng(42).choice(n, size=min(sample, n), replace=False))
+    arrs = read_arrays(IN_CELL, feature_cols)
+    Xs = scaler.transform(np.column_stack([arrs[c][idx] for c in feature_cols]))
+    pca = PCA(n_components=2, svd_solver="randomized", random_state=42).fit(Xs)
+
+    Z = np.empty((n, 2), dtype=np.float32)
+    for i, block in iter_chunks(IN_CELL, feature_cols, chunk_rows):
+        Z[i:i + len(block)] = pca.transform(scaler.transform(block))
+    return Z, pca.explained_variance_ratio_
+
+def save_pyramid_overlay(img, seg, gt, out_path, figsize=6, dpi=200):
+    # draw from the first pyramid level that fits the saved figure's pixel size; labels are
+    # sampled at the same level and boundaries are burnt into one RGB raster. Image stores
+    # already hold the levels, so only the chosen level is read
+    if hasattr(img, "n_levels"):
+        img_s, factor = preview(img, figsize * dpi)
+        seg_s = preview(seg, figsize * dpi)[0][:img_s.shape[0], :img_s.shape[1]]
+        gt_s = preview(gt, figsize * dpi)[0][:img_s.shape[0], :img_s.shape[1]]
+    else:
+        levels = image_pyramid(img, max_side=figsize * dpi)
+        img_s, factor = levels[-1], 2 ** (len(levels) - 1)
+        seg_s = label_level(seg, len(levels) - 1, img_s.shape)
+        gt_s = label_level(gt, len(levels) - 1, img_s.shape)
+    img_s = normalize01(np.asarray(img_s), dtype=np.float32)
+    rgb = np.repeat(img_s[..., None], 3, axis=2)
+    rgb[find_boundaries(gt_s, mode="outer")] = (0.0, 0.6, 1.0)
+    rgb[find_boundaries(seg_s, mode="outer")] = (1.0, 0.2, 0.0)
+    plt.figure(figsize=(figsize,figsize))
+    plt.imshow(rgb, interpolation="nearest")
+    plt.title(f"Segmentation (red) vs GT (blue), 1:{factor}")
+    plt.axis("off")
+    plt.tight_layout()
+    plt.savefig(out_path, dpi=dpi)
+    plt.close()
 
 def plot_confusion(cm, out_path, title):
     plt.figure(figsize=(5,4))
@@ -42,57 +130,52 @@ def plot_confusion(cm, out_path, title):
     plt.close()
 
 def main():
+    args = parse_args()
     seed_everything(42)
     os.makedirs("figures", exist_ok=True)
 
-    img = np.load(IN_IMG)
-    gt = np.load(IN_GT)
-    seg = np.load(IN_SEG)
-
-    # segmentation quality (binary dice/iou against GT union)
-    dice, iou = dice_iou_binary(seg, gt)
-
-    # load tables
-    cell = pd.read_csv(IN_CELL)
-    assign = pd.read_csv(IN_ASSIGN)
-
-    merged = cell.merge(assign[["seg_id","cluster","cluster_confidence"]], on="seg_id", how="left")
-    y_true = merged["true_type"].astype(int).values
-    y_pred = merged["cluster"].astype(int).values
-
-    # PCA plot (features)
-    feature_cols = [c for c in merged.columns if c.startswith(("area","eccentricity","perimeter","solidity","mean_intensity","max_intensity","bar_","prj_"))]
-    X = merged[feature_cols].values
-    X = (X - X.mean(axis=0)) / (X.std(axis=0) + 1e-12)
-
-    pca = PCA(n_components=2, random_state=42)
-    Z = pca.fit_transform(X)
-
-    # plot predicted clusters
-    plt.figure(figsize=(6,5))
-    for c in sorted(np.unique(y_pred)):
-        m = y_pred == c
-        plt.scatter(Z[m,0], Z[m,1], s=18, alpha=0.8, label=f"C{c}")
-    plt.title("PCA of multi-view features (coloured by predicted cluster)")
-    plt.xlabel("PC1")
-    plt.ylabel("PC2")
-    plt.legend(ncol=2, fontsize=9)
-    plt.tight_layout()
-    plt.savefig(FIG_PCA, dpi=200)
-    plt.close()
-
-    # plot true types
-    plt.figure(figsize=(6,5))
-    for t in sorted(np.unique(y_true)):
-        m = y_true == t
-        plt.scatter(Z[m,0], Z[m,1], s=18, alpha=0.8, label=f"T{t}")
-    plt.title("PCA of multi-view features (coloured by true type)")
-    plt.xlabel("PC1")
-    plt.ylabel("PC2")
-    plt.legend(ncol=2, fontsize=9)
-    plt.tight_layout()
-    plt.savefig(FIG_TYPE, dpi=200)
-    plt.close()
+    # images are read lazily: overlap_matrix streams row chunks and the overlay reads one
+    # stored preview level
+    seg = open_image(IN_SEG)
+    plane = seg.attrs.get("plane", {})
+    gt = open_image(IN_GT, plane)
+
+    # segmentation quality: binary dice/iou against GT union and instance matching,
+    # both read off one seg x GT overlap matrix
+    with section("segmentation_scoring"):
+        ov = overlap_matrix(seg, gt)
+        dice, iou = binary_dice_iou(ov)
+        instance = instance_matching(ov)
+
+    feature_cols = [c for c in table_columns(IN_CELL) if c.startswith(FEATURE_PREFIXES)]
+    assign = pd.read_csv(IN_ASSIGN, usecols=["seg_id","cluster","cluster_confidence"])
+
+    if args.large:
+        ids = read_arrays(IN_CELL, ["seg_id","true_type"], mmap=False)
+        order = pd.Index(assign["seg_id"]).get_indexer(ids["seg_id"])
+        if (order < 0).any():
+            raise ValueError(f"{(order < 0).sum()} cells in {IN_CELL} have no cluster in {IN_ASSIGN}; re-run 05_multiview_clustering.py")
+        y_true = ids["true_type"].astype(int)
+        y_pred = assign["cluster"].to_numpy()[order].astype(int)
+        with section("pca"):
+            Z, explained = pca_sampled(feature_cols, args.pca_sample, args.chunk_rows)
+        with section("plots"):
+            plot_density(Z, y_pred, "C", "PCA of multi-view features (coloured by predicted cluster)", FIG_PCA, args.bins)
+            plot_density(Z, y_true, "T", "PCA of multi-view features (coloured by true type)", FIG_TYPE, args.bins)
+            save_pyramid_overlay(open_image(IN_IMG, plane), seg, gt, FIG_OVERLAY)
+    else:
+        # load tables (only the columns needed here)
+        cell = read_table(IN_CELL, columns=["seg_id","true_type"] + feature_cols)
+        merged = cell.merge(assign, on="seg_id", how="left")
+        y_true = merged["true_type"].astype(int).values
+        y_pred = merged["cluster"].astype(int).values
+
+        # PCA plot (features)
+        with section("pca"):
+            Z, explained = pca_in_memory(merged, feature_cols)
+        with section("plots"):
+            plot_scatter(Z, y_pred, "C", "PCA of multi-view features (coloured by predicted cluster)", FIG_PCA)
+            plot_scatter(Z, y_true, "T", "PCA of multi-view features (coloured by true type)", FIG_TYPE)
 
     # confusion matrix
     cm = confusion_matrix(y_true, y_pred)
@@ -107,15 +190,17 @@ def main():
     metrics.update({
         "segmentation_binary_dice": dice,
         "segmentation_binary_iou": iou,
-        "pca_explained_variance_ratio": [float(v) for v in pca.explained_variance_ratio_],
+        "segmentation_instance": instance,
+        "pca_explained_variance_ratio": [float(v) for v in explained],
     })
 
     with open(METRICS_PATH, "w") as f:
         json.dump(metrics, f, indent=2)
 
-    print(f"Saved: {FIG_PCA}, {FIG_TYPE}, {FIG_CM}")
+    print(f"Saved: {FIG_PCA}, {FIG_TYPE}, {FIG_CM}" + (f", {FIG_OVERLAY}" if args.large else ""))
     print(f"Updated metrics: {METRICS_PATH}")
     print(json.dumps(metrics, indent=2))
 
 if __name__ == "__main__":
-    main()
+    with stage_profile(__file__, globals()):
+        main()
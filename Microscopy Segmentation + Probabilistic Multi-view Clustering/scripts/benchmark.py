@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import platform
+import subprocess
+import numpy as np
+from perf import PERF_METRICS, write_record
+
+# Scale benchmark for the microscopy stages. For every scale factor s the synthetic generator
+# is run at (256*s) x (256*s) pixels with 180*s^2 cells (constant density) in its own work
+# directory, then every stage runs as a separate process so wall time, CPU time and peak RSS
+# are measured per stage (os.wait4). Two sections inside 03 are also run on their own:
+# regionprops features and the seg -> GT mapping. Scaling exponents use the time measured
+# inside each process (the perf.py stage record), because interpreter start-up and imports
+# cost about a second per process and would flatten the curve at small scales. A stage is
+# flagged super-linear when that time grows faster than the cell count between the two
+# largest scales. Named hot sections recorded by the stages themselves are copied into each run.
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+OUT_BENCH = os.path.join("reports", "benchmark.json")
+
+BASE_SIDE = 256
+BASE_CELLS = 180
+
+STAGES = [
+    ("generate", "01_generate_synthetic_microscopy.py"),
+    ("segmentation", "02_segment_cells.py"),
+    ("spatial_graph", "02b_spatial_graph.py"),
+    ("features_and_mapping", "03_extract_features.py"),
+    ("regionprops_features", "--section regionprops"),
+    ("gt_mapping", "--section gt_mapping"),
+    ("multiview_table", "04_build_multiview.py"),
+    ("gmm_fit", "05_multiview_clustering.py"),
+    ("visualisation", "06_visualise_results.py"),
+]
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Time and memory-profile every microscopy stage at several scales.")
+    p.add_argument("--scales", default="1,2,4", help="linear scale factors for the image side")
+    p.add_argument("--barcode-dims", default="12", help="barcode dimensions to cross with the scales")
+    p.add_argument("--work-dir", default=os.path.join("data", "bench"))
+    p.add_argument("--stage-args", action="append", default=[], metavar="NN=ARGS",
+                   help='extra arguments for one stage, e.g. --stage-args "02=--tiled"')
+    p.add_argument("--repeat", type=int, default=1, help="runs per stage; the fastest is kept")
+    p.add_argument("--superlinear-tol", type=float, default=0.2,
+                   help="flag stages whose scaling exponent exceeds 1 + tol")
+    p.add_argument("--out", default=OUT_BENCH)
+    p.add_argument("--compare", default=None, help="earlier benchmark.json to compare against")
+    p.add_argument("--section", choices=["regionprops", "gt_mapping"], help=argparse.SUPPRESS)
+    return p.parse_args()
+
+def run_section(name):
+    # runs inside a work directory as its own process, so wait4 sees only this section
+    sys.path.insert(0, SCRIPTS_DIR)
+    from image_store import open_image
+    from features import morphology_table
+    from overlap import overlap_matrix, majority_mapping
+    t0, c0 = time.perf_counter(), time.process_time()
+    seg = open_image(os.path.join("data", "processed", "seg_mask.chunks"))
+    if name == "regionprops":
+        morphology_table(np.asarray(seg), np.asarray(open_image(os.path.join("data", "raw", "microscopy_image.chunks"))))
+    else:
+        majority_mapping(overlap_matrix(seg, open_image(os.path.join("data", "raw", "gt_mask.chunks"))))
+    write_record(record_name("--section " + name),
+                 {"wall_seconds": time.perf_counter() - t0, "cpu_seconds": time.process_time() - c0, "sections": {}})
+
+def measure(cmd, cwd):
+    # (wall seconds, child CPU seconds, child peak RSS in MB)
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL)
+    _, status, ru = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    # ru_maxrss is KB on Linux and bytes on macOS
+    rss = ru.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+    return wall, ru.ru_utime + ru.ru_stime, rss
+
+def stage_cmd(script, scale, barcode_dim, extra):
+    if script.startswith("--"):
+        return [sys.executable, os.path.abspath(__file__)] + script.split()
+    cmd = [sys.executable, os.path.join(SCRIPTS_DIR, script)]
+    if script.startswith("01"):
+        side = BASE_SIDE * scale
+        cmd += ["--height", str(side), "--width", str(side),
+                "--n-cells", str(BASE_CELLS * scale * scale), "--barcode-dim", str(barcode_dim)]
+    return cmd + extra.get(script.split("_")[0], [])
+
+def scaling_table(runs, tol):
+    rows = []
+    for stage, _ in STAGES:
+        for bdim in sorted({r["barcode_dim"] for r in runs}):
+            pts = sorted((r["n_cells"], r["stage_seconds"]) for r in runs if r["stage"] == stage and r["barcode_dim"] == bdim)
+            if len(pts) < 2:
+                continue
+            n, t = np.log([p[0] for p in pts]), np.log([max(p[1], 1e-6) for p in pts])
+            # the fit over all scales is damped by fixed per-stage overhead; the slope between
+            # the two largest scales is what decides the flag
+            top = float((t[-1] - t[-2]) / (n[-1] - n[-2]))
+            rows.append({
+                "stage": stage,
+                "barcode_dim": bdim,
+                "exponent_fit": float(np.polyfit(n, t, 1)[0]),
+                "exponent_top": top,
+                "super_linear": bool(top > 1 + tol),
+            })
+    return rows
+
+def record_name(script):
+    return "section_" + script.split()[-1] if script.startswith("--") else os.path.splitext(script)[0]
+
+def stage_record(cwd, script):
+    # the perf.py record the process just wrote: time from main() on, without start-up and imports
+    path = os.path.join(cwd, PERF_METRICS)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        perf = json.load(f).get("performance", {})
+    return perf.get(record_name(script), {})
+
+def run_stage(cmd, cwd, script):
+    wall, cpu, rss = measure(cmd, cwd)
+    return wall, cpu, rss, stage_record(cwd, script)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPTS_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(runs, path):
+    with open(path, "r") as f:
+        old = json.load(f)
+    # older files have process wall time only
+    prev = {(r["stage"], r["scale"], r["barcode_dim"]): r.get("stage_seconds", r["seconds"]) for r in old["runs"]}
+    print(f"\nvs {path} (commit {old.get('commit')}):")
+    for r in runs:
+        key = (r["stage"], r["scale"], r["barcode_dim"])
+        if key in prev:
+            print(f"  {r['stage']:<22} x{r['scale']:<3} bd={r['barcode_dim']:<4} "
+                  f"{prev[key]:8.2f}s -> {r['stage_seconds']:8.2f}s ({r['stage_seconds'] / max(prev[key], 1e-9):5.2f}x)")
+
+def main():
+    args = parse_args()
+    if args.section:
+        run_section(args.section)
+        return
+
+    extra = {}
+    for item in args.stage_args:
+        num, _, rest = item.partition("=")
+        extra[num.strip().split("_")[0]] = shlex.split(rest)
+    scales = [int(s) for s in args.scales.split(",")]
+    bdims = [int(b) for b in args.barcode_dims.split(",")]
+
+    runs = []
+    for bdim in bdims:
+        for scale in scales:
+            cwd = os.path.join(args.work_dir, f"x{scale}_bd{bdim}")
+            os.makedirs(cwd, exist_ok=True)
+            side = BASE_SIDE * scale
+            for stage, script in STAGES:
+                cmd = stage_cmd(script, scale, bdim, extra)
+                best = min((run_stage(cmd, cwd, script) for _ in range(args.repeat)),
+                           key=lambda m: m[3].get("wall_seconds", m[0]))
+                rec = best[3]
+                runs.append({
+                    "stage": stage, "scale": scale, "height": side, "width": side,
+                    "n_cells": BASE_CELLS * scale * scale, "barcode_dim": bdim,
+                    "seconds": best[0], "stage_seconds": rec.get("wall_seconds", best[0]),
+                    "cpu_seconds": best[1], "peak_rss_mb": best[2],
+                    "sections": rec.get("sections", {}),
+                })
+                print(f"x{scale:<3} bd={bdim:<4} {stage:<22} {best[0]:8.2f}s process {runs[-1]['stage_seconds']:8.2f}s stage "
+                      f"{best[1]:8.2f}s cpu {best[2]:9.1f} MB", flush=True)
+
+    scaling = scaling_table(runs, args.superlinear_tol)
+    result = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "stage_args": extra,
+        "runs": runs,
+        "scaling": scaling,
+    }
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print()
+    for s in scaling:
+        flag = "  SUPER-LINEAR" if s["super_linear"] else ""
+        print(f"{s['stage']:<22} bd={s['barcode_dim']:<4} exponent fit {s['exponent_fit']:5.2f} | top {s['exponent_top']:5.2f}{flag}")
+    print(f"Saved benchmark: {args.out}")
+    if args.compare:
+        compare(runs, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import json
+import numpy as np
+import pandas as pd
+from scipy.special import logsumexp
+
+# Persisted cluster model for scoring new cells without refitting.
+# A model is the feature column order, the standardisation (mean/scale), the mixture weights
+# and one or more covariance blocks, plus the posterior temperature used by 05. A block is
+# a set of feature columns with per-component means and precision Cholesky factors, so the
+# full-covariance GMMs (one block over every column) and the view-factorized model (one
+# block per view) share one scoring path. A block whose columns are all NaN for a cell is
+# left out of that cell's likelihood, as in multiview_gmm.
+
+def temper_probs(probs: np.ndarray, temperature: float = 2.0) -> np.ndarray:
+    # Temperature-smooth responsibilities to avoid overconfident posteriors.
+    # This is a practical calibration-style trick for demo settings.
+    p = np.clip(probs, 1e-12, 1.0)
+    p = p ** (1.0 / temperature)
+    p = p / (p.sum(axis=1, keepdims=True) + 1e-12)
+    return p
+
+def full_precisions_cholesky(gmm):
+    # sklearn GaussianMixture precision factors of any covariance_type as (K, d, d)
+    k, d = gmm.means_.shape
+    pc = gmm.precisions_cholesky_
+    if gmm.covariance_type == "full":
+        return pc
+    if gmm.covariance_type == "tied":
+        return np.broadcast_to(pc, (k, d, d)).copy()
+    if gmm.covariance_type == "diag":
+        return pc[:, :, None] * np.eye(d)[None]
+    return pc[:, None, None] * np.eye(d)[None]
+
+class ClusterModel:
+    def __init__(self, feature_cols, mean, scale, weights, blocks, temperature=1.0, block_names=None):
+        # blocks: list of (column indices, means (K, d_b), precision Cholesky factors (K, d_b, d_b))
+        self.feature_cols = list(feature_cols)
+        self.mean = np.asarray(mean, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.blocks = [(np.asarray(c, dtype=int), np.asarray(m, dtype=float), np.asarray(p, dtype=float))
+                       for c, m, p in blocks]
+        self.temperature = float(temperature)
+        self.block_names = list(block_names) if block_names is not None else [f"block_{i}" for i in range(len(blocks))]
+
+    @property
+    def n_components(self):
+        return len(self.weights)
+
+    @classmethod
+    def from_gmm(cls, feature_cols, mean, scale, gmm, temperature=1.0):
+        # any model with weights_, means_ and full (or sklearn-style) precisions_cholesky_
+        pc = full_precisions_cholesky(gmm) if hasattr(gmm, "covariance_type") else gmm.precisions_cholesky_
+        return cls(feature_cols, mean, scale, gmm.weights_, [(np.arange(len(feature_cols)), gmm.means_, pc)],
+                   temperature, block_names=["all"])
+
+    @classmethod
+    def from_multiview(cls, feature_cols, mean, scale, model, view_names, temperature=1.0):
+        blocks = list(zip(model.views, model.means_, model.precisions_cholesky_))
+        return cls(feature_cols, mean, scale, model.weights_, blocks, temperature, block_names=view_names)
+
+    def save(self, path):
+        meta = {
+            "feature_cols": self.feature_cols,
+            "temperature": self.temperature,
+            "block_names": self.block_names,
+        }
+        arrays = {"mean": self.mean, "scale": self.scale, "weights": self.weights}
+        for i, (cols, means, pc) in enumerate(self.blocks):
+            arrays[f"b{i}_cols"], arrays[f"b{i}_means"], arrays[f"b{i}_prec_chol"] = cols, means, pc
+        np.savez(path, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            meta = json.loads(str(z["meta"]))
+            blocks = [(z[f"b{i}_cols"], z[f"b{i}_means"], z[f"b{i}_prec_chol"]) for i in range(len(meta["block_names"]))]
+            return cls(meta["feature_cols"], z["mean"], z["scale"], z["weights"], blocks,
+                       meta["temperature"], meta["block_names"])
+
+    def _matrix(self, X):
+        # DataFrames are reordered by name; arrays must already follow feature_cols
+        if isinstance(X, pd.DataFrame):
+            missing = [c for c in self.feature_cols if c not in X.columns]
+            if missing:
+                raise KeyError(f"input lacks model feature columns {missing}")
+            X = X[self.feature_cols].to_numpy()
+        X = np.asarray(X, dtype=float)
+        if X.ndim != 2 or X.shape[1] != len(self.feature_cols):
+            raise ValueError(f"expected (n, {len(self.feature_cols)}) features, got {X.shape}")
+        return (X - self.mean) / self.scale
+
+    def log_prob(self, X):
+        # (n, K) weighted log-likelihoods, vectorised over cells and components
+        Xs = self._matrix(X)
+        lp = np.tile(np.log(self.weights), (len(Xs), 1))
+        for (cols, means, pc), name in zip(self.blocks, self.block_names):
+            Xb = Xs[:, cols]
+            nan = np.isnan(Xb)
+            observed = ~nan.all(axis=1)
+            if (nan.any(axis=1) & observed).any():
+                raise ValueError(f"cells with some but not all {name} features missing")
+            Xb = np.where(observed[:, None], Xb, 0.0)
+            y = np.einsum("nd,kde->nke", Xb, pc) - np.einsum("kd,kde->ke", means, pc)[None]
+            logdet = np.log(np.diagonal(pc, axis1=1, axis2=2)).sum(axis=1)
+            ll = -0.5 * (len(cols) * np.log(2 * np.pi) + (y ** 2).sum(axis=2)) + logdet[None]
+            lp += observed[:, None] * ll
+        return lp
+
+    def predict_proba(self, X, tempered=True):
+        lp = self.log_prob(X)
+        probs = np.exp(lp - logsumexp(lp, axis=1, keepdims=True))
+        return temper_probs(probs, self.temperature) if tempered else probs
+
+    def predict(self, X):
+        # (cluster, tempered confidence) per cell
+        probs = self.predict_proba(X)
+        return probs.argmax(axis=1), probs.max(axis=1)
@@ -0,0 +1,19 @@
+import pandas as pd
+from skimage.measure import regionprops_table
+from perf import section
+
+# View 1: morphology/intensity properties per segmented region
+MORPH_PROPERTIES = [
+    "label",
+    "area",
+    "eccentricity",
+    "perimeter",
+    "solidity",
+    "mean_intensity",
+    "max_intensity",
+]
+
+def morphology_table(seg, img):
+    with section("regionprops"):
+        props = regionprops_table(seg, intensity_image=img, properties=MORPH_PROPERTIES)
+    return pd.DataFrame(props).rename(columns={"label":"seg_id"})
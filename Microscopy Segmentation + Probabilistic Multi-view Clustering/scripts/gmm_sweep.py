@@ -0,0 +1,75 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.mixture import GaussianMixture
+from sklearn.metrics import adjusted_rand_score
+from threadpoolctl import threadpool_limits
+from shared_array import to_shared, attach, release
+
+# Parallel GMM model selection over (n_components, covariance_type, reg_covar).
+# Each worker task is one (covariance_type, n_components) chain that walks reg_covar from
+# the largest value down, warm-starting every fit from the previous (neighbouring) solution.
+# The scaled matrix and labels live in shared memory, so workers never copy them.
+
+_SHARED = {}
+
+def _init_worker(x_spec, y_spec):
+    # one BLAS thread per worker; the pool provides the parallelism
+    _SHARED["limits"] = threadpool_limits(1)
+    _SHARED["x_shm"], _SHARED["X"] = attach(x_spec)
+    _SHARED["y_shm"], _SHARED["y"] = attach(y_spec)
+
+def fit_chain(covariance_type, n_components, reg_covars, random_state=42):
+    X, y = _SHARED["X"], _SHARED["y"]
+    rows, models = [], []
+    prev = None
+    for reg in sorted(reg_covars, reverse=True):
+        init = {} if prev is None else {
+            "weights_init": prev.weights_,
+            "means_init": prev.means_,
+            "precisions_init": prev.precisions_,
+        }
+        t0 = time.perf_counter()
+        gm = GaussianMixture(n_components=n_components, covariance_type=covariance_type,
+                             reg_covar=reg, random_state=random_state, **init)
+        gm.fit(X)
+        rows.append({
+            "n_components": n_components,
+            "covariance_type": covariance_type,
+            "reg_covar": reg,
+            "bic": gm.bic(X),
+            "aic": gm.aic(X),
+            "ari_vs_true_type": adjusted_rand_score(y, gm.predict(X)) if len(y) else float("nan"),
+            "mean_log_likelihood": gm.score(X),
+            "n_iter": gm.n_iter_,
+            "converged": bool(gm.converged_),
+            "warm_started": prev is not None,
+            "seconds": time.perf_counter() - t0,
+        })
+        models.append(gm)
+        prev = gm
+    return rows, models
+
+def run_sweep(Xs, y_true, components, covariance_types, reg_covars, workers=None):
+    # returns the results table (sorted by BIC) and the best-BIC fitted model
+    x_shm, x_spec = to_shared(np.asarray(Xs, dtype=float))
+    y_shm, y_spec = to_shared(np.asarray(y_true, dtype=np.int64))
+    tasks = [(ct, k) for ct in covariance_types for k in components]
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                                 initargs=(x_spec, y_spec)) as ex:
+            futures = [ex.submit(fit_chain, ct, k, reg_covars) for ct, k in tasks]
+            results = [f.result() for f in futures]
+    finally:
+        release(x_shm)
+        release(y_shm)
+
+    rows = [r for chain_rows, _ in results for r in chain_rows]
+    models = [m for _, chain_models in results for m in chain_models]
+    table = pd.DataFrame(rows)
+    best = int(table["bic"].idxmin())
+    table["best_bic"] = False
+    table.loc[best, "best_bic"] = True
+    return table.sort_values("bic").reset_index(drop=True), models[best]
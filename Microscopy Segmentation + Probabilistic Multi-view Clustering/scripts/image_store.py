@@ -0,0 +1,285 @@
+import os
+import json
+import zlib
+import shutil
+import itertools
+import numpy as np
+
+# Chunked, compressed array store for images and label masks (the image counterpart of
+# table_store). A store is a directory holding array.json plus one zlib-compressed file per
+# chunk and resolution level (<level>/<i>.<j>...). Chunks are byte-shuffled before
+# compression, which helps float images a lot and costs little. Reads decompress only the
+# chunks a region touches, so a tile, a crop or a preview never loads the whole image.
+# Arrays may carry leading z and channel axes ("axes" is e.g. "yx", "zyx", "czyx"); the
+# last two axes are always y, x, are chunked in CHUNK_SIDE squares and are the only ones
+# that get downsampled. Level k halves y and x k times: block means for images (trailing
+# odd rows/columns dropped, as render.block_mean), nearest sampling for integer labels.
+# Chunks never written read back as zeros.
+
+META = "array.json"
+CHUNK_SIDE = 512
+PREVIEW_SIDE = 1024
+COMPRESSION = 1
+
+class ChunkedArray:
+    def __init__(self, path, level=0):
+        self.path = path
+        with open(os.path.join(path, META), "r") as f:
+            self.meta = json.load(f)
+        self.level_index = level
+        self.shape = tuple(self.meta["levels"][level])
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.chunks = tuple(self.meta["chunks"])
+        self.axes = self.meta["axes"]
+        self.attrs = self.meta.get("attrs", {})
+
+    @classmethod
+    def create(cls, path, shape, dtype, axes=None, chunk_side=CHUNK_SIDE, attrs=None):
+        shape = tuple(int(s) for s in shape)
+        axes = axes or "czyx"[-len(shape):]
+        if len(axes) != len(shape) or not axes.endswith("yx"):
+            raise ValueError(f"axes {axes!r} do not fit shape {shape}; the last two must be 'yx'")
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(os.path.join(path, "0"))
+        meta = {
+            "shape": list(shape),
+            "dtype": np.dtype(dtype).str,
+            "axes": axes,
+            "chunks": [1] * (len(shape) - 2) + [chunk_side, chunk_side],
+            "compression": COMPRESSION,
+            "levels": [list(shape)],
+            "attrs": attrs or {},
+        }
+        with open(os.path.join(path, META), "w") as f:
+            json.dump(meta, f, indent=2)
+        return cls(path)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def n_levels(self):
+        return len(self.meta["levels"])
+
+    def level(self, k):
+        return ChunkedArray(self.path, level=k)
+
+    def set_attrs(self, **attrs):
+        self.meta.setdefault("attrs", {}).update(attrs)
+        self.attrs = self.meta["attrs"]
+        self._save_meta()
+
+    def _save_meta(self):
+        with open(os.path.join(self.path, META), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    # chunk I/O
+
+    def _chunk_path(self, idx):
+        return os.path.join(self.path, str(self.level_index), ".".join(map(str, idx)))
+
+    def _chunk_shape(self, idx):
+        return tuple(min(c, s - i * c) for i, c, s in zip(idx, self.chunks, self.shape))
+
+    def _read_chunk(self, idx):
+        p = self._chunk_path(idx)
+        shape = self._chunk_shape(idx)
+        if not os.path.exists(p):
+            return np.zeros(shape, dtype=self.dtype)
+        with open(p, "rb") as f:
+            raw = np.frombuffer(zlib.decompress(f.read()), dtype=np.uint8)
+        # undo the byte shuffle: stored as (itemsize, n) byte planes
+        raw = raw.reshape(self.dtype.itemsize, -1).T.copy()
+        return raw.view(self.dtype).reshape(shape)
+
+    def _write_chunk(self, idx, a):
+        planes = np.ascontiguousarray(a, dtype=self.dtype).view(np.uint8).reshape(-1, self.dtype.itemsize).T
+        with open(self._chunk_path(idx), "wb") as f:
+            f.write(zlib.compress(np.ascontiguousarray(planes).tobytes(), self.meta["compression"]))
+
+    # region access
+
+    def _region(self, key):
+        # per-axis (start, stop, step) plus the axes indexed by an integer (dropped on read)
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) != self.ndim:
+            raise IndexError(f"too many indices for a {self.ndim}-d store")
+        bounds, drop = [], []
+        for ax, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step < 1:
+                    raise IndexError("store regions only support positive steps")
+                bounds.append((start, max(start, stop), step))
+            else:
+                k = int(k)
+                k = k + n if k < 0 else k
+                if not 0 <= k < n:
+                    raise IndexError(f"index {k} out of range for axis {ax} of size {n}")
+                bounds.append((k, k + 1, 1))
+                drop.append(ax)
+        return bounds, tuple(drop)
+
+    def _touched(self, bounds):
+        ranges = [range(a // c, (b - 1) // c + 1) if b > a else range(0) for (a, b, _), c in zip(bounds, self.chunks)]
+        return itertools.product(*ranges)
+
+    def __getitem__(self, key):
+        bounds, drop = self._region(key)
+        out = np.zeros([b - a for a, b, _ in bounds], dtype=self.dtype)
+        for idx in self._touched(bounds):
+            chunk = self._read_chunk(idx)
+            src, dst = [], []
+            for i, c, (a, b, _) in zip(idx, self.chunks, bounds):
+                lo, hi = max(a, i * c), min(b, i * c + c)
+                src.append(slice(lo - i * c, hi - i * c))
+                dst.append(slice(lo - a, hi - a))
+            out[tuple(dst)] = chunk[tuple(src)]
+        out = out[tuple(slice(None, None, s) for _, _, s in bounds)]
+        return out.reshape([n for ax, n in enumerate(out.shape) if ax not in drop])
+
+    def __setitem__(self, key, value):
+        bounds, _ = self._region(key)
+        if any(s != 1 for _, _, s in bounds):
+            raise IndexError("store writes need contiguous regions")
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), [b - a for a, b, _ in bounds])
+        for idx in self._touched(bounds):
+            cshape = self._chunk_shape(idx)
+            src, dst = [], []
+            for i, c, (a, b, _) in zip(idx, self.chunks, bounds):
+                lo, hi = max(a, i * c), min(b, i * c + c)
+                src.append(slice(lo - a, hi - a))
+                dst.append(slice(lo - i * c, hi - i * c))
+            part = value[tuple(src)]
+            if part.shape == cshape:
+                self._write_chunk(idx, part)
+            else:
+                # partial chunk: read-modify-write
+                chunk = self._read_chunk(idx)
+                chunk[tuple(dst)] = part
+                self._write_chunk(idx, chunk)
+
+    def __array__(self, dtype=None, copy=None):
+        a = self[...]
+        return a if dtype is None else a.astype(dtype, copy=False)
+
+    def max(self, band_rows=4096):
+        # streamed maximum (e.g. the largest label), one band of rows at a time
+        return max(self[..., r:r + band_rows, :].max() for r in range(0, self.shape[-2], band_rows))
+
+    # multi-resolution levels
+
+    def build_levels(self, max_side=PREVIEW_SIDE, band_rows=4096):
+        # add levels 1.. until y and x fit max_side; each level is built from the previous
+        # one in bands of rows, so memory stays at one band whatever the image size
+        base = self.level(0)
+        self.meta["levels"] = [list(base.shape)]
+        src = base
+        is_label = np.issubdtype(self.dtype, np.integer) or self.dtype == bool
+        band = max(2, band_rows // 2 * 2)
+        while max(src.shape[-2:]) > max_side and min(src.shape[-2:]) >= 2:
+            h, w = src.shape[-2:]
+            lead = src.shape[:-2]
+            shape = lead + (((h + 1) // 2, (w + 1) // 2) if is_label else (h // 2, w // 2))
+            k = src.level_index + 1
+            d = os.path.join(self.path, str(k))
+            if os.path.exists(d):
+                shutil.rmtree(d)
+            os.makedirs(d)
+            self.meta["levels"].append(list(shape))
+            self._save_meta()
+            dst = self.level(k)
+            for r in range(0, shape[-2], band // 2):
+                rows = src[..., 2 * r:min(2 * (r + band // 2), h), :]
+                if is_label:
+                    small = rows[..., ::2, ::2]
+                else:
+                    n = rows.shape[-2] // 2
+                    small = rows[..., :2 * n, :2 * (w // 2)].reshape(lead + (n, 2, w // 2, 2)).mean(axis=(-3, -1))
+                dst[..., r:r + small.shape[-2], :] = small
+            src = dst
+        self._save_meta()
+        return self.n_levels
+
+class PlaneView:
+    # lazy 2D (y, x) view of one channel / z-slice of a store, so stages written for 2D
+    # images run unchanged on volumetric or multi-channel data
+    def __init__(self, store, lead):
+        self.store = store
+        self.lead = tuple(lead)
+        self.shape = store.shape[len(self.lead):]
+        self.dtype = store.dtype
+        self.ndim = len(self.shape)
+        self.attrs = store.attrs
+
+    @property
+    def plane(self):
+        return dict(zip(self.store.axes, self.lead))
+
+    @property
+    def n_levels(self):
+        return self.store.n_levels
+
+    def level(self, k):
+        return PlaneView(self.store.level(k), self.lead)
+
+    def __getitem__(self, key):
+        return self.store[self.lead + (key if isinstance(key, tuple) else (key,))]
+
+    def __setitem__(self, key, value):
+        self.store[self.lead + (key if isinstance(key, tuple) else (key,))] = value
+
+    def __array__(self, dtype=None, copy=None):
+        a = self[...]
+        return a if dtype is None else a.astype(dtype, copy=False)
+
+    def max(self, band_rows=4096):
+        return max(self[r:r + band_rows].max() for r in range(0, self.shape[0], band_rows))
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, META))
+
+def open_image(path, plane=None):
+    # lazy 2D view of an image or mask: a store, or a plain .npy file (memory-mapped).
+    # For stores with leading axes, plane picks the index per axis ({"z": 3, "c": 1});
+    # unset axes default to the first channel and the middle z-slice
+    if not is_store(path):
+        return np.load(path, mmap_mode="r")
+    store = ChunkedArray(path)
+    plane = plane or {}
+    lead = []
+    for ax, n in zip(store.axes[:-2], store.shape):
+        k = plane.get(ax)
+        k = (n // 2 if ax == "z" else 0) if k is None else int(k)
+        if not 0 <= k < n:
+            raise IndexError(f"{path}: {ax}={k} out of range (size {n})")
+        lead.append(k)
+    return PlaneView(store, lead) if lead else store
+
+def preview(a, max_side=PREVIEW_SIDE):
+    # (2D array, downsampling factor): the finest stored level whose y, x fit max_side (the
+    # coarsest one if none does); arrays without levels are read strided
+    if hasattr(a, "n_levels"):
+        for k in range(a.n_levels):
+            lv = a.level(k)
+            if max(lv.shape[-2:]) <= max_side or k == a.n_levels - 1:
+                return np.asarray(lv[...]), 2 ** k
+    step = max(1, int(np.ceil(max(a.shape[-2:]) / max_side)))
+    return np.asarray(a[..., ::step, ::step]), step
+
+def write_image(a, path, axes=None, chunk_side=CHUNK_SIDE, attrs=None, levels=True, band_rows=4096):
+    # write an in-memory (or memory-mapped) array in row bands, then build the preview levels
+    store = ChunkedArray.create(path, a.shape, a.dtype, axes=axes, chunk_side=chunk_side, attrs=attrs)
+    step = max(chunk_side, band_rows // chunk_side * chunk_side)
+    for r in range(0, a.shape[-2], step):
+        store[..., r:r + step, :] = np.asarray(a[..., r:r + step, :])
+    if levels:
+        store.build_levels()
+    return store
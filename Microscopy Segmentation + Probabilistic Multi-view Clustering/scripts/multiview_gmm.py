@@ -0,0 +1,134 @@
+import numpy as np
+from scipy.special import logsumexp
+from sklearn.cluster import KMeans
+from perf import section
+
+# Multi-view Gaussian mixture with one full covariance block per view.
+# Views are conditionally independent given the cluster, so
+#   log p(x, z=k) = log w_k + sum over observed views v of log N(x_v | mu_kv, Sigma_kv)
+# Each EM iteration costs sum_v d_v^3 instead of (sum_v d_v)^3 for one full covariance.
+# A view counts as missing for a cell when all of its columns are NaN; missing views are
+# marginalised out (dropped from the sum), never imputed. A view that is only partly NaN is
+# an error, as in ClusterModel.log_prob.
+
+class MultiViewGMM:
+    def __init__(self, views, n_components=4, reg_covar=1e-6, max_iter=200, tol=1e-3, random_state=None):
+        # views: list of column-index lists into X, one per view
+        self.views = [np.asarray(v, dtype=int) for v in views]
+        self.n_components = n_components
+        self.reg_covar = reg_covar
+        self.max_iter = max_iter
+        self.tol = tol
+        self.random_state = random_state
+
+    def _split(self, X):
+        X = np.asarray(X, dtype=float)
+        blocks, observed = [], []
+        for cols in self.views:
+            Xv = X[:, cols]
+            nan = np.isnan(Xv)
+            obs = ~nan.all(axis=1)
+            if (nan.any(axis=1) & obs).any():
+                raise ValueError(f"cells with some but not all columns of view {len(blocks)} missing")
+            blocks.append(np.where(obs[:, None], Xv, 0.0))
+            observed.append(obs)
+        return blocks, np.stack(observed, axis=1)
+
+    def observed_views(self, X):
+        # (n, n_views) boolean mask of the views present for each cell
+        return self._split(X)[1]
+
+    def _view_log_prob(self, Xv, v):
+        # (n, K) log N(x_v | mu_kv, Sigma_kv) for all components at once
+        P = self.precisions_cholesky_[v]
+        mu = self.means_[v]
+        y = np.einsum("nd,kde->nke", Xv, P) - np.einsum("kd,kde->ke", mu, P)[None]
+        d = Xv.shape[1]
+        logdet = np.log(np.diagonal(P, axis1=1, axis2=2)).sum(axis=1)
+        return -0.5 * (d * np.log(2 * np.pi) + (y**2).sum(axis=2)) + logdet[None]
+
+    def _weighted_log_prob(self, blocks, observed):
+        lp = np.tile(np.log(self.weights_), (blocks[0].shape[0], 1))
+        for v, Xv in enumerate(blocks):
+            lp += observed[:, v:v + 1] * self._view_log_prob(Xv, v)
+        return lp
+
+    def _m_step(self, blocks, observed, resp):
+        nk = resp.sum(axis=0) + 10 * np.finfo(float).eps
+        self.weights_ = nk / nk.sum()
+        self.means_, self.covariances_, self.precisions_cholesky_ = [], [], []
+        for v, Xv in enumerate(blocks):
+            r = resp * observed[:, v:v + 1]
+            nv = r.sum(axis=0) + 10 * np.finfo(float).eps
+            mu = r.T @ Xv / nv[:, None]
+            diff = Xv[:, None, :] - mu[None]
+            cov = np.einsum("nk,nki,nkj->kij", r, diff, diff, optimize=True) / nv[:, None, None]
+            cov += self.reg_covar * np.eye(Xv.shape[1])[None]
+            chol = np.linalg.cholesky(cov)
+            eye = np.broadcast_to(np.eye(Xv.shape[1]), cov.shape)
+            self.means_.append(mu)
+            self.covariances_.append(cov)
+            self.precisions_cholesky_.append(np.linalg.solve(chol, eye).transpose(0, 2, 1))
+
+    def _init_resp(self, blocks, observed):
+        complete = observed.all(axis=1)
+        Xc = np.concatenate(blocks, axis=1)[complete]
+        if len(Xc) < self.n_components:
+            raise ValueError("need at least n_components cells with every view observed to initialise")
+        km = KMeans(n_clusters=self.n_components, n_init=1, random_state=self.random_state).fit(Xc)
+        labels = km.predict(np.concatenate(blocks, axis=1)) if complete.all() else None
+        resp = np.zeros((blocks[0].shape[0], self.n_components))
+        if labels is None:
+            # cells missing a view start from the k-means centres of the views they do have
+            d = 0
+            dist = np.zeros_like(resp)
+            for v, Xv in enumerate(blocks):
+                c = km.cluster_centers_[:, d:d + Xv.shape[1]]
+                dist += observed[:, v:v + 1] * ((Xv[:, None, :] - c[None]) ** 2).sum(axis=2)
+                d += Xv.shape[1]
+            labels = dist.argmin(axis=1)
+        resp[np.arange(len(labels)), labels] = 1.0
+        return resp
+
+    def fit(self, X):
+        blocks, observed = self._split(X)
+        resp = self._init_resp(blocks, observed)
+        self._m_step(blocks, observed, resp)
+        prev = -np.inf
+        self.converged_ = False
+        for it in range(1, self.max_iter + 1):
+            with section("em_e_step"):
+                lp = self._weighted_log_prob(blocks, observed)
+                norm = logsumexp(lp, axis=1, keepdims=True)
+                ll = float(norm.mean())
+            with section("em_m_step"):
+                self._m_step(blocks, observed, np.exp(lp - norm))
+            self.n_iter_ = it
+            if abs(ll - prev) < self.tol:
+                self.converged_ = True
+                break
+            prev = ll
+        self.lower_bound_ = ll
+        return self
+
+    def predict_proba(self, X):
+        lp = self._weighted_log_prob(*self._split(X))
+        return np.exp(lp - logsumexp(lp, axis=1, keepdims=True))
+
+    def predict(self, X):
+        return self.predict_proba(X).argmax(axis=1)
+
+    def score_samples(self, X):
+        return logsumexp(self._weighted_log_prob(*self._split(X)), axis=1)
+
+    def score(self, X):
+        return float(self.score_samples(X).mean())
+
+    def _n_parameters(self):
+        k = self.n_components
+        per_view = sum(k * (len(c) + len(c) * (len(c) + 1) / 2) for c in self.views)
+        return int(per_view + k - 1)
+
+    def bic(self, X):
+        n = np.asarray(X).shape[0]
+        return -2 * self.score(X) * n + self._n_parameters() * np.log(n)
@@ -0,0 +1,76 @@
+import numpy as np
+from scipy import sparse
+
+# IoU thresholds for instance matching; all > 0.5 so matches are one-to-one
+IOU_THRESHOLDS = (0.5, 0.75, 0.9)
+
+# dense bincount is used while (n_seg+1)*(n_gt+1) stays below this many cells
+MAX_DENSE_PAIRS = 1 << 24
+
+def overlap_matrix(seg, gt, chunk_rows=4096):
+    # Sparse seg x GT contingency table in one pass over paired labels.
+    # Entry [i, j] is the number of pixels with seg == i and gt == j; row/column 0 is background.
+    # Works on memory maps and image stores: rows are read in blocks of `chunk_rows`.
+    n_seg = int(seg.max()) + 1
+    n_gt = int(gt.max()) + 1
+    dense = n_seg * n_gt <= MAX_DENSE_PAIRS
+    counts = np.zeros(n_seg * n_gt, dtype=np.int64) if dense else None
+    ov = sparse.csr_matrix((n_seg, n_gt), dtype=np.int64)
+    for r0 in range(0, seg.shape[0], chunk_rows):
+        s = np.asarray(seg[r0:r0 + chunk_rows]).ravel().astype(np.int64)
+        g = np.asarray(gt[r0:r0 + chunk_rows]).ravel().astype(np.int64)
+        codes = s * n_gt + g
+        if dense:
+            counts += np.bincount(codes, minlength=n_seg * n_gt)
+        else:
+            u, c = np.unique(codes, return_counts=True)
+            ov = ov + sparse.csr_matrix((c, (u // n_gt, u % n_gt)), shape=(n_seg, n_gt))
+    if dense:
+        nz = np.flatnonzero(counts)
+        ov = sparse.csr_matrix((counts[nz], (nz // n_gt, nz % n_gt)), shape=(n_seg, n_gt))
+    return ov
+
+def majority_mapping(ov):
+    # GT id with the largest overlap for every seg id (0 when a region only touches background)
+    fg = ov[:, 1:].tocsr()
+    best = np.asarray(fg.argmax(axis=1)).ravel() + 1
+    best[np.asarray(fg.max(axis=1).todense()).ravel() == 0] = 0
+    return best
+
+def iou_matrix(ov):
+    # Sparse per-pair IoU between foreground seg regions (rows) and GT cells (columns)
+    area_seg = np.asarray(ov.sum(axis=1)).ravel()
+    area_gt = np.asarray(ov.sum(axis=0)).ravel()
+    inter = ov.tocoo()
+    keep = (inter.row > 0) & (inter.col > 0)
+    r, c, v = inter.row[keep], inter.col[keep], inter.data[keep].astype(float)
+    iou = v / (area_seg[r] + area_gt[c] - v)
+    return sparse.csr_matrix((iou, (r, c)), shape=ov.shape)
+
+def binary_dice_iou(ov):
+    # foreground-union Dice/IoU, identical to comparing (seg > 0) with (gt > 0)
+    inter = ov[1:, 1:].sum()
+    da = ov[1:, :].sum()
+    db = ov[:, 1:].sum()
+    dice = (2*inter) / (da + db + 1e-12)
+    iou = inter / ((da + db - inter) + 1e-12)
+    return float(dice), float(iou)
+
+def instance_matching(ov, thresholds=IOU_THRESHOLDS):
+    # Precision/recall/F1 of seg regions vs GT cells at each IoU threshold.
+    # With IoU > 0.5 every region can match at most one cell, so counting pairs is exact.
+    if min(thresholds) < 0.5:
+        raise ValueError("instance matching needs IoU thresholds >= 0.5")
+    n_seg = int((np.asarray(ov[1:, :].sum(axis=1)).ravel() > 0).sum())
+    n_gt = int((np.asarray(ov[:, 1:].sum(axis=0)).ravel() > 0).sum())
+    iou = iou_matrix(ov).data
+    out = {}
+    for t in thresholds:
+        tp = int((iou > t).sum())
+        out[f"iou_{t:.2f}"] = {
+            "tp": tp,
+            "precision": tp / n_seg if n_seg else 0.0,
+            "recall": tp / n_gt if n_gt else 0.0,
+            "f1": 2*tp / (n_seg + n_gt) if (n_seg + n_gt) else 0.0,
+        }
+    return {"n_seg_regions": n_seg, "n_gt_cells": n_gt, "thresholds": out}
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import time
+import resource
+import cProfile
+from contextlib import contextmanager
+
+# Stage instrumentation. Wrapping a stage's main() in stage_profile() records wall/CPU time,
+# peak RSS, the sizes of the files it declares (IN_* inputs; OUT_*/FIG_*/METRICS_PATH
+# outputs) and the time spent in named sections, then merges the record into the
+# "performance" section of reports/metrics.json under the stage name. Library code marks hot
+# sections with `with section("name"):`, which costs nothing when no stage is being profiled.
+# Set PERF_PROFILE_DIR to also dump a cProfile file per stage (<dir>/<stage>.prof).
+
+PERF_METRICS = os.path.join("reports", "metrics.json")
+PROFILE_ENV = "PERF_PROFILE_DIR"
+
+_ACTIVE = None
+
+def declared_paths(namespace):
+    # (inputs, outputs) from a stage module's IN_* / OUT_*, FIG_*, METRICS_PATH constants
+    consts = {k: v for k, v in namespace.items() if isinstance(v, str) and k.isupper()}
+    inputs = sorted({v for k, v in consts.items() if k.startswith("IN_")})
+    outputs = sorted({v for k, v in consts.items() if k.startswith(("OUT_", "FIG_")) or k == "METRICS_PATH"})
+    return inputs, outputs
+
+def path_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path) if os.path.exists(path) else None
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+@contextmanager
+def section(name):
+    if _ACTIVE is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        s = _ACTIVE["sections"].setdefault(name, {"seconds": 0.0, "calls": 0})
+        s["seconds"] += time.perf_counter() - t0
+        s["calls"] += 1
+
+def note(name, value):
+    # attach a scalar (e.g. EM iteration count) to the running stage's record
+    if _ACTIVE is not None:
+        _ACTIVE["notes"][name] = value
+
+@contextmanager
+def stage_profile(script_path, namespace):
+    global _ACTIVE
+    stage = os.path.splitext(os.path.basename(script_path))[0]
+    inputs, outputs = declared_paths(namespace)
+    _ACTIVE = {"sections": {}, "notes": {}}
+    prof_dir = os.environ.get(PROFILE_ENV)
+    prof = cProfile.Profile() if prof_dir else None
+
+    t0, c0 = time.perf_counter(), time.process_time()
+    if prof is not None:
+        prof.enable()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        if prof is not None:
+            prof.disable()
+        record = {
+            "wall_seconds": time.perf_counter() - t0,
+            "cpu_seconds": time.process_time() - c0,
+            "peak_rss_mb": peak_rss_mb(),
+            "input_bytes": {p: path_bytes(p) for p in inputs},
+            "output_bytes": {p: path_bytes(p) for p in outputs if p != PERF_METRICS},
+            "sections": _ACTIVE["sections"],
+            **_ACTIVE["notes"],
+        }
+        _ACTIVE = None
+        if prof is not None:
+            os.makedirs(prof_dir, exist_ok=True)
+            prof.dump_stats(os.path.join(prof_dir, f"{stage}.prof"))
+        if not failed:
+            write_record(stage, record)
+
+def write_record(stage, record):
+    metrics = {}
+    if os.path.exists(PERF_METRICS):
+        with open(PERF_METRICS, "r") as f:
+            metrics = json.load(f)
+    metrics.setdefault("performance", {})[stage] = record
+    os.makedirs(os.path.dirname(PERF_METRICS), exist_ok=True)
+    with open(PERF_METRICS, "w") as f:
+        json.dump(metrics, f, indent=2)
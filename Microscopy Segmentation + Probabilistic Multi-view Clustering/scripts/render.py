@@ -0,0 +1,51 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+# Large-data rendering helpers for 06: per-label 2D histogram rasters instead of per-point
+# scatter, and a block-mean image pyramid so overlays are drawn from a level that already
+# fits the figure instead of the full-resolution image.
+
+PREVIEW_MAX = 2048
+
+def density_raster(Z, labels, bins=512, extent=None, cmap="tab10"):
+    # (bins, bins, 4) RGBA raster: colour is the count-weighted mix of the labels falling in
+    # each pixel, opacity grows with log density; returns (rgba, extent, classes, colours)
+    classes, codes = np.unique(labels, return_inverse=True)
+    if extent is None:
+        extent = (float(Z[:, 0].min()), float(Z[:, 0].max()), float(Z[:, 1].min()), float(Z[:, 1].max()))
+    x0, x1, y0, y1 = extent
+    bx = np.clip(((Z[:, 0] - x0) / (x1 - x0 + 1e-12) * bins).astype(np.int64), 0, bins - 1)
+    by = np.clip(((Z[:, 1] - y0) / (y1 - y0 + 1e-12) * bins).astype(np.int64), 0, bins - 1)
+    counts = np.bincount((codes * bins + by) * bins + bx, minlength=len(classes) * bins * bins)
+    counts = counts.reshape(len(classes), bins, bins).astype(float)
+
+    colours = plt.get_cmap(cmap)(np.arange(len(classes)) % 10)[:, :3]
+    total = counts.sum(axis=0)
+    rgba = np.zeros((bins, bins, 4))
+    rgba[..., :3] = np.einsum("kyx,kc->yxc", counts, colours) / np.maximum(total, 1)[..., None]
+    rgba[..., 3] = np.log1p(total) / np.log1p(max(total.max(), 1))
+    return rgba, extent, classes, colours
+
+def block_mean(a, f, chunk_rows=2048):
+    # f x f block means of a 2D (possibly memory-mapped) array, read in row chunks;
+    # trailing rows/columns that do not fill a block are dropped
+    h, w = (a.shape[0] // f) * f, (a.shape[1] // f) * f
+    out = np.empty((h // f, w // f), dtype=np.float32)
+    step = max(f, chunk_rows // f * f)
+    for r in range(0, h, step):
+        blk = np.asarray(a[r:min(r + step, h), :w], dtype=np.float32)
+        out[r // f:(r + len(blk)) // f] = blk.reshape(len(blk) // f, f, w // f, f).mean(axis=(1, 3))
+    return out
+
+def image_pyramid(img, max_side=PREVIEW_MAX, chunk_rows=2048):
+    # level 0 is the input; each further level halves the previous one until the
+    # largest side fits max_side
+    levels = [img]
+    while max(levels[-1].shape) > max_side and min(levels[-1].shape) >= 2:
+        levels.append(block_mean(levels[-1], 2, chunk_rows))
+    return levels
+
+def label_level(labels, level, shape):
+    # nearest-neighbour view of a label image at a pyramid level (labels are never averaged)
+    s = 2 ** level
+    return np.asarray(labels[::s, ::s][:shape[0], :shape[1]])
@@ -0,0 +1,178 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shlex
+import hashlib
+import argparse
+import importlib
+import subprocess
+from perf import declared_paths
+
+# Incremental runner for the numbered microscopy stages (01-06, with 02b between 02 and 03).
+# Each stage declares its files through module constants: IN_* are inputs, OUT_*/FIG_* and
+# METRICS_PATH are outputs. A stage is skipped when the hash of its source (plus the local
+# modules it imports), its arguments and the contents of its inputs matches the last
+# successful run and its outputs are still on disk unchanged.
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_PATH = os.path.join("data", ".pipeline_state.json")
+
+CHUNK = 1 << 20
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Run microscopy stages 01-06, skipping stages whose outputs are up to date.")
+    p.add_argument("--stage-args", action="append", default=[], metavar="NN=ARGS",
+                   help='extra arguments for one stage, e.g. --stage-args "02=--tiled --tile-size 1024"')
+    p.add_argument("--force", action="append", default=[], metavar="NN",
+                   help="always re-run this stage (stage number, e.g. 05 or 02b)")
+    p.add_argument("--dry-run", action="store_true", help="only report which stages would run")
+    return p.parse_args()
+
+def discover_stages():
+    stages = []
+    for path in sorted(glob.glob(os.path.join(SCRIPTS_DIR, "[0-9][0-9]*_*.py"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        mod = importlib.import_module(name)
+        inputs, outputs = declared_paths(vars(mod))
+        stages.append({"name": name, "num": name.split("_")[0], "path": path, "inputs": inputs, "outputs": outputs})
+    return stages
+
+def local_deps(path, seen=None):
+    # the script plus every module from scripts/ it imports, transitively
+    seen = set() if seen is None else seen
+    if path in seen:
+        return seen
+    seen.add(path)
+    with open(path, "r") as f:
+        src = f.read()
+    for mod in re.findall(r"^\s*(?:from|import)\s+([A-Za-z_]\w*)", src, flags=re.M):
+        dep = os.path.join(SCRIPTS_DIR, mod + ".py")
+        if os.path.exists(dep):
+            local_deps(dep, seen)
+    return seen
+
+def file_digest(path, memo):
+    # sha256 of a file, re-used while size and mtime are unchanged
+    st = os.stat(path)
+    sig = [st.st_size, st.st_mtime_ns]
+    hit = memo.get(path)
+    if hit and hit["sig"] == sig:
+        return hit["sha"]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK), b""):
+            h.update(block)
+    memo[path] = {"sig": sig, "sha": h.hexdigest()}
+    return memo[path]["sha"]
+
+def path_digest(path, memo):
+    # files hash their bytes; directories (e.g. columnar tables) hash every file inside
+    if os.path.isdir(path):
+        h = hashlib.sha256()
+        for f in sorted(glob.glob(os.path.join(path, "**", "*"), recursive=True)):
+            if os.path.isfile(f):
+                h.update(os.path.relpath(f, path).encode())
+                h.update(file_digest(f, memo).encode())
+        return h.hexdigest()
+    if os.path.exists(path):
+        return file_digest(path, memo)
+    return None
+
+def stage_key(stage, args, memo):
+    h = hashlib.sha256()
+    for dep in sorted(local_deps(stage["path"])):
+        h.update(os.path.basename(dep).encode())
+        h.update(file_digest(dep, memo).encode())
+    h.update(json.dumps(args).encode())
+    for p in stage["inputs"]:
+        d = path_digest(p, memo)
+        if d is None:
+            raise FileNotFoundError(f"{stage['name']}: missing input {p}")
+        h.update(p.encode())
+        h.update(d.encode())
+    return h.hexdigest()
+
+def load_state():
+    if os.path.exists(STATE_PATH):
+        with open(STATE_PATH, "r") as f:
+            return json.load(f)
+    return {"stages": {}, "files": {}}
+
+def save_state(state):
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    with open(STATE_PATH, "w") as f:
+        json.dump(state, f, indent=2)
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, SCRIPTS_DIR)
+    stages = discover_stages()
+    state = load_state()
+    memo = state["files"]
+
+    extra = {}
+    for item in args.stage_args:
+        num, _, rest = item.partition("=")
+        extra[num.strip().split("_")[0]] = shlex.split(rest)
+    force = {f.split("_")[0] for f in args.force}
+
+    # outputs written by several stages (metrics.json) are merged into, so they only have
+    # to exist; every other output must still hash to what its stage produced
+    writers = {}
+    for s in stages:
+        for o in s["outputs"]:
+            writers[o] = writers.get(o, 0) + 1
+
+    rows = []
+    dirty = set()
+    saved = 0.0
+    t_all = time.perf_counter()
+    for s in stages:
+        stage_args = extra.get(s["num"], [])
+        prev = state["stages"].get(s["name"])
+        # in a dry run, inputs produced by a stage that would run are not on disk yet
+        stale = args.dry_run and (dirty & set(s["inputs"]) or not all(os.path.exists(p) for p in s["inputs"]))
+        key = None if stale else stage_key(s, stage_args, memo)
+
+        fresh = (
+            key is not None and prev is not None and prev["key"] == key and s["num"] not in force
+            and all(
+                os.path.exists(o) if writers[o] > 1 else path_digest(o, memo) == prev["outputs"].get(o)
+                for o in s["outputs"]
+            )
+        )
+        if fresh:
+            saved += prev["seconds"]
+            rows.append((s["name"], "cached", prev["seconds"]))
+            continue
+        dirty.update(s["outputs"])
+        if args.dry_run:
+            rows.append((s["name"], "would run", prev["seconds"] if prev else float("nan")))
+            continue
+
+        cmd = [sys.executable, s["path"]] + stage_args
+        print(f"==> {' '.join(shlex.quote(c) for c in cmd)}", flush=True)
+        t0 = time.perf_counter()
+        subprocess.run(cmd, check=True)
+        dt = time.perf_counter() - t0
+
+        state["stages"][s["name"]] = {
+            "key": key,
+            "seconds": dt,
+            "outputs": {o: path_digest(o, memo) for o in s["outputs"]},
+        }
+        save_state(state)
+        rows.append((s["name"], "ran", dt))
+
+    print()
+    for name, status, sec in rows:
+        print(f"{name:<36} {status:<10} {sec:8.2f}s")
+    print(f"Total {time.perf_counter() - t_all:.2f}s | time saved by cache: {saved:.2f}s")
+    if not args.dry_run:
+        save_state(state)
+
+if __name__ == "__main__":
+    main()
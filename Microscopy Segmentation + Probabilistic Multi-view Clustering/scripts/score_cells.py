@@ -0,0 +1,57 @@
+import os
+import time
+import argparse
+import pandas as pd
+from cluster_model import ClusterModel
+from table_store import table_columns, read_arrays, iter_chunks
+
+# Score new cells with the cluster model saved by 05 (reports/cluster_model.npz).
+# Input is a columnar table (*.cols) or a CSV holding the model's feature columns; it is read
+# in chunks, so scoring memory depends on --chunk-rows, not on the table size. Each chunk gets
+# the cluster and tempered confidence in one vectorised pass. From Python:
+#     model = ClusterModel.load("reports/cluster_model.npz")
+#     cluster, confidence = model.predict(features_df)
+
+IN_MODEL = os.path.join("reports", "cluster_model.npz")
+OUT_SCORES = os.path.join("reports", "scored_cells.csv")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Assign new cells to the saved clusters with tempered confidence.")
+    p.add_argument("input", help="columnar table (*.cols) or CSV with the model's feature columns")
+    p.add_argument("--model", default=IN_MODEL)
+    p.add_argument("--out", default=OUT_SCORES)
+    p.add_argument("--id-cols", default="seg_id", help="comma-separated columns copied to the output when present")
+    p.add_argument("--chunk-rows", type=int, default=65536)
+    return p.parse_args()
+
+def table_batches(path, model, id_cols, chunk_rows):
+    ids = read_arrays(path, [c for c in id_cols if c in table_columns(path)])
+    for i, block in iter_chunks(path, model.feature_cols, chunk_rows):
+        yield pd.DataFrame({c: a[i:i + len(block)] for c, a in ids.items()}), block
+
+def csv_batches(path, model, id_cols, chunk_rows):
+    for chunk in pd.read_csv(path, chunksize=chunk_rows):
+        yield chunk[[c for c in id_cols if c in chunk.columns]].reset_index(drop=True), chunk
+
+def main():
+    args = parse_args()
+    model = ClusterModel.load(args.model)
+    id_cols = [c for c in args.id_cols.split(",") if c]
+    batches = table_batches if os.path.isdir(args.input) else csv_batches
+
+    t0 = time.perf_counter()
+    n = 0
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    for k, (out, X) in enumerate(batches(args.input, model, id_cols, args.chunk_rows)):
+        cluster, conf = model.predict(X)
+        out["cluster"] = cluster
+        out["cluster_confidence"] = conf
+        out.to_csv(args.out, mode="w" if k == 0 else "a", header=k == 0, index=False)
+        n += len(out)
+    secs = time.perf_counter() - t0
+
+    print(f"Scored {n} cells with {model.n_components} clusters in {secs:.2f}s ({n / max(secs, 1e-9):,.0f} cells/s)")
+    print(f"Saved scores: {args.out}")
+
+if __name__ == "__main__":
+    main()
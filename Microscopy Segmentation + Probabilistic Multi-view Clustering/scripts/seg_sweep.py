@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import shutil
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy import ndimage as ndi
+from skimage.filters import threshold_otsu
+from skimage.morphology import remove_small_objects
+from threadpoolctl import threadpool_limits
+from shared_array import to_shared, attach, release
+from segmentation import smooth_image, opened_mask, split_cells, percentile_from_sq_counts
+from overlap import overlap_matrix, binary_dice_iou, instance_matching
+
+# Parallel, cached sweep over the segmentation settings (Gaussian sigma, opening radius,
+# minimum object size, marker percentile). Settings share their upstream products, so
+# they are computed once and kept on disk: the smoothed image and Otsu threshold per
+# sigma, the opened mask per (sigma, radius) and the squared EDT of the cleaned mask per
+# (sigma, radius, min_size); the foreground mask is sq > 0 and the marker threshold is read
+# off a histogram of sq, exactly as np.percentile(dist[bw], q). Phase 1 fills the cache with
+# one task per sigma, phase 2 runs one watershed per setting and scores it against GT with
+# the overlap-matrix metrics used by 06. Re-running with a wider grid reuses the cache; it
+# is cleared when the image changes.
+
+_SHARED = {}
+
+STAMP = "stamp.json"
+
+def _init_worker(img_spec, gt_spec, cache_dir):
+    _SHARED["limits"] = threadpool_limits(1)
+    _SHARED["img_shm"], _SHARED["img"] = attach(img_spec)
+    _SHARED["gt_shm"], _SHARED["gt"] = attach(gt_spec)
+    _SHARED["cache"] = cache_dir
+
+def _path(kind, sigma, open_radius=None, min_size=None):
+    name = f"{kind}_s{sigma:g}"
+    if open_radius is not None:
+        name += f"_r{open_radius}"
+    if min_size is not None:
+        name += f"_m{min_size}"
+    return os.path.join(_SHARED["cache"], name + ".npy")
+
+def _cached(path, compute):
+    if os.path.exists(path):
+        return np.load(path, mmap_mode="r")
+    a = compute()
+    # write then rename, so a partly written file is never picked up
+    tmp = path[:-4] + ".tmp.npy"
+    np.save(tmp, a)
+    os.replace(tmp, path)
+    return a
+
+def prepare_sigma(sigma, open_radii, min_sizes):
+    # phase 1: fill the cache for one sigma; returns how many products were computed
+    done = [os.path.exists(_path("edt", sigma, r, m)) for r in open_radii for m in min_sizes]
+    if all(done):
+        return 0
+    computed = 0
+    smooth = _cached(_path("smooth", sigma), lambda: smooth_image(_SHARED["img"], sigma=sigma))
+    thr = float(_cached(_path("otsu", sigma), lambda: np.array(threshold_otsu(np.asarray(smooth)))))
+    for r in open_radii:
+        opened = None
+        for m in min_sizes:
+            p = _path("edt", sigma, r, m)
+            if os.path.exists(p):
+                continue
+            if opened is None:
+                opened = np.asarray(_cached(_path("open", sigma, r), lambda: opened_mask(np.asarray(smooth), thr, r)))
+            bw = remove_small_objects(opened, min_size=m)
+            _cached(p, lambda: np.rint(ndi.distance_transform_edt(bw) ** 2).astype(np.int32))
+            computed += 1
+    return computed
+
+def labels_for(sigma, open_radius, min_size, marker_percentile):
+    sq = np.asarray(np.load(_path("edt", sigma, open_radius, min_size), mmap_mode="r"))
+    bw = sq > 0
+    if not bw.any():
+        return np.zeros(sq.shape, dtype=np.int32)
+    thr = percentile_from_sq_counts(np.bincount(sq[bw]), marker_percentile)
+    return split_cells(bw, np.sqrt(sq.astype(np.float64)), thr)
+
+def score_setting(sigma, open_radius, min_size, marker_percentile):
+    # phase 2: one watershed + scoring
+    t0 = time.perf_counter()
+    seg = labels_for(sigma, open_radius, min_size, marker_percentile)
+    ov = overlap_matrix(seg, _SHARED["gt"])
+    dice, iou = binary_dice_iou(ov)
+    inst = instance_matching(ov)
+    row = {
+        "sigma": sigma,
+        "open_radius": open_radius,
+        "min_size": min_size,
+        "marker_percentile": marker_percentile,
+        "dice": dice,
+        "iou": iou,
+        "n_seg_regions": inst["n_seg_regions"],
+    }
+    for t, v in inst["thresholds"].items():
+        row[f"f1_{t[4:]}"] = v["f1"]
+    row["seconds"] = time.perf_counter() - t0
+    return row
+
+def open_cache(cache_dir, stamp):
+    # reuse the cache only if it was built from the same image
+    path = os.path.join(cache_dir, STAMP)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            if json.load(f) == stamp:
+                return
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(stamp, f)
+
+def run_seg_sweep(img, gt, sigmas, open_radii, min_sizes, marker_percentiles, cache_dir, stamp,
+                  rank_by="dice", workers=None):
+    # returns (table sorted best first, best setting, its labels, phase timings)
+    open_cache(cache_dir, stamp)
+    img_shm, img_spec = to_shared(np.asarray(img))
+    gt_shm, gt_spec = to_shared(np.asarray(gt))
+    grid = list(itertools.product(sigmas, open_radii, min_sizes, marker_percentiles))
+    timing = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                                 initargs=(img_spec, gt_spec, cache_dir)) as ex:
+            t0 = time.perf_counter()
+            computed = sum(ex.map(prepare_sigma, sigmas, itertools.repeat(open_radii), itertools.repeat(min_sizes)))
+            timing["prepare_seconds"] = time.perf_counter() - t0
+            timing["masks_computed"] = int(computed)
+            timing["masks_cached"] = len(sigmas) * len(open_radii) * len(min_sizes) - int(computed)
+            t0 = time.perf_counter()
+            rows = list(ex.map(score_setting, *zip(*grid)))
+            timing["watershed_seconds"] = time.perf_counter() - t0
+
+        table = pd.DataFrame(rows)
+        key = {"dice": ["dice", "f1_0.50"], "iou": ["iou", "f1_0.50"], "f1": ["f1_0.50", "dice"]}[rank_by]
+        table = table.sort_values(key, ascending=False, kind="stable").reset_index(drop=True)
+        table.insert(0, "rank", np.arange(1, len(table) + 1))
+        best = {k: table[k].iloc[0].item() for k in ["sigma", "open_radius", "min_size", "marker_percentile"]}
+        _SHARED["cache"] = cache_dir
+        seg = labels_for(**best)
+    finally:
+        release(img_shm)
+        release(gt_shm)
+        _SHARED.clear()
+    return table, best, seg, timing
@@ -0,0 +1,203 @@
+import os
+import tempfile
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.filters import threshold_otsu, gaussian
+from skimage.morphology import remove_small_objects, binary_opening, disk
+from skimage.segmentation import watershed
+from skimage.measure import label
+from perf import section
+
+# Baseline segmentation settings (shared by the in-memory and tiled paths)
+SIGMA = 1.0
+OPEN_RADIUS = 2
+MIN_SIZE = 40
+MARKER_PERCENTILE = 75
+
+# Approximate peak working memory of segment_image per image pixel, on top of the input.
+# Low-memory mode keeps every float array in float32, frees intermediates as soon as they
+# are used and emits labels in the smallest integer dtype.
+BYTES_PER_PIXEL = {False: 36, True: 26}
+
+def label_dtype(max_label):
+    # smallest unsigned integer dtype that holds labels 0..max_label
+    return np.min_scalar_type(max(int(max_label), 0))
+
+def working_bytes(shape, low_memory=False):
+    return int(np.prod(shape)) * BYTES_PER_PIXEL[low_memory]
+
+def fit_tile_size(budget_bytes, halo, low_memory=False, max_tile=2048):
+    # largest tile side whose extended tile fits the budget (None if not even a halo-sized one)
+    side = int(np.sqrt(budget_bytes / BYTES_PER_PIXEL[low_memory])) - 2 * halo
+    return min(side, max_tile) if side >= halo else None
+
+def smooth_image(img, dtype=None, sigma=SIGMA):
+    if dtype is not None:
+        img = img.astype(dtype, copy=False)
+    return gaussian(img, sigma=sigma, preserve_range=True)
+
+def opened_mask(smooth, thr, open_radius=OPEN_RADIUS):
+    return binary_opening(smooth > thr, footprint=disk(open_radius))
+
+def foreground_mask(smooth, thr, open_radius=OPEN_RADIUS, min_size=MIN_SIZE):
+    return remove_small_objects(opened_mask(smooth, thr, open_radius), min_size=min_size)
+
+def banded_edt(bw, band_rows=1024, halo=64):
+    # float32 EDT computed in row bands extended by `halo` rows. A distance <= halo is exact
+    # (its nearest background pixel lies inside the extended band); if any pixel is farther
+    # than that from the background, fall back to the whole-image transform.
+    H = bw.shape[0]
+    out = np.empty(bw.shape, dtype=np.float32)
+    for r0 in range(0, H, band_rows):
+        r1 = min(r0 + band_rows, H)
+        e0, e1 = max(r0 - halo, 0), min(r1 + halo, H)
+        out[r0:r1] = ndi.distance_transform_edt(bw[e0:e1])[r0 - e0:r1 - e0]
+    if out.max() > halo:
+        return ndi.distance_transform_edt(bw).astype(np.float32)
+    return out
+
+def split_cells(bw, dist, marker_thr, inplace=False):
+    # local maxima as markers (simple); inplace=True negates `dist` in place
+    markers = label(dist > marker_thr)
+    if inplace:
+        markers = markers.astype(label_dtype(markers.max()) if markers.max() < 2**31 else np.int64)
+        return watershed(np.negative(dist, out=dist), markers, mask=bw)
+    return watershed(-dist, markers, mask=bw)
+
+def segment_image(img, low_memory=False, sigma=SIGMA, open_radius=OPEN_RADIUS, min_size=MIN_SIZE,
+                  marker_percentile=MARKER_PERCENTILE):
+    dtype = np.float32 if low_memory else None
+    with section("otsu"):
+        smooth = smooth_image(img, dtype, sigma)
+        thr = threshold_otsu(smooth)
+    with section("foreground"):
+        bw = foreground_mask(smooth, thr, open_radius, min_size)
+        del smooth
+    with section("edt"):
+        dist = banded_edt(bw) if low_memory else ndi.distance_transform_edt(bw)
+    with section("watershed"):
+        seg = split_cells(bw, dist, np.percentile(dist[bw], marker_percentile), inplace=low_memory)
+    if low_memory:
+        seg = seg.astype(label_dtype(seg.max()), copy=False)
+    return seg
+
+def iter_tiles(shape, tile_size, halo):
+    # yields (extended tile, core within the extended tile, core in image coordinates)
+    H, W = shape
+    for y0 in range(0, H, tile_size):
+        for x0 in range(0, W, tile_size):
+            y1, x1 = min(y0 + tile_size, H), min(x0 + tile_size, W)
+            ey0, ex0 = max(y0 - halo, 0), max(x0 - halo, 0)
+            ey1, ex1 = min(y1 + halo, H), min(x1 + halo, W)
+            ext = (slice(ey0, ey1), slice(ex0, ex1))
+            core = (slice(y0 - ey0, y1 - ey0), slice(x0 - ex0, x1 - ex0))
+            yield ext, core, (slice(y0, y1), slice(x0, x1))
+
+def percentile_from_sq_counts(counts, q):
+    # Same as np.percentile(dist[bw], q) (linear interpolation), where counts[k] is the
+    # number of foreground pixels at squared distance k. EDT distances are sqrt(int),
+    # so an integer histogram of squared distances is exact.
+    cum = np.cumsum(counts)
+    k = (q / 100.0) * (cum[-1] - 1)
+    lo = int(np.floor(k))
+    hi = min(lo + 1, int(cum[-1]) - 1)
+    v_lo = np.sqrt(float(np.searchsorted(cum, lo, side="right")))
+    v_hi = np.sqrt(float(np.searchsorted(cum, hi, side="right")))
+    return v_lo + (k - lo) * (v_hi - v_lo)
+
+def segment_tiled(img, out, tile_size=2048, halo=48, max_otsu_samples=4_000_000, scratch_dir=None,
+                  low_memory=False):
+    # Out-of-core Otsu + watershed. `img` and `out` are memory maps or image stores; peak memory
+    # is a few float64 copies of one (tile_size + 2*halo)^2 tile, independent of image size.
+    # Each watershed cell is owned by the tile whose core contains its bounding-box centre,
+    # so the halo must comfortably exceed the largest cell for seams to be seamless.
+    H, W = img.shape
+    tiles = list(iter_tiles(img.shape, tile_size, halo))
+
+    # pass 1: one global Otsu threshold from a strided sample of the smoothed image
+    stride = max(1, int(np.ceil(np.sqrt(H * W / max_otsu_samples))))
+    samples = []
+    with section("otsu"):
+        for ext, core, _ in tiles:
+            smooth = smooth_image(np.asarray(img[ext]))[core]
+            samples.append(smooth[::stride, ::stride].ravel())
+        thr = threshold_otsu(np.concatenate(samples))
+    del samples
+
+    # pass 2: foreground + EDT per tile; squared distances go to a scratch memmap and a
+    # global histogram gives the exact marker percentile
+    fd, scratch_path = tempfile.mkstemp(suffix=".npy", dir=scratch_dir)
+    os.close(fd)
+    d2 = None
+    try:
+        d2 = np.lib.format.open_memmap(scratch_path, mode="w+", dtype=np.int32, shape=(H, W))
+        counts = np.zeros(1, dtype=np.int64)
+        for ext, core, core_g in tiles:
+            with section("foreground"):
+                bw = foreground_mask(smooth_image(np.asarray(img[ext])), thr)
+            with section("edt"):
+                sq = np.rint(ndi.distance_transform_edt(bw)[core] ** 2).astype(np.int32)
+            d2[core_g] = sq
+            c = np.bincount(sq[sq > 0].ravel())
+            if len(c) > len(counts):
+                counts = np.pad(counts, (0, len(c) - len(counts)))
+            counts[:len(c)] += c
+        if counts.sum() == 0:
+            return {"otsu_threshold": float(thr), "n_labels": 0, "n_tiles": len(tiles), "truncated_objects": 0}
+        marker_thr = percentile_from_sq_counts(counts, MARKER_PERCENTILE)
+
+        # pass 3: watershed per extended tile, keep only the cells this tile owns
+        n_labels = 0
+        truncated = 0
+        for ext, core, _ in tiles:
+            sq = np.asarray(d2[ext])
+            bw = sq > 0
+            dist = np.sqrt(sq.astype(np.float32 if low_memory else np.float64))
+            with section("watershed"):
+                ws = split_cells(bw, dist, marker_thr, inplace=low_memory)
+
+            objs = ndi.find_objects(ws)
+            present = np.array([i for i, sl in enumerate(objs, start=1) if sl is not None], dtype=np.int64)
+            if len(present) == 0:
+                continue
+            boxes = np.array([(objs[i - 1][0].start, objs[i - 1][1].start, objs[i - 1][0].stop, objs[i - 1][1].stop)
+                              for i in present])
+            cy = (boxes[:, 0] + boxes[:, 2]) // 2
+            cx = (boxes[:, 1] + boxes[:, 3]) // 2
+            owned = (
+                (cy >= core[0].start) & (cy < core[0].stop)
+                & (cx >= core[1].start) & (cx < core[1].stop)
+            )
+            th, tw = bw.shape
+            cut = (
+                ((boxes[:, 0] == 0) & (ext[0].start > 0)) | ((boxes[:, 2] == th) & (ext[0].stop < H))
+                | ((boxes[:, 1] == 0) & (ext[1].start > 0)) | ((boxes[:, 3] == tw) & (ext[1].stop < W))
+            )
+            truncated += int((owned & cut).sum())
+            if not owned.any():
+                continue
+
+            # owned cells get consecutive global ids, everything else in the tile is left alone
+            lut = np.zeros(len(objs) + 1, dtype=out.dtype)
+            lut[present[owned]] = np.arange(n_labels + 1, n_labels + 1 + int(owned.sum()))
+            new = lut[ws]
+            sel = new > 0
+            # read-modify-write, so `out` can be a memmap or an image store
+            region = np.asarray(out[ext])
+            region[sel] = new[sel]
+            out[ext] = region
+            n_labels += int(owned.sum())
+        if hasattr(out, "flush"):
+            out.flush()
+    finally:
+        del d2
+        os.remove(scratch_path)
+
+    return {
+        "otsu_threshold": float(thr),
+        "marker_threshold": float(marker_thr),
+        "otsu_sample_stride": stride,
+        "n_labels": n_labels,
+        "n_tiles": len(tiles),
+        "truncated_objects": truncated,
+    }
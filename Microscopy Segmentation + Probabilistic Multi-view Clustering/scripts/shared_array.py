@@ -0,0 +1,23 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+# NumPy arrays in POSIX shared memory so pool workers read one copy instead of each
+# receiving a pickled copy. The creating process owns the block and must release() it.
+
+def to_shared(a):
+    a = np.ascontiguousarray(a)
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+    return shm, (shm.name, a.shape, a.dtype.str)
+
+def attach(spec):
+    # read-only view of a block created by to_shared; keep the returned shm alive while using it
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    a = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    a.flags.writeable = False
+    return shm, a
+
+def release(shm):
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from perf import section
+
+# Spatial context of segmented cells.
+# The region adjacency graph (RAG) comes from one pass over the label image, read in bands
+# of rows: every pixel is compared with its right and lower neighbour (shifted arrays, plus
+# the last row of the previous band), and pairs of different non-zero labels are counted as
+# shared edge length. The same pass accumulates area, centroid sums and boundary length, so
+# cost is linear in pixels and memory is one band plus per-label counters. Radius
+# neighbourhoods and nearest-neighbour distances come from a KD-tree over the centroids.
+
+def region_adjacency(seg, chunk_rows=4096):
+    # (edges DataFrame seg_a < seg_b with contact_length, per-label stats indexed by label)
+    n = int(seg.max()) + 1
+    H, W = seg.shape
+    area = np.zeros(n, dtype=np.int64)
+    boundary = np.zeros(n, dtype=np.int64)
+    sy = np.zeros(n)
+    sx = np.zeros(n)
+    codes, counts = [], []
+    xs = np.arange(W, dtype=float)
+    prev = None
+    for r0 in range(0, H, chunk_rows):
+        band = np.asarray(seg[r0:r0 + chunk_rows]).astype(np.int64)
+        flat = band.ravel()
+        area += np.bincount(flat, minlength=n)
+        sy += np.bincount(flat, np.repeat(np.arange(r0, r0 + len(band), dtype=float), W), minlength=n)
+        sx += np.bincount(flat, np.tile(xs, len(band)), minlength=n)
+
+        # right neighbours, lower neighbours, and the seam with the previous band
+        shifted = [(band[:, :-1], band[:, 1:]), (band[:-1], band[1:])]
+        if prev is not None:
+            shifted.append((prev, band[0]))
+        band_codes = []
+        for a, b in shifted:
+            a, b = a.ravel(), b.ravel()
+            d = a != b
+            a, b = a[d], b[d]
+            boundary += np.bincount(a, minlength=n) + np.bincount(b, minlength=n)
+            fg = (a > 0) & (b > 0)
+            a, b = a[fg], b[fg]
+            band_codes.append(np.minimum(a, b) * n + np.maximum(a, b))
+        u, c = np.unique(np.concatenate(band_codes), return_counts=True)
+        codes.append(u)
+        counts.append(c)
+        prev = band[-1]
+
+    u, inv = np.unique(np.concatenate(codes), return_inverse=True)
+    contact = np.bincount(inv, np.concatenate(counts).astype(float)).astype(np.int64)
+    edges = pd.DataFrame({"seg_a": u // n, "seg_b": u % n, "contact_length": contact})
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats = {"area": area, "boundary": boundary, "cy": sy / area, "cx": sx / area}
+    return edges, stats
+
+def neighbourhood_features(edges, stats, radius=40.0, k=6, types=None):
+    # one row per present label (seg_id ascending); `types` optionally maps label -> type
+    # code (>= 0, -1 when unknown) for the neighbour-type composition within `radius`
+    labels = np.flatnonzero(stats["area"][1:] > 0) + 1
+    m = len(labels)
+    row = np.full(len(stats["area"]), -1, dtype=np.int64)
+    row[labels] = np.arange(m)
+    a, b = row[edges["seg_a"].to_numpy()], row[edges["seg_b"].to_numpy()]
+    contact = edges["contact_length"].to_numpy().astype(float)
+
+    degree = np.bincount(a, minlength=m) + np.bincount(b, minlength=m)
+    contact_len = np.bincount(a, contact, minlength=m) + np.bincount(b, contact, minlength=m)
+    bnd = stats["boundary"][labels]
+    out = {
+        "seg_id": labels,
+        "sp_n_contacts": degree,
+        "sp_contact_length": contact_len,
+        "sp_contact_fraction": np.where(bnd > 0, contact_len / np.maximum(bnd, 1), 0.0),
+    }
+
+    pts = np.column_stack([stats["cy"][labels], stats["cx"][labels]])
+    with section("kdtree"):
+        tree = cKDTree(pts)
+        pairs = tree.query_pairs(radius, output_type="ndarray") if m > 1 else np.empty((0, 2), dtype=np.int64)
+        n_within = np.bincount(pairs.ravel(), minlength=m)
+        kk = min(k, m - 1)
+        if kk > 0:
+            dist, _ = tree.query(pts, k=kk + 1)
+            dist = dist.reshape(m, kk + 1)[:, 1:]
+            nn, knn = dist[:, 0], dist.mean(axis=1)
+        else:
+            nn = knn = np.full(m, np.nan)
+    out["sp_n_within_radius"] = n_within
+    out["sp_nn_dist"] = nn
+    out["sp_mean_knn_dist"] = knn
+
+    if types is not None:
+        t = np.asarray(types)[labels]
+        n_types = int(t.max()) + 1 if (t >= 0).any() else 0
+        i = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        j = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        known = t[j] >= 0
+        comp = np.bincount(i[known] * n_types + t[j[known]], minlength=m * n_types).reshape(m, n_types)
+        tot = np.maximum(comp.sum(axis=1, keepdims=True), 1)
+        for c in range(n_types):
+            out[f"sp_frac_type_{c}"] = comp[:, c] / tot[:, 0]
+    return pd.DataFrame(out)
@@ -0,0 +1,98 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import linear_sum_assignment
+from sklearn.mixture import GaussianMixture
+from sklearn.metrics import adjusted_rand_score, confusion_matrix
+from threadpoolctl import threadpool_limits
+from shared_array import to_shared, attach, release
+
+# Bootstrap / subsample stability of the GMM clustering.
+# Every resample refits the mixture on a resampled set of rows and labels all cells; its
+# labels are matched to the reference clustering (Hungarian assignment on the confusion
+# matrix) so runs are comparable. Workers read the scaled matrix, the reference labels and
+# the true types from shared memory and send back only the aligned label vector and a few
+# scores; the parent accumulates per-cell co-assignment counts without keeping every run.
+
+_SHARED = {}
+
+def _init_worker(x_spec, ref_spec, y_spec):
+    _SHARED["limits"] = threadpool_limits(1)
+    _SHARED["x_shm"], _SHARED["X"] = attach(x_spec)
+    _SHARED["ref_shm"], _SHARED["ref"] = attach(ref_spec)
+    _SHARED["y_shm"], _SHARED["y"] = attach(y_spec)
+
+def align_labels(ref, labels, k):
+    # relabel `labels` so that it agrees with `ref` on as many cells as possible
+    cm = confusion_matrix(ref, labels, labels=np.arange(k))
+    rows, cols = linear_sum_assignment(-cm)
+    lut = np.empty(k, dtype=np.int64)
+    lut[cols] = rows
+    return lut[labels]
+
+def fit_resample(seed, mode, fraction, n_components, covariance_type, reg_covar):
+    X, ref, y = _SHARED["X"], _SHARED["ref"], _SHARED["y"]
+    n = len(X)
+    rng = np.random.default_rng(seed)
+    if mode == "bootstrap":
+        idx = rng.integers(0, n, size=n)
+    else:
+        idx = rng.choice(n, size=max(n_components, int(round(fraction * n))), replace=False)
+    gm = GaussianMixture(n_components=n_components, covariance_type=covariance_type,
+                         reg_covar=reg_covar, random_state=seed).fit(X[idx])
+    aligned = align_labels(ref, gm.predict(X), n_components)
+    inter = np.bincount(ref * n_components + aligned, minlength=n_components**2).reshape(n_components, n_components)
+    union = np.bincount(ref, minlength=n_components) + np.bincount(aligned, minlength=n_components) - np.diag(inter)
+    return {
+        "seed": seed,
+        "labels": aligned.astype(np.int16),
+        "ari_vs_reference": adjusted_rand_score(ref, aligned),
+        "ari_vs_true_type": adjusted_rand_score(y, aligned) if len(y) else float("nan"),
+        "jaccard": np.diag(inter) / np.maximum(union, 1),
+    }
+
+def run_stability(Xs, ref_labels, y_true, n_components, n_resamples=200, mode="bootstrap", fraction=0.8,
+                  covariance_type="full", reg_covar=1e-6, workers=None, seed=42):
+    # returns (per-cell table, per-cluster table, per-run table)
+    k = n_components
+    n = len(Xs)
+    seeds = np.random.SeedSequence(seed).generate_state(n_resamples).tolist()
+    x_shm, x_spec = to_shared(np.asarray(Xs, dtype=float))
+    ref_shm, ref_spec = to_shared(np.asarray(ref_labels, dtype=np.int64))
+    y_shm, y_spec = to_shared(np.asarray(y_true, dtype=np.int64))
+
+    counts = np.zeros((n, k), dtype=np.int32)
+    runs = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                                 initargs=(x_spec, ref_spec, y_spec)) as ex:
+            futures = [ex.submit(fit_resample, s, mode, fraction, k, covariance_type, reg_covar) for s in seeds]
+            for f in futures:
+                r = f.result()
+                counts[np.arange(n), r.pop("labels")] += 1
+                runs.append(r)
+    finally:
+        release(x_shm)
+        release(ref_shm)
+        release(y_shm)
+
+    # co_assignment: share of resamples that put the cell in its reference cluster
+    freq = counts / n_resamples
+    cells = pd.DataFrame({
+        "co_assignment": freq[np.arange(n), ref_labels],
+        "modal_cluster": freq.argmax(axis=1),
+        "modal_frequency": freq.max(axis=1),
+    })
+
+    jac = np.stack([r.pop("jaccard") for r in runs])
+    clusters = pd.DataFrame({
+        "cluster": np.arange(k),
+        "n": np.bincount(ref_labels, minlength=k),
+        "mean_co_assignment": pd.Series(cells["co_assignment"]).groupby(ref_labels).mean().reindex(range(k)).to_numpy(),
+        "jaccard_mean": jac.mean(axis=0),
+        "jaccard_p05": np.quantile(jac, 0.05, axis=0),
+        # share of resamples in which the cluster dissolved (Jaccard < 0.5, as in Hennig 2007)
+        "dissolved_fraction": (jac < 0.5).mean(axis=0),
+    })
+    return cells, clusters, pd.DataFrame(runs)
@@ -0,0 +1,122 @@
+import numpy as np
+from scipy.linalg import solve_triangular
+from scipy.special import logsumexp
+from sklearn.cluster import KMeans
+from perf import section
+
+# Streaming counterparts of StandardScaler + GaussianMixture(covariance_type="full") for
+# tables that do not fit in memory. Both expose partial_fit so batches can be fed as they
+# arrive; the GMM uses stepwise online EM (running averages of the sufficient statistics
+# with a decaying step size), followed by a regular M-step after every batch.
+
+class StreamingScaler:
+    def __init__(self):
+        self.n_samples_seen_ = 0
+        self.mean_ = None
+        self._m2 = None
+
+    def partial_fit(self, X):
+        X = np.asarray(X, dtype=float)
+        m = X.shape[0]
+        if m == 0:
+            return self
+        mean_b = X.mean(axis=0)
+        m2_b = ((X - mean_b) ** 2).sum(axis=0)
+        if self.mean_ is None:
+            self.mean_, self._m2, self.n_samples_seen_ = mean_b, m2_b, m
+            return self
+        # Chan et al. pairwise update of mean and sum of squared deviations
+        n = self.n_samples_seen_
+        tot = n + m
+        delta = mean_b - self.mean_
+        self.mean_ = self.mean_ + delta * (m / tot)
+        self._m2 = self._m2 + m2_b + delta**2 * (n * m / tot)
+        self.n_samples_seen_ = tot
+        return self
+
+    @property
+    def scale_(self):
+        # population std like StandardScaler; constant features keep scale 1
+        s = np.sqrt(self._m2 / self.n_samples_seen_)
+        return np.where(s == 0, 1.0, s)
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=float) - self.mean_) / self.scale_
+
+class StreamingGMM:
+    def __init__(self, n_components=4, reg_covar=1e-6, decay=0.6, offset=2.0, random_state=None):
+        self.n_components = n_components
+        self.reg_covar = reg_covar
+        self.decay = decay
+        self.offset = offset
+        self.random_state = random_state
+        self.n_batches_ = 0
+
+    def _init_from_batch(self, X):
+        if X.shape[0] < self.n_components:
+            raise ValueError(f"first batch has {X.shape[0]} rows, need at least n_components={self.n_components}")
+        km = KMeans(n_clusters=self.n_components, n_init=1, random_state=self.random_state).fit(X)
+        resp = np.zeros((X.shape[0], self.n_components))
+        resp[np.arange(X.shape[0]), km.labels_] = 1.0
+        self._s0, self._s1, self._s2 = self._batch_stats(X, resp)
+        self._m_step()
+
+    @staticmethod
+    def _batch_stats(X, resp):
+        # per-sample averages of E[z], E[z x] and E[z x x^T]
+        n = X.shape[0]
+        s0 = resp.sum(axis=0) / n
+        s1 = resp.T @ X / n
+        s2 = np.einsum("nk,ni,nj->kij", resp, X, X, optimize=True) / n
+        return s0, s1, s2
+
+    def _m_step(self):
+        d = self._s1.shape[1]
+        nk = self._s0 + 10 * np.finfo(float).eps
+        self.weights_ = nk / nk.sum()
+        self.means_ = self._s1 / nk[:, None]
+        cov = self._s2 / nk[:, None, None] - np.einsum("ki,kj->kij", self.means_, self.means_)
+        cov += self.reg_covar * np.eye(d)[None]
+        self.covariances_ = cov
+        self.precisions_cholesky_ = np.stack([
+            solve_triangular(np.linalg.cholesky(c), np.eye(d), lower=True).T for c in cov
+        ])
+
+    def _estimate_weighted_log_prob(self, X):
+        # log N(x | mu_k, Sigma_k) + log w_k for every component, via precision Cholesky factors
+        n, d = X.shape
+        out = np.empty((n, self.n_components))
+        for k in range(self.n_components):
+            P = self.precisions_cholesky_[k]
+            y = X @ P - self.means_[k] @ P
+            out[:, k] = -0.5 * (d * np.log(2 * np.pi) + (y**2).sum(axis=1)) + np.log(np.diag(P)).sum()
+        return out + np.log(self.weights_)
+
+    def partial_fit(self, X):
+        X = np.asarray(X, dtype=float)
+        if X.shape[0] == 0:
+            return self
+        if self.n_batches_ == 0:
+            self._init_from_batch(X)
+        else:
+            with section("em_e_step"):
+                resp = self.predict_proba(X)
+            rho = (self.n_batches_ + self.offset) ** (-self.decay)
+            with section("em_m_step"):
+                b0, b1, b2 = self._batch_stats(X, resp)
+                self._s0 = (1 - rho) * self._s0 + rho * b0
+                self._s1 = (1 - rho) * self._s1 + rho * b1
+                self._s2 = (1 - rho) * self._s2 + rho * b2
+                self._m_step()
+        self.n_batches_ += 1
+        return self
+
+    def score_samples(self, X):
+        return logsumexp(self._estimate_weighted_log_prob(np.asarray(X, dtype=float)), axis=1)
+
+    def predict_proba(self, X):
+        lp = self._estimate_weighted_log_prob(np.asarray(X, dtype=float))
+        return np.exp(lp - logsumexp(lp, axis=1, keepdims=True))
+
+    def predict(self, X):
+        return self.predict_proba(X).argmax(axis=1)
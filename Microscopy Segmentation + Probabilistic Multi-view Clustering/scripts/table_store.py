@@ -0,0 +1,187 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# Columnar table store used for the hand-offs between stages 03 -> 04 -> 05 -> 06.
+# A table is a directory holding one .npy file per column plus schema.json, so readers
+# can list columns without touching data, load only the columns they need, and memory-map
+# them straight into NumPy. Float columns are stored as float32. Writers can attach a small
+# JSON-serialisable "meta" dict to the schema (e.g. which columns make up each view).
+# A table can carry a dense offset index on an integer key column (index_<key>.npy, with
+# entry k holding the row of key k or -1), so rows for a set of keys are fetched by random
+# access instead of a join over the whole table.
+
+SCHEMA = "schema.json"
+
+def write_table(df, path, float_dtype=np.float32, meta=None):
+    os.makedirs(path, exist_ok=True)
+    cols = []
+    for i, c in enumerate(df.columns):
+        a = df[c].to_numpy()
+        if a.dtype.kind == "f":
+            a = a.astype(float_dtype)
+        elif a.dtype.kind not in "biu":
+            a = a.astype(str)
+        fname = f"c{i:04d}.npy"
+        np.save(os.path.join(path, fname), np.ascontiguousarray(a))
+        cols.append({"name": str(c), "file": fname, "dtype": a.dtype.str})
+
+    # drop column files left over from an older, wider table
+    keep = {c["file"] for c in cols}
+    for f in os.listdir(path):
+        if f.endswith(".npy") and f not in keep:
+            os.remove(os.path.join(path, f))
+
+    schema = {"n_rows": int(len(df)), "columns": cols}
+    if meta is not None:
+        schema["meta"] = meta
+    _save_schema(path, schema)
+
+def csv_to_table(csv_path, path, chunk_rows=100_000, float_dtype=np.float32):
+    # Convert a CSV without loading it: pass 1 finds the row count and column dtypes,
+    # pass 2 fills memory-mapped column files chunk by chunk.
+    n, kinds, widths = 0, {}, {}
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_rows):
+        n += len(chunk)
+        for c in chunk.columns:
+            k = chunk[c].dtype.kind
+            prev = kinds.get(c, k)
+            kinds[c] = "O" if "O" in (k, prev) else "f" if "f" in (k, prev) else k
+            if kinds[c] == "O":
+                widths[c] = max(widths.get(c, 1), int(chunk[c].astype(str).str.len().max()))
+    header = list(pd.read_csv(csv_path, nrows=0).columns)
+
+    os.makedirs(path, exist_ok=True)
+    dtypes = {c: np.dtype(float_dtype) if kinds.get(c) == "f"
+              else np.dtype(f"<U{widths[c]}") if kinds.get(c) == "O"
+              else np.dtype(np.int64) for c in header}
+    files = {c: f"c{i:04d}.npy" for i, c in enumerate(header)}
+    outs = {c: np.lib.format.open_memmap(os.path.join(path, files[c]), mode="w+", dtype=dtypes[c], shape=(n,))
+            for c in header}
+    r0 = 0
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_rows):
+        for c in header:
+            outs[c][r0:r0 + len(chunk)] = chunk[c].to_numpy().astype(dtypes[c])
+        r0 += len(chunk)
+    for a in outs.values():
+        a.flush()
+    del outs
+    for f in os.listdir(path):
+        if f.endswith(".npy") and f not in files.values():
+            os.remove(os.path.join(path, f))
+    _save_schema(path, {"n_rows": n, "columns": [{"name": c, "file": files[c], "dtype": dtypes[c].str} for c in header]})
+
+def _schema(path):
+    with open(os.path.join(path, SCHEMA), "r") as f:
+        return json.load(f)
+
+def table_columns(path):
+    return [c["name"] for c in _schema(path)["columns"]]
+
+def table_rows(path):
+    return _schema(path)["n_rows"]
+
+def table_meta(path):
+    return _schema(path).get("meta", {})
+
+def read_arrays(path, columns=None, mmap=True):
+    # {column: array}; with mmap=True the arrays are zero-copy views of the files on disk
+    files = {c["name"]: c["file"] for c in _schema(path)["columns"]}
+    columns = list(files) if columns is None else list(columns)
+    missing = [c for c in columns if c not in files]
+    if missing:
+        raise KeyError(f"{path} has no columns {missing}")
+    mode = "r" if mmap else None
+    return {c: np.load(os.path.join(path, files[c]), mmap_mode=mode) for c in columns}
+
+def read_matrix(path, columns, dtype=np.float32):
+    # (n_rows, len(columns)) matrix filled column by column from the memory maps
+    arrs = read_arrays(path, columns)
+    X = np.empty((table_rows(path), len(columns)), dtype=dtype)
+    for j, c in enumerate(columns):
+        X[:, j] = arrs[c]
+    return X
+
+def iter_chunks(path, columns, chunk_rows=65536, dtype=np.float32, rng=None):
+    # (start, block) pairs of at most chunk_rows rows, read from the memory maps;
+    # pass a numpy Generator to visit the chunks in random order
+    arrs = list(read_arrays(path, columns).values())
+    n = table_rows(path)
+    starts = np.arange(0, n, chunk_rows)
+    if rng is not None:
+        starts = rng.permutation(starts)
+    for i in starts:
+        i = int(i)
+        block = np.empty((min(chunk_rows, n - i), len(columns)), dtype=dtype)
+        for j, a in enumerate(arrs):
+            block[:, j] = a[i:i + chunk_rows]
+        yield i, block
+
+def _save_schema(path, schema):
+    with open(os.path.join(path, SCHEMA), "w") as f:
+        json.dump(schema, f, indent=2)
+
+def build_index(path, key):
+    keys = np.asarray(read_arrays(path, [key])[key])
+    if keys.dtype.kind not in "iu" or (len(keys) and keys.min() < 0):
+        raise ValueError(f"index key {key} must be a non-negative integer column")
+    offsets = np.full(int(keys.max()) + 1 if len(keys) else 0, -1, dtype=np.int64)
+    offsets[keys] = np.arange(len(keys))
+    if (offsets >= 0).sum() != len(keys):
+        raise ValueError(f"index key {key} has duplicate values")
+    fname = f"index_{key}.npy"
+    np.save(os.path.join(path, fname), offsets)
+    schema = _schema(path)
+    schema.setdefault("meta", {}).setdefault("index", {})[key] = fname
+    _save_schema(path, schema)
+
+def lookup_rows(path, key, keys):
+    # row positions for `keys` (-1 where a key is absent), via the offset index
+    fname = _schema(path).get("meta", {}).get("index", {}).get(key)
+    if fname is None:
+        raise KeyError(f"{path} has no index on {key}; call build_index first")
+    offsets = np.load(os.path.join(path, fname), mmap_mode="r")
+    keys = np.asarray(keys, dtype=np.int64)
+    pos = np.full(len(keys), -1, dtype=np.int64)
+    ok = (keys >= 0) & (keys < len(offsets))
+    pos[ok] = offsets[keys[ok]]
+    return pos
+
+def append_columns(path, src_path, positions, columns=None, chunk_rows=65536):
+    # Add columns of src_path to the table at path, row i taking source row positions[i].
+    # Rows are gathered in sorted batches of chunk_rows straight into memory-mapped column
+    # files, so neither table is loaded whole. Missing rows (-1) become NaN; integer
+    # columns with missing rows are widened to float like a pandas left join.
+    schema = _schema(path)
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) != schema["n_rows"]:
+        raise ValueError(f"{len(positions)} positions for a table of {schema['n_rows']} rows")
+    src = read_arrays(src_path, columns)
+    order = np.argsort(positions, kind="stable")
+    sorted_pos = positions[order]
+    missing = sorted_pos < 0
+    for name, a in src.items():
+        dtype = a.dtype
+        if missing.any() and dtype.kind in "biu":
+            dtype = np.dtype(np.float64)
+        fname = f"c{len(schema['columns']):04d}.npy"
+        out = np.lib.format.open_memmap(os.path.join(path, fname), mode="w+", dtype=dtype, shape=(len(positions),))
+        for i in range(0, len(order), chunk_rows):
+            rows, pos, miss = order[i:i + chunk_rows], sorted_pos[i:i + chunk_rows], missing[i:i + chunk_rows]
+            block = np.empty(len(rows), dtype=dtype)
+            block[~miss] = a[pos[~miss]]
+            if miss.any():
+                block[miss] = np.nan if dtype.kind == "f" else ""
+            out[rows] = block
+        out.flush()
+        del out
+        schema["columns"].append({"name": name, "file": fname, "dtype": dtype.str})
+    _save_schema(path, schema)
+
+def read_table(path, columns=None):
+    arrs = read_arrays(path, columns, mmap=False)
+    return pd.DataFrame(arrs, columns=list(arrs))
+
+def export_csv(path, csv_path, columns=None):
+    read_table(path, columns).to_csv(csv_path, index=False)
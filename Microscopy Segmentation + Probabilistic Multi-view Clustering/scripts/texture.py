@@ -0,0 +1,163 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import ndimage as ndi
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+from shared_array import to_shared, attach, release
+from perf import section
+
+# Per-region texture and intensity features for View 1.
+# Region slices come from one ndi.find_objects pass; every region is only ever touched
+# through its bounding-box crop. Regions are processed in chunks: the crops of a chunk are
+# flattened into one pixel list tagged with the region index, so quantiles, radial profiles
+# and grey-level co-occurrence (GLCM) statistics are computed for the whole chunk with
+# sorts and bincounts instead of per-region loops. Chunks run in a process pool with the
+# image and labels in shared memory.
+
+GLCM_LEVELS = 16
+GLCM_OFFSETS = ((0, 1), (1, 0), (1, 1), (1, -1))
+QUANTILES = (0.10, 0.25, 0.50, 0.75, 0.90)
+N_RINGS = 4
+
+_SHARED = {}
+
+def _init_worker(seg_spec, img_spec):
+    _SHARED["limits"] = threadpool_limits(1)
+    _SHARED["seg_shm"], _SHARED["seg"] = attach(seg_spec)
+    _SHARED["img_shm"], _SHARED["img"] = attach(img_spec)
+
+def _chunk_pixels(seg, img, labels, slices, lo, hi):
+    # flattened pixels of every region in the chunk, plus co-occurring grey-level pairs
+    reg, vals, ys, xs, pa, pb, preg = [], [], [], [], [], [], []
+    scale = (GLCM_LEVELS - 1e-9) / (hi - lo + 1e-12)
+    for i, (lab, sl) in enumerate(zip(labels, slices)):
+        m = seg[sl] == lab
+        crop = img[sl]
+        yy, xx = np.nonzero(m)
+        reg.append(np.full(len(yy), i))
+        vals.append(crop[yy, xx])
+        ys.append(yy + sl[0].start)
+        xs.append(xx + sl[1].start)
+        q = ((crop - lo) * scale).astype(np.int64).clip(0, GLCM_LEVELS - 1)
+        h, w = m.shape
+        for dy, dx in GLCM_OFFSETS:
+            # pixel pairs (y, x) -> (y + dy, x + dx) with both ends inside the region
+            a = (slice(0, h - dy), slice(max(0, -dx), w - max(0, dx)))
+            b = (slice(dy, h), slice(max(0, dx), w - max(0, -dx)))
+            both = m[a] & m[b]
+            pa.append(q[a][both])
+            pb.append(q[b][both])
+            preg.append(np.full(int(both.sum()), i))
+    cat = np.concatenate
+    return cat(reg), cat(vals).astype(np.float64), cat(ys), cat(xs), cat(pa), cat(pb), cat(preg)
+
+def _quantiles(reg, vals, n):
+    # linear-interpolated quantiles per region (same as np.quantile) from one sort
+    order = np.lexsort((vals, reg))
+    v = vals[order]
+    counts = np.bincount(reg, minlength=n)
+    start = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    out = {}
+    for q in QUANTILES:
+        pos = q * (counts - 1)
+        k = np.floor(pos).astype(np.int64)
+        frac = pos - k
+        lo = v[start + k]
+        hi = v[start + np.minimum(k + 1, counts - 1)]
+        out[f"int_q{int(round(q * 100)):02d}"] = lo + frac * (hi - lo)
+    return out
+
+def _radial_profile(reg, vals, ys, xs, n):
+    # mean intensity in N_RINGS rings of normalised distance from the region centroid
+    cnt = np.bincount(reg, minlength=n)
+    cy = np.bincount(reg, ys, minlength=n) / cnt
+    cx = np.bincount(reg, xs, minlength=n) / cnt
+    r = np.hypot(ys - cy[reg], xs - cx[reg])
+    rmax = np.zeros(n)
+    np.maximum.at(rmax, reg, r)
+    ring = np.minimum((r / (rmax[reg] + 1e-12) * N_RINGS).astype(np.int64), N_RINGS - 1)
+    code = reg * N_RINGS + ring
+    s = np.bincount(code, vals, minlength=n * N_RINGS).reshape(n, N_RINGS)
+    c = np.bincount(code, minlength=n * N_RINGS).reshape(n, N_RINGS)
+    mean = np.bincount(reg, vals, minlength=n) / cnt
+    prof = np.where(c > 0, s / np.maximum(c, 1), mean[:, None])
+    return {f"rad_{k + 1}": prof[:, k] for k in range(N_RINGS)}
+
+def _haralick(pa, pb, preg, n):
+    # symmetric normalised GLCM per region, summed over GLCM_OFFSETS
+    L = GLCM_LEVELS
+    P = np.bincount((preg * L + pa) * L + pb, minlength=n * L * L).reshape(n, L, L).astype(np.float64)
+    P += P.transpose(0, 2, 1)
+    tot = P.sum(axis=(1, 2))
+    P /= np.maximum(tot, 1)[:, None, None]
+    i, j = np.meshgrid(np.arange(L), np.arange(L), indexing="ij")
+    mu_i = (P * i).sum(axis=(1, 2))
+    mu_j = (P * j).sum(axis=(1, 2))
+    sd_i = np.sqrt((P * (i - mu_i[:, None, None]) ** 2).sum(axis=(1, 2)))
+    sd_j = np.sqrt((P * (j - mu_j[:, None, None]) ** 2).sum(axis=(1, 2)))
+    cov = (P * (i - mu_i[:, None, None]) * (j - mu_j[:, None, None])).sum(axis=(1, 2))
+    flat = (sd_i < 1e-15) | (sd_j < 1e-15)
+    out = {
+        "tex_contrast": (P * (i - j) ** 2).sum(axis=(1, 2)),
+        "tex_homogeneity": (P / (1.0 + (i - j) ** 2)).sum(axis=(1, 2)),
+        "tex_energy": np.sqrt((P ** 2).sum(axis=(1, 2))),
+        # constant texture is perfectly correlated, as in skimage.feature.graycoprops
+        "tex_correlation": np.where(flat, 1.0, cov / np.where(flat, 1.0, sd_i * sd_j)),
+        "tex_entropy": -(P * np.log2(np.where(P > 0, P, 1.0))).sum(axis=(1, 2)),
+    }
+    no_pairs = tot == 0
+    for k in out:
+        out[k][no_pairs] = np.nan
+    return out
+
+def texture_chunk(labels, slices, lo, hi):
+    seg, img = _SHARED["seg"], _SHARED["img"]
+    n = len(labels)
+    reg, vals, ys, xs, pa, pb, preg = _chunk_pixels(seg, img, labels, slices, lo, hi)
+    cols = {"seg_id": np.asarray(labels)}
+    cols.update(_quantiles(reg, vals, n))
+    cnt = np.bincount(reg, minlength=n)
+    mean = np.bincount(reg, vals, minlength=n) / cnt
+    cols["int_std"] = np.sqrt(np.maximum(np.bincount(reg, vals ** 2, minlength=n) / cnt - mean ** 2, 0.0))
+    cols.update(_radial_profile(reg, vals, ys, xs, n))
+    cols.update(_haralick(pa, pb, preg, n))
+    return pd.DataFrame(cols)
+
+def texture_table(seg, img, workers=None, chunk_regions=2048):
+    # one row per labelled region (seg_id ascending), like morphology_table
+    with section("find_objects"):
+        objs = ndi.find_objects(seg)
+    labels = [i for i, sl in enumerate(objs, start=1) if sl is not None]
+    slices = [objs[i - 1] for i in labels]
+    lo, hi = float(img.min()), float(img.max())
+    chunks = [(labels[i:i + chunk_regions], slices[i:i + chunk_regions], lo, hi)
+              for i in range(0, len(labels), chunk_regions)]
+    if not chunks:
+        return _empty_table()
+
+    workers = workers or os.cpu_count()
+    with section("texture"):
+        if workers == 1 or len(chunks) == 1:
+            _SHARED["seg"], _SHARED["img"] = seg, img
+            try:
+                parts = [texture_chunk(*c) for c in chunks]
+            finally:
+                _SHARED.clear()
+        else:
+            seg_shm, seg_spec = to_shared(np.ascontiguousarray(seg))
+            img_shm, img_spec = to_shared(np.ascontiguousarray(img))
+            try:
+                with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), initializer=_init_worker,
+                                         initargs=(seg_spec, img_spec)) as ex:
+                    parts = list(ex.map(texture_chunk, *zip(*chunks)))
+            finally:
+                release(seg_shm)
+                release(img_shm)
+    return pd.concat(parts, ignore_index=True)
+
+def _empty_table():
+    cols = ["seg_id"] + [f"int_q{int(round(q * 100)):02d}" for q in QUANTILES] + ["int_std"]
+    cols += [f"rad_{k + 1}" for k in range(N_RINGS)]
+    cols += ["tex_contrast", "tex_homogeneity", "tex_energy", "tex_correlation", "tex_entropy"]
+    return pd.DataFrame(columns=cols)
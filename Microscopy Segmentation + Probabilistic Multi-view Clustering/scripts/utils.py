@@ -5,8 +5,10 @@ def seed_everything(seed: int = 42):
     random.seed(seed)
     np.random.seed(seed)
 
-def normalize01(x: np.ndarray) -> np.ndarray:
-    x = x.astype(float)
-    x = x - np.min(x)
+def normalize01(x: np.ndarray, dtype=float) -> np.ndarray:
+    # one working copy in `dtype` (pass np.float32 to halve memory), rescaled in place
+    x = x.astype(dtype)
+    x -= np.min(x)
     d = np.max(x) - np.min(x)
-    return x / (d + 1e-12)
+    x /= (d + 1e-12)
+    return x
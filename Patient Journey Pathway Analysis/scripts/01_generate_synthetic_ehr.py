@@ -1,11 +1,45 @@
 import os
+import time
+import shutil
+import argparse
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from utils import seed_everything
+from utils import seed_everything, EVENTS
 
 OUT_PATH = os.path.join("data", "raw", "event_log.csv")
 
+# shard files of --batched; appended to OUT_PATH in shard order, then removed
+SHARD_DIR = os.path.join("data", "raw", "event_log.parts")
+
+START = datetime(2024, 1, 1, 8, 0, 0)
+
+# Batched generator (--batched) for load tests. Patients are drawn in shards of --shard-size,
+# each shard as whole arrays (severity, inclusion flags of the optional steps, gaps, admission)
+# over a fixed slot layout of the journey. Every shard has its own random stream spawned from
+# --seed, so the log depends on the seed and shard size only, not on the number of workers.
+# Shards are written by a process pool and appended to OUT_PATH in order; patient ids are
+# zero-padded, so the log stays sorted by (patient_id, timestamp).
+
+# journey slots in order; OUTCOME becomes ADMIT or DISCHARGE
+SLOTS = ["ED_ARRIVAL", "TRIAGE", "VITALS", "LABS", "IMAGING", "TREATMENT", "OBSERVATION", "SPECIALIST_REVIEW", "OUTCOME"]
+# optional slots and the severity offset of their inclusion probability
+OPTIONAL = {"LABS": 0.1, "IMAGING": 0.3, "OBSERVATION": 0.2, "SPECIALIST_REVIEW": 0.6}
+
+COLUMNS = ["patient_id", "timestamp", "event", "age", "sex", "deprivation", "latent_severity",
+           "admitted", "wait_time_min", "los_min"]
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Generate a synthetic unscheduled-care event log.")
+    p.add_argument("--n-patients", type=int, default=1200)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--batched", action="store_true",
+                   help="vectorised, sharded generator for large logs (other random draws than the default)")
+    p.add_argument("--shard-size", type=int, default=100_000, help="patients per shard (--batched)")
+    p.add_argument("--workers", type=int, default=None, help="processes writing shards (--batched)")
+    return p.parse_args()
+
 def sample_demographics(n, rng):
     age = rng.integers(18, 92, size=n)
     sex = rng.choice(["F", "M"], size=n, p=[0.52, 0.48])
@@ -64,17 +98,112 @@ def generate_journey(rng, patient_id, base_time, age, deprivation):
 
     return rows
 
+def generate_shard(seed_seq, first_id, n, id_width):
+    # n patients (ids first_id..) as an event DataFrame sorted by (patient_id, timestamp)
+    rng = np.random.default_rng(seed_seq)
+    age, sex, deprivation = sample_demographics(n, rng)
+    base_min = rng.integers(0, 180, size=n) * 24*60 + rng.integers(0, 24*60, size=n)
+
+    severity = np.clip(rng.normal(loc=0.0, scale=1.0, size=n), -2.5, 2.5)
+    severity += 0.015*(age-50) + 0.12*(deprivation-3)
+
+    include = np.ones((n, len(SLOTS)), dtype=bool)
+    for slot, offset in OPTIONAL.items():
+        include[:, SLOTS.index(slot)] = rng.random(n) < 1/(1+np.exp(-(severity-offset)))
+    admitted = (rng.random(n) < 1/(1+np.exp(-(severity-0.4)))).astype(np.int64)
+
+    # one gap per slot; skipped slots add nothing, so every event is one gap after the previous
+    complexity = 1 + 0.25*np.maximum(0, severity)
+    gaps = (rng.integers(8, 35, size=(n, len(SLOTS))) * complexity[:, None]).astype(np.int64)
+    gaps[:, 0] = 0
+    gaps *= include
+    offsets = np.cumsum(gaps, axis=1)
+
+    row, slot = np.nonzero(include)
+    slot_code = np.array([EVENTS.index(s) if s in EVENTS else -1 for s in SLOTS])
+    code = slot_code[slot]
+    outcome = code < 0
+    code[outcome] = np.where(admitted[row[outcome]] == 1, EVENTS.index("ADMIT"), EVENTS.index("DISCHARGE"))
+
+    ids = [f"P{i:0{id_width}d}" for i in range(first_id, first_id + n)]
+    minutes = (base_min[row] + offsets[row, slot]).astype("timedelta64[m]")
+    return pd.DataFrame({
+        "patient_id": pd.Categorical.from_codes(row, ids),
+        "timestamp": (np.datetime64(START, "m") + minutes).astype("datetime64[s]"),
+        "event": pd.Categorical.from_codes(code, EVENTS),
+        "age": age[row],
+        "sex": sex[row],
+        "deprivation": deprivation[row],
+        "latent_severity": severity[row],
+        "admitted": admitted[row],
+        "wait_time_min": gaps[row, 1],
+        "los_min": offsets[row, -1],
+    }, columns=COLUMNS)
+
+def csv_text(df):
+    # the rows of a shard as CSV text, byte-identical to df.to_csv(header=False) but faster:
+    # the per-patient columns are formatted once per patient, not once per event
+    row = df["patient_id"].cat.codes.to_numpy()
+    new_patient = np.r_[True, row[1:] != row[:-1]]
+    first = np.flatnonzero(new_patient)
+    per_patient = [df[c].to_numpy()[first].tolist() for c in COLUMNS[3:]]
+    tails = np.array(["," + ",".join(map(str, v)) + "\n" for v in zip(*per_patient)], dtype=object)
+    ids = np.array([f"{p}," for p in df["patient_id"].cat.categories], dtype=object)
+    events = np.array([f",{e}" for e in df["event"].cat.categories], dtype=object)
+    ts = np.char.replace(np.datetime_as_string(df["timestamp"].to_numpy(), unit="s"), "T", " ").astype(object)
+    lines = ids[row] + ts + events[df["event"].cat.codes.to_numpy()] + tails[np.cumsum(new_patient) - 1]
+    return "".join(lines)
+
+def write_shard(k, seed_seq, first_id, n, id_width):
+    df = generate_shard(seed_seq, first_id, n, id_width)
+    path = os.path.join(SHARD_DIR, f"part-{k:05d}.csv")
+    with open(path, "w", newline="") as f:
+        f.write(csv_text(df))
+    return path, len(df)
+
+def generate_batched(args):
+    n = args.n_patients
+    id_width = max(5, len(str(n - 1)))
+    firsts = list(range(0, n, args.shard_size))
+    sizes = [min(args.shard_size, n - f) for f in firsts]
+    seeds = np.random.SeedSequence(args.seed).spawn(len(firsts))
+
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    n_rows = 0
+    with open(OUT_PATH, "w", newline="") as out:
+        out.write(",".join(COLUMNS) + "\n")
+        with ProcessPoolExecutor(max_workers=args.workers) as ex:
+            # results come back in shard order, so each part is appended as soon as it is ready
+            for path, rows in ex.map(write_shard, range(len(firsts)), seeds, firsts, sizes,
+                                     [id_width] * len(firsts)):
+                with open(path, "r", newline="") as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(path)
+                n_rows += rows
+    shutil.rmtree(SHARD_DIR, ignore_errors=True)
+    return n_rows, len(firsts)
+
 def main():
-    seed_everything(42)
-    rng = np.random.default_rng(42)
+    args = parse_args()
+    seed_everything(args.seed)
+    os.makedirs(os.path.dirname(OUT_PATH), exist_ok=True)
 
-    n_patients = 1200
+    if args.batched:
+        t0 = time.perf_counter()
+        n_rows, n_shards = generate_batched(args)
+        secs = time.perf_counter() - t0
+        print(f"Saved synthetic event log: {OUT_PATH} ({n_rows:,} rows, {args.n_patients:,} patients, "
+              f"{n_shards} shards in {secs:.1f}s, {n_rows / max(secs, 1e-9):,.0f} rows/s)")
+        return
+
+    rng = np.random.default_rng(args.seed)
+
+    n_patients = args.n_patients
     age, sex, deprivation = sample_demographics(n_patients, rng)
 
-    start = datetime(2024, 1, 1, 8, 0, 0)
     all_rows = []
     for i in range(n_patients):
-        base_time = start + timedelta(days=int(rng.integers(0, 180)), minutes=int(rng.integers(0, 24*60)))
+        base_time = START + timedelta(days=int(rng.integers(0, 180)), minutes=int(rng.integers(0, 24*60)))
         rows = generate_journey(rng, f"P{i:05d}", base_time, age[i], deprivation[i])
         for r in rows:
             r["sex"] = sex[i]
@@ -84,7 +213,6 @@ def main():
     df["timestamp"] = pd.to_datetime(df["timestamp"])
     df.sort_values(["patient_id", "timestamp"], inplace=True)
 
-    os.makedirs(os.path.dirname(OUT_PATH), exist_ok=True)
     df.to_csv(OUT_PATH, index=False)
 
     print(f"Saved synthetic event log: {OUT_PATH} ({len(df):,} rows, {df['patient_id'].nunique():,} patients)")
@@ -1,89 +1,291 @@
 import os
+import json
+import time
+import argparse
 import numpy as np
 import pandas as pd
-from collections import Counter
 from utils import seed_everything
+from scipy import sparse
+import npy_rows
+from journey_state import rebuild, refresh, STATE_DIR
+from sparse_features import write_csr, splice_csr, csr_meta
+
+# Columnar sequence builder. The event log is encoded once as integer event codes and folded
+# into the journey state (journey_state.py): per patient, the node of its pathway in the
+# prefix trie (pathway_index.py) plus first-row attributes and first/last event times. The
+# tables below are whole-array operations over that state: pathway strings, first events and
+# transition counts are computed once per distinct pathway and broadcast to its patients, so
+# no per-patient Python loop is left. --incremental ingests only the events appended to the
+# log since the last run. The features are also written as a CSR matrix (mostly zero
+# one-hots and transition counts), built from (row, column) pairs and per-pathway rows, so
+# its cost follows the non-zeros; 04 and 05 read it with --sparse.
+# With --incremental the outputs keep the state's row order (first appearance in the log,
+# which is patient_id order for a log written patient by patient) and are edited rather than
+# rewritten: rows are redone from the first one the refresh changed, where changed rows are
+# rendered again and the others keep their bytes, so new patients are appended. The line
+# offsets of the CSVs and the layout they were written with (transition columns, which of
+# them are float) live next to the state; a layout change, such as a first-seen
+# transition, rewrites the file in full.
 
 IN_PATH = os.path.join("data", "raw", "event_log.csv")
 OUT_SEQ = os.path.join("data", "processed", "journeys.csv")
 OUT_FEAT = os.path.join("reports", "journey_features.csv")
+# the numeric feature columns as a CSR matrix with its column index (sparse_features.py)
+OUT_SPARSE = os.path.join("reports", "journey_features.csr")
+OUT_INDEX = os.path.join("data", "processed", "pathway_index.npz")
+OUT_STATE = STATE_DIR
+# layout and line offsets of the outputs above, for --incremental
+OUT_EXPORTS = os.path.join(STATE_DIR, "exports")
 
 EVENT_VOCAB = ["ED_ARRIVAL","TRIAGE","VITALS","LABS","IMAGING","TREATMENT","OBSERVATION","SPECIALIST_REVIEW","DISCHARGE","ADMIT"]
 
-def transition_counts(events):
-    c = Counter()
-    for a,b in zip(events[:-1], events[1:]):
-        c[f"{a}->{b}"] += 1
-    return c
+FIRST_K = 5
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Build journey sequences and features from the event log.")
+    p.add_argument("--incremental", action="store_true",
+                   help="update the saved journey state with events appended since the last run")
+    p.add_argument("--sparse-only", action="store_true",
+                   help="write the features only in sparse form, not as the dense journey_features.csv")
+    return p.parse_args()
+
+def pathway_transitions(S, first_patient, vocab):
+    # transition counts per distinct pathway (rows of the code matrix S) for the transitions
+    # that occur, and their column names. Columns follow the order of first occurrence over
+    # the patient-sorted log: by the first patient with the transition, then by position
+    V = len(vocab)
+    L = S.shape[1]
+    a, b = S[:, :-1], S[:, 1:]
+    ok = (a >= 0) & (b >= 0)
+    row = np.broadcast_to(np.arange(len(S))[:, None], a.shape)[ok]
+    pos = np.broadcast_to(np.arange(L - 1), a.shape)[ok]
+    pair = (a * V + b)[ok]
+    counts = np.bincount(row * V * V + pair, minlength=len(S) * V * V).reshape(len(S), V * V)
+    first = np.full(len(S) * V * V, np.iinfo(np.int64).max)
+    np.minimum.at(first, row * V * V + pair, first_patient[row] * L + pos)
+    first = first.reshape(len(S), V * V).min(axis=0)
+    present = np.flatnonzero(counts.sum(axis=0) > 0)
+    order = present[np.argsort(first[present], kind="stable")]
+    return counts[:, order], [f"trans_{vocab[p // V]}->{vocab[p % V]}" for p in order]
+
+def distinct_pathways(state):
+    # per distinct pathway (trie node): its code row (S) and transition counts. Transition
+    # columns follow the order of the patients in state
+    nodes, first_patient = np.unique(state.patients["node"], return_index=True)
+    S = state.index.sequences(nodes, min_width=FIRST_K)
+    counts, trans_cols = pathway_transitions(S, first_patient, state.index.vocab)
+    # a patient without the transition was a missing key filled with 0, i.e. a float column
+    floats = (counts == 0).any(axis=0)
+    return {"nodes": nodes, "S": S, "counts": counts, "trans_cols": trans_cols, "floats": floats}
+
+def pathway_rows(state, paths):
+    return np.searchsorted(paths["nodes"], state.patients["node"])
+
+def numeric_columns(state):
+    p = state.patients
+    return {
+        "admitted": p["admitted"],
+        "age": p["age"],
+        "sex_M": (p["sex"] == "M").astype(np.int64),
+        "deprivation": p["deprivation"],
+        "n_events": state.index.depth[p["node"]],
+        "wait_time_min": p["wait_time_min"],
+        "los_min": state.los_min,
+    }
+
+def journeys_table(state, paths):
+    p = state.patients
+    inv = pathway_rows(state, paths)
+    names = np.array(state.index.vocab + ["NONE"], dtype=object)
+    var_str = np.array([" | ".join(names[v[v >= 0]]) for v in paths["S"]], dtype=object)
+    num = numeric_columns(state)
+    return pd.DataFrame({
+        "patient_id": p["patient_id"],
+        "events": var_str[inv],
+        "n_events": num["n_events"],
+        "admitted": num["admitted"],
+        "age": num["age"],
+        "sex": p["sex"],
+        "deprivation": num["deprivation"],
+        "wait_time_min": num["wait_time_min"],
+        "los_min": num["los_min"],
+    })
+
+def feature_table(state, paths):
+    p = state.patients
+    inv = pathway_rows(state, paths)
+    names = np.array(state.index.vocab + ["NONE"], dtype=object)
+    feat = {"patient_id": p["patient_id"], **numeric_columns(state)}
+    early = paths["S"][inv, :FIRST_K]
+    for i in range(FIRST_K):
+        feat[f"early_event_{i+1}"] = names[early[:, i]]
+    for i in range(FIRST_K):
+        for t, token in enumerate(EVENT_VOCAB + ["NONE"]):
+            code = -1 if token == "NONE" else t
+            feat[f"early{i+1}_{token}"] = (early[:, i] == code).astype(np.int64)
+    for j, col in enumerate(paths["trans_cols"]):
+        c = paths["counts"][inv, j]
+        feat[col] = c.astype(float) if paths["floats"][j] else c
+    return pd.DataFrame(feat)
+
+def sparse_features(state, paths):
+    # the numeric columns of journey_features.csv as CSR, built without a dense matrix:
+    # one-hots from (row, column) pairs, transitions as the per-pathway count rows of inv
+    num = numeric_columns(state)
+    n = state.n_patients
+    tokens = EVENT_VOCAB + ["NONE"]
+    inv = pathway_rows(state, paths)
+    early = paths["S"][inv, :FIRST_K]
+    tok = np.where(early < 0, len(EVENT_VOCAB), early)
+    tok[early >= len(EVENT_VOCAB)] = len(tokens)   # events outside EVENT_VOCAB have no one-hot
+    rows, cols = np.nonzero(tok < len(tokens))
+    onehot = sparse.csr_matrix((np.ones(len(rows)), (rows, cols * len(tokens) + tok[rows, cols])),
+                               shape=(n, FIRST_K * len(tokens)))
+    X = sparse.hstack([
+        sparse.csr_matrix(np.column_stack(list(num.values())).astype(float)),
+        onehot,
+        sparse.csr_matrix(paths["counts"].astype(float))[inv],
+    ], format="csr")
+    X.eliminate_zeros()
+    columns = list(num) + [f"early{i+1}_{t}" for i in range(FIRST_K) for t in tokens] + paths["trans_cols"]
+    return X, columns
+
+# incremental outputs
+
+def csv_lines(df):
+    return df.to_csv(index=False, header=False).encode().splitlines(keepends=True)
+
+def line_offsets(path):
+    # start of every data row of a CSV, then its size
+    return np.flatnonzero(np.fromfile(path, dtype=np.uint8) == ord("\n")) + 1
+
+def splice_csv(path, offsets_path, start, redo, lines):
+    # rewrite the rows start: of a CSV; rows flagged in redo take the next of lines, the
+    # others (all older rows) keep their bytes
+    off = np.load(offsets_path)
+    base = int(off[start])
+    lengths = np.empty(len(redo), dtype=np.int64)
+    lengths[~redo] = np.diff(off)[start + np.flatnonzero(~redo)]
+    lengths[redo] = [len(l) for l in lines]
+    cuts = np.r_[0, np.flatnonzero(np.diff(redo.astype(np.int8))) + 1, len(redo)]
+    with open(path, "r+b") as f:
+        f.seek(base)
+        old = f.read()
+        pieces, k = [], 0
+        for a, b in zip(cuts[:-1], cuts[1:]):
+            if redo[a]:
+                pieces.append(b"".join(lines[k:k + b - a]))
+                k += b - a
+            else:
+                pieces.append(old[off[start + a] - base:off[start + b] - base])
+        f.seek(base)
+        f.write(b"".join(pieces))
+        f.truncate()
+    npy_rows.splice(offsets_path, start + 1, base + np.cumsum(lengths))
+
+def write_outputs(state, paths, sparse_only):
+    # all rows, in the order of state; returns the size of every output
+    jdf = journeys_table(state, paths)
+    jdf.to_csv(OUT_SEQ, index=False)
+    X, columns = sparse_features(state, paths)
+    write_csr(OUT_SPARSE, X, columns, state.patients["patient_id"])
+    sizes = {"journeys": len(jdf), "sparse": (X.shape, X.nnz)}
+    if not sparse_only:
+        fdf = feature_table(state, paths)
+        fdf.to_csv(OUT_FEAT, index=False)
+        sizes["features"] = fdf.shape
+    return sizes
+
+def output_layout(paths, sparse_only):
+    return {"trans_cols": paths["trans_cols"], "floats": paths["floats"].tolist(), "features": not sparse_only}
+
+def editable(meta, state, layout, offsets):
+    # the outputs on disk are the ones the export meta describes, for this state and layout
+    if meta.get("generation") != state.generation or meta.get("layout") != layout or meta["rows"] > state.n_patients:
+        return False
+    try:
+        files = [(OUT_SEQ, offsets["journeys"], meta["sizes"]["journeys"])]
+        if layout["features"]:
+            files.append((OUT_FEAT, offsets["features"], meta["sizes"]["features"]))
+        return (csr_meta(OUT_SPARSE)["shape"][0] == meta["rows"] and
+                all(os.path.getsize(out) == size and npy_rows.n_rows(off) == meta["rows"] + 1
+                    for out, off, size in files))
+    except (OSError, KeyError, ValueError):
+        return False
+
+def update_outputs(state, paths, sparse_only):
+    # edit the outputs in row order; (rows redone, first row redone), or None after a full write
+    os.makedirs(OUT_EXPORTS, exist_ok=True)
+    meta_path = os.path.join(OUT_EXPORTS, "exports.json")
+    offsets = {"journeys": os.path.join(OUT_EXPORTS, "journeys.offsets.npy"),
+               "features": os.path.join(OUT_EXPORTS, "features.offsets.npy")}
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {}
+    layout = output_layout(paths, sparse_only)
+    n = state.n_patients
+    usable = editable(meta, state, layout, offsets)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)   # outputs are edited in place: an interrupted update must not be picked up
+    if usable:
+        redo = state.patients["stamp"] > meta["version"]
+        redo[meta["rows"]:] = True
+        todo = np.flatnonzero(redo)
+        start = int(todo[0]) if len(todo) else n
+        if len(todo):
+            tail, changed = state.take(np.arange(start, n)), state.take(todo)
+            splice_csv(OUT_SEQ, offsets["journeys"], start, redo[start:], csv_lines(journeys_table(changed, paths)))
+            if not sparse_only:
+                splice_csv(OUT_FEAT, offsets["features"], start, redo[start:], csv_lines(feature_table(changed, paths)))
+            X, columns = sparse_features(tail, paths)
+            splice_csr(OUT_SPARSE, start, X, tail.patients["patient_id"], columns)
+        result = (len(todo), start)
+    else:
+        write_outputs(state, paths, sparse_only)
+        np.save(offsets["journeys"], line_offsets(OUT_SEQ))
+        if not sparse_only:
+            np.save(offsets["features"], line_offsets(OUT_FEAT))
+        result = None
+    sizes = {"journeys": os.path.getsize(OUT_SEQ)}
+    if not sparse_only:
+        sizes["features"] = os.path.getsize(OUT_FEAT)
+    meta = {"generation": state.generation, "version": state.version, "rows": n, "layout": layout, "sizes": sizes}
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    return result
 
 def main():
+    args = parse_args()
     seed_everything(42)
-    df = pd.read_csv(IN_PATH, parse_dates=["timestamp"])
-    df.sort_values(["patient_id","timestamp"], inplace=True)
-
-    journeys = []
-    features = []
-    for pid, g in df.groupby("patient_id"):
-        g = g.sort_values("timestamp")
-        ev = g["event"].tolist()
-        admitted = int(g["admitted"].iloc[0])
-        age = int(g["age"].iloc[0])
-        sex = g["sex"].iloc[0]
-        deprivation = int(g["deprivation"].iloc[0])
-
-        t0 = g["timestamp"].iloc[0]
-        t_end = g["timestamp"].iloc[-1]
-        los = int((t_end - t0).total_seconds() / 60)
-        wait = int(g["wait_time_min"].iloc[0])
-
-        journeys.append({
-            "patient_id": pid,
-            "events": " | ".join(ev),
-            "n_events": len(ev),
-            "admitted": admitted,
-            "age": age,
-            "sex": sex,
-            "deprivation": deprivation,
-            "wait_time_min": wait,
-            "los_min": los
-        })
-
-        trans = transition_counts(ev)
-        feat = {
-            "patient_id": pid,
-            "admitted": admitted,
-            "age": age,
-            "sex_M": 1 if sex == "M" else 0,
-            "deprivation": deprivation,
-            "n_events": len(ev),
-            "wait_time_min": wait,
-            "los_min": los,
-        }
-
-        first_k = 5
-        early = ev[:min(first_k, len(ev))]
-        for i in range(first_k):
-            feat[f"early_event_{i+1}"] = early[i] if i < len(early) else "NONE"
-
-        for i in range(first_k):
-            for token in (EVENT_VOCAB + ["NONE"]):
-                feat[f"early{i+1}_{token}"] = 1 if feat[f"early_event_{i+1}"] == token else 0
-
-        for k,v in trans.items():
-            feat[f"trans_{k}"] = v
-
-        features.append(feat)
-
-    jdf = pd.DataFrame(journeys)
-    fdf = pd.DataFrame(features).fillna(0)
-
+    t0 = time.perf_counter()
+    state, info = (refresh if args.incremental else rebuild)(IN_PATH, OUT_STATE, OUT_INDEX)
     os.makedirs(os.path.dirname(OUT_SEQ), exist_ok=True)
     os.makedirs(os.path.dirname(OUT_FEAT), exist_ok=True)
-    jdf.to_csv(OUT_SEQ, index=False)
-    fdf.to_csv(OUT_FEAT, index=False)
 
-    print(f"Saved journeys: {OUT_SEQ} ({len(jdf):,})")
-    print(f"Saved features: {OUT_FEAT} ({fdf.shape[0]:,} x {fdf.shape[1]:,})")
+    if args.incremental:
+        # rows in first-seen order, so appended patients are appended rows
+        rows = state.take(state.by_row())
+        paths = distinct_pathways(rows)
+        edit = update_outputs(rows, paths, args.sparse_only)
+    else:
+        paths = distinct_pathways(state)
+        write_outputs(state, paths, args.sparse_only)
+        edit = None
+    meta = csr_meta(OUT_SPARSE)
+    (n, m), nnz = meta["shape"], meta["nnz"]
+
+    print(f"Saved journeys: {OUT_SEQ} ({n:,})")
+    if not args.sparse_only:
+        print(f"Saved features: {OUT_FEAT} ({n:,} x {1 + FIRST_K + m:,})")
+    print(f"Saved sparse features: {OUT_SPARSE} ({n:,} x {m:,}, {nnz / max(n * m, 1):.1%} non-zero)")
+    print(f"Saved pathway index: {OUT_INDEX} ({state.index.n_variants:,} variants, {state.index.n_nodes:,} prefixes)")
+    if edit is not None:
+        print(f"Outputs edited: {edit[0]:,} rows redone from row {edit[1]:,} of {n:,}")
+    print(f"{info['mode'].capitalize()} update: {info['new_events']:,} events, {info['updated_patients']:,} patients "
+          f"updated, {info['new_patients']:,} added, {state.n_open:,} journeys open "
+          f"(state {info['seconds']:.2f}s, total {time.perf_counter() - t0:.2f}s)")
 
 if __name__ == "__main__":
     main()
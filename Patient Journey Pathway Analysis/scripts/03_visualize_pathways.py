@@ -1,14 +1,27 @@
 import os
+import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import plotly.graph_objects as go
 from utils import seed_everything, EVENTS, SERVICE_ORDER
+from pathway_index import PathwayIndex
+from journey_state import refresh, STATE_DIR
 
 IN_PATH = os.path.join("data", "raw", "event_log.csv")
+IN_INDEX = os.path.join("data", "processed", "pathway_index.npz")
 HEATMAP_OUT = os.path.join("figures", "transition_heatmap.png")
 SANKEY_OUT = os.path.join("reports", "sankey_pathways.html")
 
+# prefixes (trie nodes) shown in the Sankey, most-travelled first
+SANKEY_MAX_NODES = 60
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Transition heatmap and pathway Sankey.")
+    p.add_argument("--incremental", action="store_true",
+                   help="take the transition matrix and index from the journey state, updated with new events only")
+    return p.parse_args()
+
 def build_transition_matrix(df):
     counts = np.zeros((len(EVENTS), len(EVENTS)), dtype=int)
     for pid, g in df.groupby("patient_id"):
@@ -29,34 +42,42 @@ def save_heatmap(mat):
     plt.savefig(HEATMAP_OUT, dpi=200)
     plt.close()
 
-def save_sankey(mat):
-    links = []
-    for i,a in enumerate(EVENTS):
-        for j,b in enumerate(EVENTS):
-            if mat[i,j] > 0:
-                links.append((a,b,int(mat[i,j])))
-    links.sort(key=lambda x: x[2], reverse=True)
-    top = links[:30]
-
-    label = EVENTS
-    src = [SERVICE_ORDER[a] for a,b,v in top]
-    tgt = [SERVICE_ORDER[b] for a,b,v in top]
-    val = [v for a,b,v in top]
+def save_sankey(index, max_nodes=SANKEY_MAX_NODES):
+    # multi-step flows from the pathway index: each Sankey node is a prefix of the journey
+    # (so TREATMENT after LABS and TREATMENT after VITALS are different nodes) and each link
+    # carries the journeys that continue from one prefix to the next
+    nodes, links = index.flows(max_nodes=max_nodes)
+    pos = {v: i for i, v in enumerate(nodes)}
+    label = [index.vocab[index.code[v]] for v in nodes]
+    hover = []
+    for v in nodes:
+        s = index.prefix(index.path(v))
+        hover.append(f"{' > '.join(index.path(v))}<br>{s['count']:,} journeys, "
+                     f"admission {s['admit_rate']:.0%}, mean LOS {s['mean_los_min']:.0f} min")
 
     fig = go.Figure(data=[go.Sankey(
-        node=dict(pad=15, thickness=20, line=dict(width=0.5), label=label),
-        link=dict(source=src, target=tgt, value=val)
+        node=dict(pad=15, thickness=20, line=dict(width=0.5), label=label,
+                  customdata=hover, hovertemplate="%{customdata}<extra></extra>"),
+        link=dict(source=[pos[a] for a,b,v in links], target=[pos[b] for a,b,v in links],
+                  value=[v for a,b,v in links])
     )])
-    fig.update_layout(title_text="Top unscheduled-care pathway flows (synthetic)", font_size=11)
+    fig.update_layout(title_text="Unscheduled-care pathway flows by step (synthetic)", font_size=11)
     os.makedirs(os.path.dirname(SANKEY_OUT), exist_ok=True)
     fig.write_html(SANKEY_OUT)
 
 def main():
+    args = parse_args()
     seed_everything(42)
-    df = pd.read_csv(IN_PATH, parse_dates=["timestamp"])
-    mat = build_transition_matrix(df)
+    if args.incremental:
+        state, info = refresh(IN_PATH, STATE_DIR, IN_INDEX)
+        print(f"{info['mode'].capitalize()} update: {info['new_events']:,} new events ({info['seconds']:.2f}s)")
+        # the state vocabulary starts with EVENTS; events outside it are left out of the heatmap
+        mat, index = state.transitions[:len(EVENTS), :len(EVENTS)], state.index
+    else:
+        df = pd.read_csv(IN_PATH, parse_dates=["timestamp"])
+        mat, index = build_transition_matrix(df), PathwayIndex.load(IN_INDEX)
     save_heatmap(mat)
-    save_sankey(mat)
+    save_sankey(index)
     print(f"Saved: {HEATMAP_OUT}")
     print(f"Saved: {SANKEY_OUT}")
 
@@ -1,32 +1,218 @@
 import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
+from scipy import sparse
+from threadpoolctl import threadpool_limits
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
 from sklearn.preprocessing import StandardScaler
 from utils import seed_everything
+from sparse_features import read_csr, csr_columns, iter_csr
+
+# --streaming clusters block by block, so memory is bounded by --block-rows whatever the
+# number of journeys. One pass fits the scaler and draws a uniform row sample (the rows with
+# the smallest random keys); K-means is initialised on the sample (several k-means++ starts)
+# and refined with mini-batch updates over --epochs passes; a last pass writes the labels
+# and accumulates the cluster summary. --k-sweep fits one such model per k in parallel and
+# records streamed inertia and silhouette on the sample; without --k the best silhouette wins.
 
 FEAT_PATH = os.path.join("reports","journey_features.csv")
+SPARSE_PATH = os.path.join("reports","journey_features.csr")
 OUT_ASSIGN = os.path.join("reports","journey_clusters.csv")
 OUT_SUM = os.path.join("reports","cluster_summary.csv")
 FIG_OUT = os.path.join("figures","cluster_profiles.png")
+OUT_K = os.path.join("reports","k_selection.csv")
+FIG_K = os.path.join("figures","k_selection.png")
+
+OUT_COLS = ["admitted","age","deprivation","n_events","wait_time_min","los_min"]
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Cluster journeys into typologies.")
+    p.add_argument("--sparse", action="store_true",
+                   help="read the CSR features (reports/journey_features.csr) and cluster them without densifying")
+    p.add_argument("--streaming", action="store_true",
+                   help="mini-batch K-means over blocks of rows instead of the whole matrix in memory")
+    p.add_argument("--k", type=int, default=None, help="number of clusters (default 5, or the best silhouette of --k-sweep)")
+    p.add_argument("--k-sweep", default=None, help="values of k to compare, e.g. 2-10 or 3,5,8 (implies --streaming)")
+    p.add_argument("--block-rows", type=int, default=100_000, help="rows read per block (--streaming)")
+    p.add_argument("--batch-size", type=int, default=4096, help="mini-batch size (--streaming)")
+    p.add_argument("--epochs", type=int, default=2, help="mini-batch passes over the data (--streaming)")
+    p.add_argument("--sample", type=int, default=10_000, help="rows sampled for initialisation and silhouette")
+    p.add_argument("--workers", type=int, default=None, help="processes fitting k values in parallel (--k-sweep)")
+    return p.parse_args()
+
+def parse_ks(spec):
+    if "-" in spec:
+        lo, hi = map(int, spec.split("-"))
+        return list(range(lo, hi + 1))
+    return sorted({int(k) for k in spec.split(",")})
+
+def feature_columns(columns):
+    cols = [c for c in columns if c.startswith("trans_") or (c.startswith("early") and not c.startswith("early_event_"))]
+    return cols + ["age","deprivation","n_events","wait_time_min"]
+
+def load_sparse():
+    # (feature matrix, per-journey output columns); centring would densify, so no mean
+    X, _, ids = read_csr(SPARSE_PATH, feature_columns(csr_columns(SPARSE_PATH)))
+    out, _, _ = read_csr(SPARSE_PATH, OUT_COLS)
+    df = pd.DataFrame(out.toarray().astype(np.int64), columns=OUT_COLS)
+    df.insert(0, "patient_id", ids)
+    return X, df
+
+def feature_blocks(args, cols):
+    # (features, per-journey output columns) over consecutive row blocks
+    if args.sparse:
+        for start, X, ids in iter_csr(SPARSE_PATH, cols, args.block_rows):
+            out, _, _ = read_csr(SPARSE_PATH, OUT_COLS, slice(start, start + X.shape[0]))
+            df = pd.DataFrame(out.toarray().astype(np.int64), columns=OUT_COLS)
+            df.insert(0, "patient_id", ids)
+            yield X, df
+    else:
+        for chunk in pd.read_csv(FEAT_PATH, chunksize=args.block_rows):
+            yield chunk[cols].to_numpy(dtype=float), chunk[["patient_id"] + OUT_COLS].reset_index(drop=True)
+
+def stream_columns(args):
+    header = csr_columns(SPARSE_PATH) if args.sparse else pd.read_csv(FEAT_PATH, nrows=0).columns
+    return feature_columns(header)
+
+def scan(args, cols):
+    # scaler statistics and a uniform sample of --sample rows, in one pass
+    scaler = StandardScaler(with_mean=False)
+    rng = np.random.default_rng(42)
+    sample, keys = None, np.array([])
+    for X, _ in feature_blocks(args, cols):
+        scaler.partial_fit(X)
+        keys = np.r_[keys, rng.random(X.shape[0])]
+        sample = X if sample is None else (sparse.vstack([sample, X], format="csr") if args.sparse else np.vstack([sample, X]))
+        if len(keys) > args.sample:
+            keep = np.sort(np.argpartition(keys, args.sample)[:args.sample])
+            sample, keys = sample[keep], keys[keep]
+    return scaler, scaler.transform(sample)
+
+def fit_minibatch(args, cols, scaler, sample, k):
+    km = MiniBatchKMeans(n_clusters=k, n_init=5, batch_size=args.batch_size, random_state=42)
+    km.fit(sample)
+    for _ in range(args.epochs):
+        for X, _ in feature_blocks(args, cols):
+            X = scaler.transform(X)
+            for i in range(0, X.shape[0], args.batch_size):
+                km.partial_fit(X[i:i + args.batch_size])
+    return km
+
+def streamed_inertia(args, cols, scaler, km):
+    return float(sum(-km.score(scaler.transform(X)) for X, _ in feature_blocks(args, cols)))
+
+_SHARED = {}
+
+def _init_worker():
+    # one BLAS/OpenMP thread per process; parallelism comes from fitting several k at once
+    _SHARED["limits"] = threadpool_limits(1)
+
+def sweep_k(args, cols, scaler, sample, k):
+    t0 = time.perf_counter()
+    km = fit_minibatch(args, cols, scaler, sample, k)
+    labels = km.predict(sample)
+    sil = silhouette_score(sample, labels) if len(np.unique(labels)) > 1 else float("nan")
+    row = {"k": k, "inertia": streamed_inertia(args, cols, scaler, km), "silhouette": sil,
+           "seconds": round(time.perf_counter() - t0, 2)}
+    return row, km
+
+def save_k_selection(table, k):
+    table.to_csv(OUT_K, index=False)
+    os.makedirs(os.path.dirname(FIG_K), exist_ok=True)
+    fig, axes = plt.subplots(1, 2, figsize=(11,4))
+    for ax, col in zip(axes, ["inertia", "silhouette"]):
+        ax.plot(table["k"], table[col], marker="o")
+        ax.axvline(k, color="grey", linestyle="--", linewidth=1)
+        ax.set_xlabel("k")
+        ax.set_title(col + (" (streamed)" if col == "inertia" else " (sampled)"))
+    plt.tight_layout()
+    plt.savefig(FIG_K, dpi=200)
+    plt.close()
+
+def assign_streaming(args, cols, scaler, km):
+    # labels written block by block; the summary comes from per-cluster running sums
+    k = km.n_clusters
+    n = np.zeros(k, dtype=np.int64)
+    sums = np.zeros((k, len(OUT_COLS)))
+    first = True
+    for X, df in feature_blocks(args, cols):
+        labels = km.predict(scaler.transform(X))
+        df["cluster"] = labels
+        df.to_csv(OUT_ASSIGN, mode="w" if first else "a", header=first, index=False)
+        first = False
+        n += np.bincount(labels, minlength=k)
+        sums += np.column_stack([np.bincount(labels, df[c].to_numpy(dtype=float), minlength=k) for c in OUT_COLS])
+    keep = n > 0
+    means = pd.DataFrame(sums[keep] / n[keep, None], columns=OUT_COLS)
+    return pd.DataFrame({
+        "cluster": np.flatnonzero(keep), "n": n[keep],
+        "admit_rate": means["admitted"], "avg_events": means["n_events"], "avg_wait": means["wait_time_min"],
+        "avg_los": means["los_min"], "avg_age": means["age"], "avg_deprivation": means["deprivation"],
+    })
+
+def cluster_streaming(args):
+    cols = stream_columns(args)
+    scaler, sample = scan(args, cols)
+    if args.k_sweep:
+        ks = parse_ks(args.k_sweep)
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as ex:
+            results = list(ex.map(sweep_k, *zip(*[(args, cols, scaler, sample, k) for k in ks])))
+        table = pd.DataFrame([r for r, _ in results])
+        k = args.k or int(table.loc[table["silhouette"].idxmax(), "k"])
+        save_k_selection(table, k)
+        print(table.to_string(index=False))
+        print(f"Saved k selection: {OUT_K}, {FIG_K} (k={k})")
+        models = {r["k"]: m for r, m in results}
+        km = models[k] if k in models else fit_minibatch(args, cols, scaler, sample, k)
+    else:
+        km = fit_minibatch(args, cols, scaler, sample, args.k or 5)
+    return assign_streaming(args, cols, scaler, km)
+
+def save_profiles(summ):
+    os.makedirs(os.path.dirname(FIG_OUT), exist_ok=True)
+    plt.figure(figsize=(10,6))
+    x = np.arange(len(summ))
+    plt.bar(x-0.2, summ["admit_rate"], width=0.4, label="admission rate")
+    plt.bar(x+0.2, (summ["avg_wait"]/summ["avg_wait"].max()).fillna(0), width=0.4, label="avg wait (norm)")
+    plt.xticks(x, [f"C{c}" for c in summ["cluster"]])
+    plt.ylim(0,1.05)
+    plt.title("Journey typologies (clusters): admission vs wait time (normalised)")
+    plt.legend()
+    plt.tight_layout()
+    plt.savefig(FIG_OUT, dpi=200)
+    plt.close()
 
 def main():
+    args = parse_args()
     seed_everything(42)
-    df = pd.read_csv(FEAT_PATH)
+    if args.streaming or args.k_sweep:
+        summ = cluster_streaming(args)
+        summ.to_csv(OUT_SUM, index=False)
+        save_profiles(summ)
+        print(f"Saved assignments: {OUT_ASSIGN}")
+        print(f"Saved summary: {OUT_SUM}")
+        print(f"Saved figure: {FIG_OUT}")
+        return
 
-    cols = [c for c in df.columns if c.startswith("trans_") or (c.startswith("early") and not c.startswith("early_event_"))]
-    cols += ["age","deprivation","n_events","wait_time_min"]
-    X = df[cols].values
-
-    scaler = StandardScaler(with_mean=False) if np.any(X==0) else StandardScaler()
+    if args.sparse:
+        X, df = load_sparse()
+        scaler = StandardScaler(with_mean=False)
+    else:
+        df = pd.read_csv(FEAT_PATH)
+        X = df[feature_columns(df.columns)].values
+        scaler = StandardScaler(with_mean=False) if np.any(X==0) else StandardScaler()
     Xs = scaler.fit_transform(X)
 
-    k = 5
+    k = args.k or 5
     km = KMeans(n_clusters=k, n_init=20, random_state=42)
     labels = km.fit_predict(Xs)
 
-    df_out = df[["patient_id","admitted","age","deprivation","n_events","wait_time_min","los_min"]].copy()
+    df_out = df[["patient_id"] + OUT_COLS].copy()
     df_out["cluster"] = labels
     df_out.to_csv(OUT_ASSIGN, index=False)
 
@@ -40,19 +226,7 @@ def main():
         avg_deprivation=("deprivation","mean"),
     ).reset_index()
     summ.to_csv(OUT_SUM, index=False)
-
-    os.makedirs(os.path.dirname(FIG_OUT), exist_ok=True)
-    plt.figure(figsize=(10,6))
-    x = np.arange(k)
-    plt.bar(x-0.2, summ["admit_rate"], width=0.4, label="admission rate")
-    plt.bar(x+0.2, (summ["avg_wait"]/summ["avg_wait"].max()).fillna(0), width=0.4, label="avg wait (norm)")
-    plt.xticks(x, [f"C{c}" for c in summ["cluster"]])
-    plt.ylim(0,1.05)
-    plt.title("Journey typologies (clusters): admission vs wait time (normalised)")
-    plt.legend()
-    plt.tight_layout()
-    plt.savefig(FIG_OUT, dpi=200)
-    plt.close()
+    save_profiles(summ)
 
     print(f"Saved assignments: {OUT_ASSIGN}")
     print(f"Saved summary: {OUT_SUM}")
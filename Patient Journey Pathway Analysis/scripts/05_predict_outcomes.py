@@ -1,5 +1,6 @@
 import os
 import json
+import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -11,8 +12,10 @@ from sklearn.calibration import calibration_curve
 from sklearn.preprocessing import StandardScaler
 from sklearn.pipeline import Pipeline
 from utils import seed_everything
+from sparse_features import read_csr, csr_columns
 
 FEAT_PATH = os.path.join("reports","journey_features.csv")
+SPARSE_PATH = os.path.join("reports","journey_features.csr")
 METRICS_OUT = os.path.join("reports","metrics.json")
 ROC_OUT = os.path.join("figures","roc_admission.png")
 CAL_OUT = os.path.join("figures","calibration_admission.png")
@@ -30,20 +33,32 @@ def ece_score(y_true, y_prob, n_bins=10):
         ece += (mask.sum()/len(y_true)) * abs(acc - conf)
     return float(ece)
 
+def parse_args():
+    p = argparse.ArgumentParser(description="Predict admission from early pathway signals.")
+    p.add_argument("--sparse", action="store_true",
+                   help="train on the CSR features (reports/journey_features.csr) without densifying")
+    return p.parse_args()
+
+def feature_columns(columns):
+    return [c for c in columns if c.startswith("early") and not c.startswith("early_event_")] + ["age","deprivation","wait_time_min","n_events"]
+
 def main():
+    args = parse_args()
     seed_everything(42)
-    df = pd.read_csv(FEAT_PATH)
-    y = df["admitted"].values
-
-    cols = [c for c in df.columns if c.startswith("early") and not c.startswith("early_event_")] + ["age","deprivation","wait_time_min","n_events"]
-    X = df[cols].values
+    if args.sparse:
+        X, _, _ = read_csr(SPARSE_PATH, feature_columns(csr_columns(SPARSE_PATH)))
+        y = read_csr(SPARSE_PATH, ["admitted"])[0].toarray().ravel().astype(int)
+    else:
+        df = pd.read_csv(FEAT_PATH)
+        y = df["admitted"].values
+        X = df[feature_columns(df.columns)].values
 
     X_train, X_test, y_train, y_test = train_test_split(
         X, y, test_size=0.25, random_state=42, stratify=y
     )
 
     lr = Pipeline([
-        ("scaler", StandardScaler(with_mean=False) if np.any(X==0) else StandardScaler()),
+        ("scaler", StandardScaler(with_mean=False) if args.sparse or np.any(X==0) else StandardScaler()),
         ("clf", LogisticRegression(max_iter=2000))
     ])
     gb = GradientBoostingClassifier(random_state=42)
@@ -92,7 +107,7 @@ def main():
     plt.close()
 
     metrics = {
-        "n_patients": int(df.shape[0]),
+        "n_patients": int(X.shape[0]),
         "test_size": int(len(y_test)),
         "models": {
             "logistic_regression": {"auroc": float(auc_lr), "brier": float(brier_lr), "ece": ece_lr},
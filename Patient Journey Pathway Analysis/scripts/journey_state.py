@@ -0,0 +1,305 @@
+import io
+import os
+import json
+import time
+import zlib
+import numpy as np
+import pandas as pd
+import npy_rows
+from utils import EVENTS
+from sequences import segments, code_matrix
+from pathway_index import PathwayIndex, journey_values
+
+# Persisted journey state for incremental refreshes of 02 and 03.
+# Per patient (sorted by patient_id) it keeps the trie node of the journey so far (the
+# pathway index holds the actual sequence), the first and last event time and the
+# first-row attributes; next to it the event-to-event transition matrix. Everything 02 and
+# 03 write is derived from this state. The watermark is the byte offset of the last
+# ingested row of event_log.csv, which is assumed to grow by appending whole rows: a refresh
+# reads only the bytes after it. Patients with new events are removed from the index and
+# transition matrix and re-added with their extended journey, so a refresh costs time in
+# proportion to the new events and the patients they touch, not to the history.
+# A log that was rewritten (header or the bytes before the watermark changed), or events
+# older than a patient's last event, cannot be applied in place and trigger a full rebuild.
+# On disk every patient has a fixed row, in order of its first appearance in the log, with
+# one .npy file per column (npy_rows.py): a save rewrites the rows of updated patients in
+# place and appends new patients, so it costs time in proportion to them. Each row carries
+# the state version that last changed it (stamp), which is how 02 finds the rows of its
+# exports to redo, whichever of 02 or 03 ingested the events.
+
+STATE_DIR = os.path.join("data", "processed", "journey_state")
+INDEX_PATH = os.path.join("data", "processed", "pathway_index.npz")
+
+# first-row attributes carried per patient
+ATTRS = ["admitted", "age", "sex", "deprivation", "wait_time_min"]
+
+# events that close a journey; journeys ending elsewhere are still open
+CLOSING = ["ADMIT", "DISCHARGE"]
+
+# bytes before the watermark that must be unchanged for an incremental refresh
+TAIL_CHECK = 4096
+
+# per-patient columns on disk; only the UPDATED ones change after a patient is added
+COLUMNS = ["patient_id", "node", "first_ts", "last_ts"] + ATTRS + ["stamp"]
+UPDATED = ["node", "last_ts", "stamp"]
+
+class StaleState(Exception):
+    pass
+
+def pair_counts(M, V):
+    # (V, V) event-to-event transition counts over the code matrix
+    a, b = M[:, :-1], M[:, 1:]
+    ok = (a >= 0) & (b >= 0)
+    return np.bincount((a * V + b)[ok], minlength=V * V).reshape(V, V)
+
+def _timestamps(df):
+    return df["timestamp"].to_numpy().astype("datetime64[ns]").astype(np.int64)
+
+def _los(first_ts, last_ts):
+    return np.trunc((last_ts - first_ts) / 1e9 / 60).astype(np.int64)
+
+class JourneyState:
+    def __init__(self, patients, index, transitions, watermark, version=0, generation=None):
+        self.patients = patients        # dict of per-patient arrays, sorted by patient_id
+        self.index = index
+        self.transitions = transitions
+        self.watermark = watermark
+        self.version = version          # bumped by every ingest; rows changed by it get stamp = version
+        self.generation = generation or f"{time.time_ns():x}"   # changes with every full rebuild
+        self._stored = 0                # rows on disk
+        self._saved = 0                 # version on disk
+
+    @classmethod
+    def empty(cls):
+        patients = {c: np.array([], dtype=str if c in ("patient_id", "sex") else np.int64) for c in COLUMNS + ["row"]}
+        return cls(patients, PathwayIndex.empty(list(EVENTS)), np.zeros((len(EVENTS),) * 2, dtype=np.int64), {})
+
+    def take(self, pos):
+        # the patients at sorted positions pos, in that order, for building tables
+        return JourneyState({c: a[pos] for c, a in self.patients.items()}, self.index, self.transitions,
+                            self.watermark, self.version, self.generation)
+
+    def by_row(self):
+        # sorted positions of the patients in row order
+        pos = np.empty(self.n_patients, dtype=np.int64)
+        pos[self.patients["row"]] = np.arange(self.n_patients)
+        return pos
+
+    @property
+    def n_patients(self):
+        return len(self.patients["patient_id"])
+
+    @property
+    def los_min(self):
+        return _los(self.patients["first_ts"], self.patients["last_ts"])
+
+    @property
+    def n_open(self):
+        last = self.index.code[self.patients["node"]]
+        closing = [self.index.vocab.index(e) for e in CLOSING if e in self.index.vocab]
+        return int((~np.isin(last, closing)).sum())
+
+    def _values(self, rows):
+        p = self.patients
+        return journey_values(p["admitted"][rows], p["wait_time_min"][rows],
+                              _los(p["first_ts"][rows], p["last_ts"][rows]))
+
+    def ingest(self, df):
+        # fold new event rows into the state; returns (patients updated, patients added)
+        if not len(df):
+            return 0, 0
+        self.version += 1
+        df = df.reset_index(drop=True).sort_values(["patient_id", "timestamp"], kind="stable")
+        index, p = self.index, self.patients
+        V0 = len(index.vocab)
+        index.grow_vocab(sorted(set(pd.unique(df["event"])) - set(index.vocab)))
+        V = len(index.vocab)
+        if V > V0:
+            grown = np.zeros((V, V), dtype=np.int64)
+            grown[:V0, :V0] = self.transitions
+            self.transitions = grown
+        codes = pd.Categorical(df["event"].to_numpy(), categories=index.vocab).codes.astype(np.int64)
+        pids = df["patient_id"].to_numpy().astype(str)
+        starts, lengths = segments(pids)
+        ends = starts + lengths - 1
+        ts = _timestamps(df)
+
+        # patients already in the state
+        new_pids = pids[starts]
+        pos = np.searchsorted(p["patient_id"], new_pids)
+        known = pos < self.n_patients
+        known[known] = p["patient_id"][pos[known]] == new_pids[known]
+        rows = pos[known]
+        late = ts[starts][known] < p["last_ts"][rows]
+        if late.any():
+            raise StaleState(f"{int(late.sum())} patients have events older than their last ingested event")
+
+        # take the known journeys out, extend them, put them back
+        old_nodes = p["node"][rows]
+        old_seq = index.sequences(old_nodes)
+        index.add(old_nodes, old_seq, self._values(rows), sign=-1)
+        self.transitions -= pair_counts(old_seq, V)
+
+        nodes = np.zeros(len(starts), dtype=np.int64)
+        nodes[known] = old_nodes
+        nodes = index.extend(nodes, code_matrix(codes, starts, lengths))
+
+        p["node"][rows] = nodes[known]
+        p["last_ts"][rows] = ts[ends][known]
+        p["stamp"][rows] = self.version
+        # new patients get the next rows, in order of their first row in df
+        first_seen = np.minimum.reduceat(df.index.to_numpy(), starts)[~known]
+        added = {"patient_id": new_pids[~known], "node": nodes[~known],
+                 "first_ts": ts[starts][~known], "last_ts": ts[ends][~known],
+                 "stamp": np.full(len(first_seen), self.version),
+                 "row": self.n_patients + np.argsort(np.argsort(first_seen, kind="stable"))}
+        for c in ATTRS:
+            v = df[c].to_numpy()[starts][~known]
+            added[c] = v.astype(str) if v.dtype == object else v
+        self._insert(pos[~known], added)
+
+        # rows of the touched patients after the insert
+        rows = np.searchsorted(p["patient_id"], new_pids)
+        seq = index.sequences(p["node"][rows])
+        index.add(p["node"][rows], seq, self._values(rows))
+        self.transitions += pair_counts(seq, V)
+        return int(known.sum()), int((~known).sum())
+
+    def _insert(self, pos, added):
+        # merge new patients into the sorted arrays at their searchsorted positions
+        if not len(pos):
+            return
+        total = self.n_patients + len(pos)
+        is_new = np.zeros(total, dtype=bool)
+        is_new[pos + np.arange(len(pos))] = True
+        for c, old in self.patients.items():
+            new = np.asarray(added[c])
+            out = np.empty(total, dtype=np.result_type(old, new))
+            out[~is_new] = old
+            out[is_new] = new
+            self.patients[c] = out
+
+    # persistence
+
+    def save(self, state_dir=STATE_DIR, index_path=INDEX_PATH):
+        pdir = os.path.join(state_dir, "patients")
+        os.makedirs(pdir, exist_ok=True)
+        meta_path = os.path.join(state_dir, "state.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)   # rows are edited in place: an interrupted save must not be picked up
+        p, pos, stored = self.patients, self.by_row(), self._stored
+        changed = np.flatnonzero(p["stamp"][pos[:stored]] > self._saved)
+        for c in COLUMNS:
+            path = os.path.join(pdir, f"{c}.npy")
+            if not stored:
+                np.save(path, p[c][pos])
+                continue
+            if c in UPDATED:
+                npy_rows.update(path, changed, p[c][pos[changed]])
+            if self.n_patients > stored:
+                npy_rows.splice(path, stored, p[c][pos[stored:]])
+        if not stored or self.n_patients > stored:
+            np.save(os.path.join(state_dir, "order.npy"), p["row"])
+        # the index and transition matrix grow with distinct prefixes and events, not patients
+        np.save(os.path.join(state_dir, "transitions.npy"), self.transitions)
+        self.index.save(index_path)
+        # written last: a state is only picked up when its meta matches the arrays
+        meta = {"watermark": self.watermark, "n_patients": self.n_patients, "n_nodes": self.index.n_nodes,
+                "index": index_path, "version": self.version, "generation": self.generation}
+        with open(meta_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        self._stored, self._saved = self.n_patients, self.version
+
+    @classmethod
+    def load(cls, state_dir=STATE_DIR, index_path=INDEX_PATH):
+        # None when there is no usable state
+        try:
+            with open(os.path.join(state_dir, "state.json"), "r") as f:
+                meta = json.load(f)
+            order = np.load(os.path.join(state_dir, "order.npy"))
+            rows = {c: np.load(os.path.join(state_dir, "patients", f"{c}.npy")) for c in COLUMNS}
+            transitions = np.load(os.path.join(state_dir, "transitions.npy"))
+            index = PathwayIndex.load(index_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        n = meta["n_patients"]
+        if len(order) != n or any(len(a) != n for a in rows.values()) or meta["n_nodes"] != index.n_nodes:
+            return None
+        patients = {c: a[order] for c, a in rows.items()}
+        patients["row"] = order
+        state = cls(patients, index, transitions, meta["watermark"], meta["version"], meta["generation"])
+        state._stored, state._saved = n, state.version
+        return state
+
+# event log watermark
+
+def _tail_crc(f, offset, header_end):
+    start = max(header_end, offset - TAIL_CHECK)
+    f.seek(start)
+    return zlib.crc32(f.read(offset - start))
+
+def log_watermark(path, rows, max_ts):
+    # watermark after a full read of the log: the end of its last complete row
+    with open(path, "rb") as f:
+        header = f.readline()
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - TAIL_CHECK))
+        tail = f.read()
+        offset = size - len(tail) + tail.rfind(b"\n") + 1
+        return {"offset": offset, "rows": int(rows), "header": header.decode().strip(),
+                "tail_crc": _tail_crc(f, offset, len(header)), "max_timestamp": max_ts}
+
+def read_new_events(path, watermark):
+    # (rows appended after the watermark, advanced watermark); StaleState if the log changed
+    with open(path, "rb") as f:
+        header = f.readline()
+        offset = watermark.get("offset", 0)
+        size = f.seek(0, os.SEEK_END)
+        if header.decode().strip() != watermark.get("header") or size < offset:
+            raise StaleState("the event log was rewritten")
+        if _tail_crc(f, offset, len(header)) != watermark["tail_crc"]:
+            raise StaleState("the event log was rewritten")
+        f.seek(offset)
+        data = f.read()
+    data = data[:data.rfind(b"\n") + 1]   # a row still being written waits for the next refresh
+    wm = dict(watermark)
+    if not data:
+        return pd.DataFrame(columns=watermark["header"].split(",")), wm
+    df = pd.read_csv(io.BytesIO(data), names=watermark["header"].split(","), parse_dates=["timestamp"])
+    wm["offset"] = offset + len(data)
+    wm["rows"] = watermark["rows"] + len(df)
+    with open(path, "rb") as f:
+        wm["tail_crc"] = _tail_crc(f, wm["offset"], len(header))
+    wm["max_timestamp"] = max(filter(None, [watermark.get("max_timestamp"), str(df["timestamp"].max())]))
+    return df, wm
+
+def rebuild(log_path, state_dir=STATE_DIR, index_path=INDEX_PATH):
+    # full build from the whole event log
+    t0 = time.perf_counter()
+    df = pd.read_csv(log_path, parse_dates=["timestamp"])
+    state = JourneyState.empty()
+    state.ingest(df)
+    state.watermark = log_watermark(log_path, len(df), str(df["timestamp"].max()) if len(df) else None)
+    state.save(state_dir, index_path)
+    info = {"mode": "full", "new_events": len(df), "updated_patients": 0,
+            "new_patients": state.n_patients, "seconds": time.perf_counter() - t0}
+    return state, info
+
+def refresh(log_path, state_dir=STATE_DIR, index_path=INDEX_PATH):
+    # bring the persisted state up to date with the log; (state, info)
+    t0 = time.perf_counter()
+    state = JourneyState.load(state_dir, index_path)
+    if state is None:
+        return rebuild(log_path, state_dir, index_path)
+    try:
+        df, wm = read_new_events(log_path, state.watermark)
+        updated, added = state.ingest(df)
+    except StaleState as e:
+        print(f"Full rebuild: {e}")
+        return rebuild(log_path, state_dir, index_path)
+    state.watermark = wm
+    if len(df):
+        state.save(state_dir, index_path)
+    info = {"mode": "incremental", "new_events": len(df), "updated_patients": updated,
+            "new_patients": added, "seconds": time.perf_counter() - t0}
+    return state, info
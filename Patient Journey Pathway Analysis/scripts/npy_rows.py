@@ -0,0 +1,61 @@
+import io
+import os
+import numpy as np
+from numpy.lib import format as npy
+
+# Row-level edits of 1-D .npy files on disk, for state that grows by appending. numpy pads
+# the .npy header so the length can grow without moving the data, so appending rows, or
+# replacing every row from some position on, only writes the header and the new bytes; rows
+# before the edit are neither read nor written. Updating given rows goes through a writable
+# memory map. A file is only rewritten in full when the values need a wider dtype (e.g.
+# longer strings).
+
+def _header(f):
+    version = npy.read_magic(f)
+    read = npy.read_array_header_1_0 if version == (1, 0) else npy.read_array_header_2_0
+    shape, _, dtype = read(f)
+    return version, shape[0], dtype, f.tell()
+
+def _fits(dtype, values):
+    # values can be stored as dtype without loss
+    if np.result_type(dtype, values.dtype) == dtype:
+        return True
+    if dtype.kind in "iu" and values.dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        return not len(values) or (info.min <= values.min() and values.max() <= info.max)
+    return False
+
+def n_rows(path):
+    with open(path, "rb") as f:
+        return _header(f)[1]
+
+def splice(path, start, values):
+    # replace rows start: with values; start == n_rows(path) appends
+    values = np.asarray(values)
+    if start == 0 and not os.path.exists(path):
+        np.save(path, values)
+        return
+    with open(path, "r+b") as f:
+        version, n, dtype, offset = _header(f)
+        if start > n:
+            raise ValueError(f"{path}: cannot write at row {start} of {n}")
+        header = io.BytesIO()
+        write = npy.write_array_header_1_0 if version == (1, 0) else npy.write_array_header_2_0
+        write(header, {"descr": npy.dtype_to_descr(dtype), "fortran_order": False, "shape": (start + len(values),)})
+        if _fits(dtype, values) and header.tell() == offset:
+            f.seek(0)
+            f.write(header.getvalue())
+            f.seek(offset + start * dtype.itemsize)
+            f.write(values.astype(dtype).tobytes())
+            f.truncate()
+            return
+    np.save(path, np.concatenate([np.load(path)[:start], values]))
+
+def update(path, rows, values):
+    # overwrite the given rows in place
+    if not len(rows):
+        return
+    a = np.load(path, mmap_mode="r+")
+    a[rows] = values
+    a.flush()
+    del a
@@ -0,0 +1,282 @@
+import json
+import numpy as np
+import pandas as pd
+
+# Pathway index: a prefix trie over the encoded journeys, stored as flat arrays.
+# Node 0 is the empty prefix; every other node is one event appended to its parent's
+# prefix, so a journey is fully described by its last node. Journeys are inserted level by
+# level (one np.unique over new (parent, code) keys per position), vectorised over journeys,
+# and parents always have smaller ids than their children. Each node keeps the journeys
+# passing through it (count, admissions, wait and LOS sums) and those ending at it, i.e.
+# the full pathway variants. n-grams up to max_ngram events are counted too (occurrences
+# and journeys containing them); longer ones are answered from the variant table.
+# Journeys can be removed and re-added (sign -1 / +1), which is how appended events are
+# folded in without rebuilding (journey_state.py).
+# Queries are a walk of dict lookups, so they take microseconds whatever the log size.
+
+STATS = ["count", "admitted", "wait_sum", "los_sum"]
+
+def _summary(count, admitted, wait_sum, los_sum):
+    n = int(count)
+    return {
+        "count": n,
+        "admitted": int(admitted),
+        "admit_rate": admitted / n if n else float("nan"),
+        "mean_wait_min": wait_sum / n if n else float("nan"),
+        "mean_los_min": los_sum / n if n else float("nan"),
+    }
+
+def journey_values(admitted, wait, los):
+    # per-journey STATS rows
+    return np.column_stack([np.ones(len(admitted)), admitted, wait, los]).astype(float)
+
+class PathwayIndex:
+    def __init__(self, vocab, parent, code, depth, through, end, ngram_keys, ngram_counts, max_ngram):
+        self.vocab = list(vocab)
+        self.parent = parent
+        self.code = code
+        self.depth = depth
+        self.through = through   # (nodes, 4): STATS of journeys passing through the node
+        self.end = end           # (nodes, 4): STATS of journeys ending at the node
+        self.ngram_keys = ngram_keys
+        self.ngram_counts = ngram_counts   # (keys, 2): occurrences, journeys
+        self.max_ngram = max_ngram
+        self._reindex()
+
+    def _reindex(self):
+        V = len(self.vocab)
+        keys = self.parent[1:] * V + self.code[1:]
+        self._child = dict(zip(keys.tolist(), range(1, len(self.parent))))
+        order = np.argsort(keys, kind="stable")
+        self._child_keys, self._child_ids = keys[order], order + 1
+        self._ngram = dict(zip(self.ngram_keys.tolist(), range(len(self.ngram_keys))))
+        self._codes = {e: i for i, e in enumerate(self.vocab)}
+        self._variant_paths = None
+
+    @classmethod
+    def empty(cls, vocab, max_ngram=3):
+        return cls(vocab, np.array([-1]), np.array([-1]), np.array([0]), np.zeros((1, 4)), np.zeros((1, 4)),
+                   np.array([], dtype=np.int64), np.zeros((0, 2), dtype=np.int64), max_ngram)
+
+    @classmethod
+    def build(cls, M, admitted, wait, los, vocab, max_ngram=3):
+        # M: (journeys, positions) event codes, -1 after the end of a journey
+        index = cls.empty(vocab, max_ngram)
+        nodes = index.extend(np.zeros(len(M), dtype=np.int64), M)
+        index.add(nodes, M, journey_values(admitted, wait, los))
+        return index
+
+    # updates
+
+    def grow_vocab(self, names):
+        # append event names; codes of existing events are unchanged, n-gram keys re-encoded
+        names = [e for e in names if e not in self._codes]
+        if not names:
+            return
+        B, B2 = len(self.vocab) + 1, len(self.vocab) + len(names) + 1
+        keys, new, scale = self.ngram_keys.copy(), np.zeros_like(self.ngram_keys), 1
+        while (keys > 0).any():
+            new += keys % B * scale
+            keys //= B
+            scale *= B2
+        self.ngram_keys = new
+        self.vocab += names
+        self._reindex()
+
+    def extend(self, nodes, M):
+        # walk (and insert) the codes of M after the given nodes; returns the new end nodes
+        nodes = np.asarray(nodes, dtype=np.int64).copy()
+        V = len(self.vocab)
+        for d in range(M.shape[1]):
+            alive = np.flatnonzero(M[:, d] >= 0)
+            if not len(alive):
+                break
+            key = nodes[alive] * V + M[alive, d]
+            i = np.searchsorted(self._child_keys, key)
+            found = i < len(self._child_keys)
+            found[found] = self._child_keys[i[found]] == key[found]
+            child = np.zeros(len(key), dtype=np.int64)
+            child[found] = self._child_ids[i[found]]
+            if not found.all():
+                u, inv = np.unique(key[~found], return_inverse=True)
+                child[~found] = len(self.parent) + inv
+                self.parent = np.r_[self.parent, u // V]
+                self.code = np.r_[self.code, u % V]
+                self.depth = np.r_[self.depth, self.depth[u // V] + 1]
+                self.through = np.vstack([self.through, np.zeros((len(u), 4))])
+                self.end = np.vstack([self.end, np.zeros((len(u), 4))])
+                self._reindex()
+            nodes[alive] = child
+        return nodes
+
+    def add(self, nodes, M, values, sign=1):
+        # add (sign=1) or remove (sign=-1) journeys ending at `nodes`, with full code
+        # sequences M and STATS rows `values`
+        n = len(self.parent)
+        values = sign * np.asarray(values, dtype=float)
+        cur = np.asarray(nodes, dtype=np.int64)
+        self.end += np.column_stack([np.bincount(cur, values[:, j], minlength=n) for j in range(4)])
+        while len(cur):
+            self.through += np.column_stack([np.bincount(cur, values[:, j], minlength=n) for j in range(4)])
+            up = self.parent[cur]
+            values, cur = values[up >= 0], up[up >= 0]
+        keys, counts = self._count_ngrams(M, len(self.vocab), self.max_ngram)
+        keys = np.r_[self.ngram_keys, keys]
+        u, inv = np.unique(keys, return_inverse=True)
+        merged = np.zeros((len(u), 2), dtype=np.int64)
+        np.add.at(merged, inv, np.r_[self.ngram_counts, sign * counts])
+        keep = merged[:, 0] > 0
+        self.ngram_keys, self.ngram_counts = u[keep], merged[keep]
+        self._ngram = dict(zip(self.ngram_keys.tolist(), range(len(self.ngram_keys))))
+        self._variant_paths = None
+
+    def sequences(self, nodes, min_width=0):
+        # (journeys, longest) code matrix of the pathways ending at `nodes`, -1 padded
+        nodes = np.asarray(nodes, dtype=np.int64)
+        pos = self.depth[nodes] - 1
+        M = np.full((len(nodes), max(int(pos.max(initial=-1)) + 1, min_width)), -1, dtype=np.int64)
+        rows, cur = np.arange(len(nodes)), nodes
+        while len(cur):
+            ok = cur > 0
+            rows, cur, pos = rows[ok], cur[ok], pos[ok]
+            M[rows, pos] = self.code[cur]
+            cur, pos = self.parent[cur], pos - 1
+        return M
+
+    @staticmethod
+    def _count_ngrams(M, V, max_ngram):
+        # key = sum (code + 1) * (V + 1)^i, unique across lengths
+        n, L = M.shape
+        keys, occ, jour = [], [], []
+        for k in range(1, min(max_ngram, L) + 1):
+            w = np.stack([M[:, i:L - k + 1 + i] for i in range(k)], axis=-1)
+            ok = (w >= 0).all(axis=-1)
+            key = ((w + 1) * (V + 1) ** np.arange(k)).sum(axis=-1)
+            rows = np.broadcast_to(np.arange(n)[:, None], ok.shape)[ok]
+            u, c = np.unique(key[ok], return_counts=True)
+            # journeys containing it: distinct (key, journey) pairs per key
+            pairs = np.unique(key[ok] * n + rows)
+            _, cj = np.unique(pairs // n, return_counts=True)
+            keys.append(u)
+            occ.append(c)
+            jour.append(cj)
+        if not keys:
+            return np.array([], dtype=np.int64), np.zeros((0, 2), dtype=np.int64)
+        return np.concatenate(keys), np.column_stack([np.concatenate(occ), np.concatenate(jour)])
+
+    @property
+    def n_nodes(self):
+        return len(self.parent)
+
+    @property
+    def n_variants(self):
+        return int((self.end[:, 0] > 0).sum())
+
+    # lookups
+
+    def encode(self, seq):
+        # event names (list or "A>B>C" string) or codes -> codes; None if an event is unknown
+        if isinstance(seq, str):
+            seq = [s.strip() for s in seq.replace("->", ">").split(">") if s.strip()]
+        out = []
+        for e in seq:
+            c = self._codes.get(e) if isinstance(e, str) else int(e)
+            if c is None:
+                return None
+            out.append(c)
+        return out
+
+    def node(self, seq):
+        # trie node of a prefix, -1 if no journey starts with it
+        codes = self.encode(seq)
+        if codes is None:
+            return -1
+        v, V = 0, len(self.vocab)
+        for c in codes:
+            v = self._child.get(v * V + c, -1)
+            if v < 0:
+                return -1
+        return v
+
+    def path(self, node):
+        out = []
+        while node > 0:
+            out.append(self.vocab[self.code[node]])
+            node = self.parent[node]
+        return out[::-1]
+
+    def prefix(self, seq):
+        # journeys whose pathway starts with seq
+        v = self.node(seq)
+        return _summary(*(self.through[v] if v >= 0 else np.zeros(4)))
+
+    def variant(self, seq):
+        # journeys whose full pathway is exactly seq
+        v = self.node(seq)
+        return _summary(*(self.end[v] if v >= 0 else np.zeros(4)))
+
+    def ngram(self, seq):
+        # contiguous sub-path anywhere in the journey: occurrences and journeys containing it
+        codes = self.encode(seq)
+        if not codes:
+            return {"occurrences": 0, "journeys": 0}
+        if len(codes) <= self.max_ngram:
+            key = sum((c + 1) * (len(self.vocab) + 1) ** i for i, c in enumerate(codes))
+            i = self._ngram.get(key)
+            occ, jour = self.ngram_counts[i] if i is not None else (0, 0)
+            return {"occurrences": int(occ), "journeys": int(jour)}
+        # longer sub-paths: scan the variants (far fewer than journeys)
+        occ = jour = 0
+        k = len(codes)
+        for v, p in self._variants():
+            hits = sum(p[i:i + k] == codes for i in range(len(p) - k + 1))
+            if hits:
+                n = int(self.end[v, 0])
+                occ += hits * n
+                jour += n
+        return {"occurrences": occ, "journeys": jour}
+
+    def _variants(self):
+        if self._variant_paths is None:
+            nodes = np.flatnonzero(self.end[:, 0] > 0)
+            self._variant_paths = [(v, [self._codes[e] for e in self.path(v)]) for v in nodes]
+        return self._variant_paths
+
+    def variants(self, min_count=1):
+        # table of full pathway variants with outcome aggregates
+        nodes = np.flatnonzero(self.end[:, 0] >= max(min_count, 1))
+        rows = [dict(pathway=" > ".join(self.path(v)), n_events=int(self.depth[v]), **_summary(*self.end[v]))
+                for v in nodes]
+        return pd.DataFrame(rows, columns=["pathway", "n_events", "count", "admitted", "admit_rate",
+                                           "mean_wait_min", "mean_los_min"])
+
+    def top_variants(self, n=20, by="count", min_count=1):
+        df = self.variants(min_count=min_count)
+        return df.sort_values([by, "count"], ascending=False, kind="stable").head(n).reset_index(drop=True)
+
+    def flows(self, max_nodes=60, max_depth=None):
+        # Sankey links parent -> child over the most-travelled prefixes. A child never has
+        # more journeys than its parent and comes after it on ties, so the top nodes by count
+        # always include the parents of the nodes they include
+        cand = np.flatnonzero((self.depth >= 1) & ((self.depth <= max_depth) if max_depth else True))
+        order = cand[np.argsort(-self.through[cand, 0], kind="stable")]
+        keep = order[:max_nodes]
+        kept = set(keep.tolist())
+        links = [(int(self.parent[v]), int(v), int(self.through[v, 0])) for v in keep
+                 if self.parent[v] in kept]
+        return sorted(kept), links
+
+    # persistence
+
+    def save(self, path):
+        meta = {"vocab": self.vocab, "stats": STATS, "max_ngram": self.max_ngram}
+        np.savez_compressed(path, meta=np.array(json.dumps(meta)), parent=self.parent, code=self.code,
+                            depth=self.depth, through=self.through, end=self.end,
+                            ngram_keys=self.ngram_keys, ngram_counts=self.ngram_counts)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            meta = json.loads(str(z["meta"]))
+            return cls(meta["vocab"], z["parent"], z["code"], z["depth"], z["through"], z["end"],
+                       z["ngram_keys"], z["ngram_counts"], meta["max_ngram"])
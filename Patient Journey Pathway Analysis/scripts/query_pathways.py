@@ -0,0 +1,40 @@
+import os
+import argparse
+import pandas as pd
+from pathway_index import PathwayIndex
+
+# Ask the pathway index saved by 02 (data/processed/pathway_index.npz) about journeys,
+# without re-reading the event log. Pathways are given as events joined by ">", e.g.
+#     python scripts/query_pathways.py --ngram "LABS>IMAGING>ADMIT"
+#     python scripts/query_pathways.py --top 20 --by admit_rate --min-count 50
+# From Python:
+#     index = PathwayIndex.load("data/processed/pathway_index.npz")
+#     index.prefix("ED_ARRIVAL>TRIAGE>VITALS>LABS")
+
+IN_INDEX = os.path.join("data", "processed", "pathway_index.npz")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Prefix, variant and sub-path queries on the pathway index.")
+    p.add_argument("--index", default=IN_INDEX)
+    p.add_argument("--prefix", action="append", default=[], help="journeys starting with this pathway")
+    p.add_argument("--variant", action="append", default=[], help="journeys with exactly this pathway")
+    p.add_argument("--ngram", action="append", default=[], help="journeys containing this sub-path")
+    p.add_argument("--top", type=int, default=0, help="show the top N full pathway variants")
+    p.add_argument("--by", default="count", choices=["count", "admit_rate", "mean_wait_min", "mean_los_min"])
+    p.add_argument("--min-count", type=int, default=1)
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    index = PathwayIndex.load(args.index)
+    for kind in ["prefix", "variant", "ngram"]:
+        for q in getattr(args, kind):
+            res = getattr(index, kind)(q)
+            print(f"{kind} {q}: " + ", ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v:,}"
+                                              for k, v in res.items()))
+    if args.top:
+        with pd.option_context("display.max_colwidth", None, "display.width", 200):
+            print(index.top_variants(args.top, by=args.by, min_count=args.min_count).to_string(index=False))
+
+if __name__ == "__main__":
+    main()
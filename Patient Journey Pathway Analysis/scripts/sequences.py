@@ -0,0 +1,18 @@
+import numpy as np
+
+# Segmented-array helpers for the encoded event log. With the log sorted by
+# (patient_id, timestamp), every patient is a contiguous segment of the event arrays,
+# described by its start offset and length.
+
+def segments(keys):
+    # start offsets and lengths of the runs of equal keys in a sorted array
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype=np.int64)
+    return starts, np.diff(np.r_[starts, len(keys)])
+
+def code_matrix(codes, starts, lengths, min_width=0):
+    # (patients, longest journey) matrix of event codes, -1 past the end of a journey
+    seg = np.repeat(np.arange(len(starts)), lengths)
+    pos = np.arange(len(codes)) - np.repeat(starts, lengths)
+    M = np.full((len(starts), max(int(lengths.max(initial=0)), min_width)), -1, dtype=np.int64)
+    M[seg, pos] = codes
+    return M
@@ -0,0 +1,75 @@
+import os
+import json
+import numpy as np
+from scipy import sparse
+import npy_rows
+
+# Sparse feature store: a CSR matrix kept as a directory of plain .npy arrays (data,
+# indices, indptr) plus the patient ids and a columns.json column index. The arrays are
+# memory-mapped on read, so a block of rows or a subset of columns only touches the
+# non-zeros it needs, and nothing is densified on the way into a model. splice_csr replaces
+# the rows from some position on in place, so appending rows does not rewrite the store.
+
+META = "columns.json"
+
+def write_csr(path, X, columns, ids):
+    X = sparse.csr_matrix(X)
+    if X.shape[1] != len(columns) or X.shape[0] != len(ids):
+        raise ValueError(f"matrix {X.shape} does not fit {len(ids)} ids x {len(columns)} columns")
+    os.makedirs(path, exist_ok=True)
+    X.sort_indices()
+    for name in ["data", "indices", "indptr"]:
+        np.save(os.path.join(path, f"{name}.npy"), getattr(X, name))
+    np.save(os.path.join(path, "ids.npy"), np.asarray(ids).astype(str))
+    _write_meta(path, columns, X.shape, X.nnz)
+
+def _write_meta(path, columns, shape, nnz):
+    with open(os.path.join(path, META), "w") as f:
+        json.dump({"columns": list(columns), "shape": list(shape), "nnz": int(nnz)}, f, indent=2)
+
+def splice_csr(path, start, X, ids, columns):
+    # replace rows start: of the store with X (same columns); start == rows appends
+    meta = csr_meta(path)
+    if list(columns) != meta["columns"] or start > meta["shape"][0]:
+        raise ValueError(f"{path}: cannot write {len(columns)} columns at row {start}")
+    X = sparse.csr_matrix(X)
+    X.sort_indices()
+    lo = int(np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")[start])
+    npy_rows.splice(os.path.join(path, "data.npy"), lo, X.data)
+    npy_rows.splice(os.path.join(path, "indices.npy"), lo, X.indices)
+    npy_rows.splice(os.path.join(path, "indptr.npy"), start + 1, X.indptr[1:] + lo)
+    npy_rows.splice(os.path.join(path, "ids.npy"), start, np.asarray(ids).astype(str))
+    _write_meta(path, columns, (start + X.shape[0], len(columns)), lo + X.nnz)
+
+def csr_meta(path):
+    with open(os.path.join(path, META), "r") as f:
+        return json.load(f)
+
+def csr_columns(path):
+    return csr_meta(path)["columns"]
+
+def read_csr(path, columns=None, rows=None):
+    # (CSR matrix, column names, ids) for a row slice and/or a list of column names
+    meta = csr_meta(path)
+    n, m = meta["shape"]
+    start, stop, _ = (rows or slice(None)).indices(n)
+    load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+    indptr = np.asarray(load("indptr")[start:stop + 1])
+    lo, hi = int(indptr[0]), int(indptr[-1])
+    X = sparse.csr_matrix((np.asarray(load("data")[lo:hi]), np.asarray(load("indices")[lo:hi]), indptr - lo),
+                          shape=(stop - start, m))
+    ids = np.asarray(load("ids")[start:stop])
+    if columns is None:
+        return X, meta["columns"], ids
+    pos = {c: i for i, c in enumerate(meta["columns"])}
+    missing = [c for c in columns if c not in pos]
+    if missing:
+        raise KeyError(f"{path}: no columns {missing}")
+    return X[:, [pos[c] for c in columns]], list(columns), ids
+
+def iter_csr(path, columns=None, block_rows=100_000):
+    # (first row, CSR block, ids) over consecutive row blocks
+    n = csr_meta(path)["shape"][0]
+    for start in range(0, n, block_rows):
+        X, _, ids = read_csr(path, columns, slice(start, min(start + block_rows, n)))
+        yield start, X, ids